@@ -0,0 +1,225 @@
+"""
+Benchmarks the hot paths of xray-cAD against the number of shadowsocks instances.
+
+Config generation, refurbish and the /lc, /gc, /rc bot handlers are run against a
+fake docker binary (benchmarks/fake_docker) and stubbed telegram updates, so no
+docker daemon and no bot token are needed. Run from the repository root:
+
+    python benchmarks/bench_services.py --sizes 10 1000 10000 20000 --output bench_output.json
+
+Every measurement reports wall time, the number of files opened and peak python memory.
+Sizes are capped by the port range (24001 ports without excluded_ports.txt). What the
+code under test prints goes to stderr, so "--output -" stays valid JSON.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "src"))
+os.environ["PATH"] = os.path.join(BENCHMARKS_DIR, "fake_docker") + os.pathsep + os.environ["PATH"]
+
+from services import (
+    parse_config,
+    generate_tmpdir,
+    generate_xray_config,
+    generate_docker_compose,
+    refurbish_xray_inbound_intance,
+    remove_tmpdir
+)
+
+class FileOpenCounter:
+    """
+    Counts every file opened by the interpreter (open(), os.open(), tempfile, ...) through an audit hook.
+    Audit hooks can't be removed, so the counter is only switched on and off.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.count = 0
+        sys.addaudithook(self._hook)
+
+    def _hook(self, event, args):
+        if self.enabled and event in ("open", "os.open"):
+            self.count += 1
+
+file_open_counter = FileOpenCounter()
+
+def measure(name, instances_count, func):
+
+    file_open_counter.count = 0
+    file_open_counter.enabled = True
+    tracemalloc.start()
+    started_at = time.perf_counter()
+
+    try:
+        func()
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        wall_seconds = time.perf_counter() - started_at
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        file_open_counter.enabled = False
+
+    return {
+        "name": name,
+        "instances": instances_count,
+        "wall_seconds": round(wall_seconds, 6),
+        "files_opened": file_open_counter.count,
+        "peak_memory_bytes": peak_memory,
+        "error": error
+    }
+
+class StubMessage:
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.chat = self
+        self.id = chat_id
+        self.replies = []
+
+    async def reply_text(self, text=None, reply_markup=None, **kwargs):
+        self.replies.append(text)
+        return self
+
+    async def edit_text(self, text=None, reply_markup=None, **kwargs):
+        self.replies.append(text)
+        return self
+
+    async def reply_document(self, document=None, filename=None, **kwargs):
+        return self
+
+class StubCallbackQuery:
+
+    def __init__(self, data, message):
+        self.data = data
+        self.message = message
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, text=None, reply_markup=None, **kwargs):
+        self.message.replies.append(text)
+
+    async def edit_message_reply_markup(self, reply_markup=None, **kwargs):
+        pass
+
+class StubBot:
+
+    async def send_document(self, chat_id, document, filename=None, **kwargs):
+        pass
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        pass
+
+    async def send_message(self, chat_id, text, **kwargs):
+        pass
+
+class StubUpdate:
+    """
+    Just the parts of telegram.Update the handlers look at.
+    """
+
+    def __init__(self, chat_id, callback_data=None):
+        self.message = StubMessage(chat_id)
+        self.callback_query = StubCallbackQuery(callback_data, self.message) if callback_data is not None else None
+
+        # callback query updates don't carry a message of their own
+        if callback_data is not None:
+            self.message = None
+
+class StubContext:
+
+    def __init__(self, args=()):
+        self.args = list(args)
+        self.bot = StubBot()
+
+def bench_size(config, instances_count, with_handlers):
+
+    config = dict(config)
+    config["xray_inbound_separated_instances"] = {"shadowsocks_instances_count": instances_count}
+
+    tmpdir = generate_tmpdir()
+    results = []
+
+    try:
+        results.append(measure("generate_xray_config", instances_count, lambda: generate_xray_config(config=config, tmpdir=tmpdir)))
+
+        if results[-1]["error"] is not None:
+            return results
+
+        results.append(measure("generate_docker_compose", instances_count, lambda: generate_docker_compose(config=config, tmpdir=tmpdir)))
+        results.append(measure("refurbish_xray_inbound_intance", instances_count, lambda: refurbish_xray_inbound_intance(config=config, tmpdir=tmpdir, instance_num=instances_count // 2)))
+
+        if not with_handlers:
+            return results
+
+        try:
+            from telebot import build_handlers
+        except ImportError as e:
+            results.append({"name": "handlers", "instances": instances_count, "error": f"skipped, {e}"})
+            return results
+
+        chat_id = 1
+        command_handlers, callback_query_handlers = build_handlers(users_whitelist=[chat_id], config=config, tmpdir=tmpdir)
+        callback_query_handler = {pattern.split(":")[0].lstrip("^"): handler for pattern, handler in callback_query_handlers.items()}
+
+        def run_handler(handler, update):
+            asyncio.run(handler(update, StubContext()))
+
+        for command in ("lc", "gc", "rc"):
+            results.append(measure(f"/{command}", instances_count, lambda: run_handler(command_handlers[command], StubUpdate(chat_id))))
+
+        results.append(measure("/gc callback", instances_count, lambda: run_handler(
+            callback_query_handler["getconfigforinboundnum"], StubUpdate(chat_id, f"getconfigforinboundnum:{instances_count // 2}")
+        )))
+        results.append(measure("/gc next page", instances_count, lambda: run_handler(
+            callback_query_handler["inboundspage"], StubUpdate(chat_id, "inboundspage:gc:1:")
+        )))
+        results.append(measure("/rc callback", instances_count, lambda: run_handler(
+            callback_query_handler["refurbishinboundnum"], StubUpdate(chat_id, f"refurbishinboundnum:{instances_count // 2}")
+        )))
+    finally:
+        remove_tmpdir(tmpdir)
+
+    return results
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--no-handlers", action="store_true", help="only benchmark the services layer")
+    parser.add_argument("--output", default="-", help="where to write the json results, - for stdout")
+    args = parser.parse_args()
+
+    config = parse_config()
+
+    with contextlib.redirect_stdout(sys.stderr):
+        bench_results = [result for instances_count in args.sizes for result in bench_size(config, instances_count, not args.no_handlers)]
+
+    results = {
+        "python": sys.version.split()[0],
+        "network": config["xray_shadowsocks_inbound_network"],
+        "ports_publishing": config.get("docker_ports_publishing", "ports"),
+        "results": bench_results
+    }
+
+    output = json.dumps(results, indent=4)
+
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Compares xray-core container startup time between the ports publishing modes.
+
+Run from the repository root (needs docker and the settings in src/configuration):
+
+    python benchmarks/compose_startup.py --instances 300 --modes ports ranges host
+
+It runs as its own compose project (xray-cad-bench), so it never touches the containers of a
+live deployment. Docker and the services layer only write to stderr here, so "--output -" stays valid JSON.
+"""
+
+import argparse
+import contextlib
+import json
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, "src")
+
+from services import (
+    parse_config,
+    generate_tmpdir,
+    generate_xray_config,
+    generate_docker_compose,
+    remove_tmpdir
+)
+
+# keeps the benchmark containers apart from the ones of a live deployment
+BENCH_COMPOSE_PROJECT_NAME = "xray-cad-bench"
+
+def wait_until_running(tmpdir, timeout):
+
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        result = subprocess.run(
+            ["docker", "compose", "-p", BENCH_COMPOSE_PROJECT_NAME, "ps", "--status", "running", "--quiet"],
+            cwd=tmpdir, capture_output=True, text=True, check=True
+        )
+        if result.stdout.strip():
+            return True
+        time.sleep(0.1)
+
+    return False
+
+def measure_startup(config, mode, instances_count, timeout):
+
+    config = dict(config)
+    config["docker_ports_publishing"] = mode
+    config["xray_inbound_separated_instances"] = {"shadowsocks_instances_count": instances_count}
+
+    tmpdir = generate_tmpdir()
+
+    try:
+        generate_xray_config(config=config, tmpdir=tmpdir)
+        generate_docker_compose(config=config, tmpdir=tmpdir)
+
+        started_at = time.monotonic()
+        subprocess.run(["docker", "compose", "-p", BENCH_COMPOSE_PROJECT_NAME, "up", "-d"], check=True, cwd=tmpdir, capture_output=True)
+        up_seconds = time.monotonic() - started_at
+
+        running = wait_until_running(tmpdir, timeout)
+        running_seconds = time.monotonic() - started_at
+
+        started_at = time.monotonic()
+        subprocess.run(["docker", "compose", "-p", BENCH_COMPOSE_PROJECT_NAME, "down", "--remove-orphans"], check=True, cwd=tmpdir, capture_output=True)
+        down_seconds = time.monotonic() - started_at
+    finally:
+        remove_tmpdir(tmpdir)
+
+    return {
+        "mode": mode,
+        "instances": instances_count,
+        "network": config["xray_shadowsocks_inbound_network"],
+        "compose_up_seconds": round(up_seconds, 3),
+        "running_after_seconds": round(running_seconds, 3) if running else None,
+        "compose_down_seconds": round(down_seconds, 3)
+    }
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--instances", type=int, default=300)
+    parser.add_argument("--modes", nargs="+", default=["ports", "ranges", "host"])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--output", default="-", help="where to write the json results, - for stdout")
+    args = parser.parse_args()
+
+    config = parse_config()
+
+    with contextlib.redirect_stdout(sys.stderr):
+        results = [
+            measure_startup(config, mode, args.instances, args.timeout)
+            for mode in args.modes
+            for _ in range(args.repeat)
+        ]
+
+    output = json.dumps(results, indent=4)
+
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,502 @@
+"""
+Load-tests the generated inbounds on localhost. A swarm of shadowsocks (or vless) clients pushes
+traffic through the running xray-core to a local echo sink. The results are throughput, latency
+percentiles and error rates per inbound and per cipher, for sizing instance counts and methods.
+
+Run from the repository root. It needs docker, the cryptography package and the settings in src/configuration:
+
+    python benchmarks/load_test.py --instances 10 100 --methods aes-256-gcm chacha20-ietf-poly1305 --clients 20 --duration 30
+
+Every instances x method combination gets a freshly generated config, brought up with docker compose and torn
+down afterwards. It runs as its own compose project (xray-cad-bench), so it never touches the containers
+of a live deployment, but the ports come from the same range and can still collide with it.
+Two things differ from what xray-cAD runs: "host" ports publishing, so the container reaches the sink on
+127.0.0.1, and no rule blackholing private addresses.
+
+--tmpdir load-tests an already running generated config instead. Its routing has to let the sink through.
+
+Docker and the services layer only write to stderr here, so "--output -" stays valid JSON.
+
+shadowsocks-2022 inbounds are skipped: their key schedule needs blake3, which isn't around.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import struct
+import subprocess
+import sys
+import time
+import uuid
+
+sys.path.insert(0, "src")
+
+from health import (
+    AEAD_TAG_LENGTH,
+    SHADOWSOCKS_AEAD_METHODS,
+    ShadowsocksAead,
+    describe_probe_error,
+    render_socks_address,
+    render_vless_address
+)
+from services import (
+    parse_config,
+    generate_tmpdir,
+    generate_xray_config,
+    generate_docker_compose,
+    remove_tmpdir
+)
+from shards import get_shard_config_filename
+from state import InboundRecord, get_state_store
+
+# keeps the benchmark containers apart from the ones of a live deployment
+BENCH_COMPOSE_PROJECT_NAME = "xray-cad-bench"
+
+# the biggest payload of one shadowsocks AEAD chunk
+SHADOWSOCKS_MAX_CHUNK = 0x3FFF
+
+# keeps a udp request and its reply inside a single unfragmented datagram
+UDP_MAX_PAYLOAD = 1200
+
+RECONNECT_DELAY = 0.1
+
+def percentile(values, fraction):
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))]
+
+def new_stats():
+    return {"requests": 0, "bytes": 0, "latencies": [], "errors": {}}
+
+def add_error(stats, error):
+    description = describe_probe_error(error)
+    stats["errors"][description] = stats["errors"].get(description, 0) + 1
+
+def merge_stats(target, stats):
+    target["requests"] += stats["requests"]
+    target["bytes"] += stats["bytes"]
+    target["latencies"].extend(stats["latencies"])
+
+    for description, count in stats["errors"].items():
+        target["errors"][description] = target["errors"].get(description, 0) + count
+
+def summarize_stats(stats, duration):
+
+    errors_count = sum(stats["errors"].values())
+    attempts = stats["requests"] + errors_count
+
+    summary = {
+        "requests": stats["requests"],
+        "error_rate": round(errors_count / attempts, 4) if attempts else None,
+        "errors": stats["errors"],
+        # echoed payload, counted once - what a client gets through the inbound
+        "throughput_mbps": round(stats["bytes"] * 8 / duration / 1e6, 3)
+    }
+
+    if stats["latencies"]:
+        summary["latency_p50_ms"] = round(percentile(stats["latencies"], 0.5) * 1000, 3)
+        summary["latency_p90_ms"] = round(percentile(stats["latencies"], 0.9) * 1000, 3)
+        summary["latency_p99_ms"] = round(percentile(stats["latencies"], 0.99) * 1000, 3)
+
+    return summary
+
+class TcpTunnel:
+    """
+    A client connection through one inbound to the sink: shadowsocks AEAD chunks both ways,
+    or a bare VLESS request header and a response header in front of the raw stream.
+    """
+
+    def __init__(self, inbound, reader, writer):
+        self.inbound = inbound
+        self.reader = reader
+        self.writer = writer
+        self.encryptor = None
+        self.decryptor = None
+        self.response_started = False
+        self.buffer = b""
+
+    @classmethod
+    async def open(cls, host, inbound, target):
+
+        reader, writer = await asyncio.open_connection(host, inbound.port)
+        tunnel = cls(inbound, reader, writer)
+
+        if inbound.protocol == "vless":
+            # version 0, the uuid, no addons, command 1 (tcp), then the target
+            writer.write(b"\x00" + uuid.UUID(inbound.password).bytes + b"\x00\x01" + render_vless_address(target))
+        else:
+            salt = os.urandom(SHADOWSOCKS_AEAD_METHODS[inbound.method][0])
+            tunnel.encryptor = ShadowsocksAead(inbound.method, inbound.password, salt)
+            writer.write(salt + tunnel.encrypt_chunk(render_socks_address(target)))
+
+        return tunnel
+
+    def encrypt_chunk(self, data):
+        return self.encryptor.encrypt(struct.pack("!H", len(data))) + self.encryptor.encrypt(data)
+
+    async def send(self, data):
+
+        if self.encryptor is None:
+            self.writer.write(data)
+        else:
+            for offset in range(0, len(data), SHADOWSOCKS_MAX_CHUNK):
+                self.writer.write(self.encrypt_chunk(data[offset:offset + SHADOWSOCKS_MAX_CHUNK]))
+
+        await self.writer.drain()
+
+    async def receive(self, size):
+
+        if not self.response_started:
+            self.response_started = True
+
+            if self.encryptor is None:
+                version, addons_length = await self.reader.readexactly(2)
+                await self.reader.readexactly(addons_length)
+            else:
+                response_salt = await self.reader.readexactly(SHADOWSOCKS_AEAD_METHODS[self.inbound.method][0])
+                self.decryptor = ShadowsocksAead(self.inbound.method, self.inbound.password, response_salt)
+
+        if self.decryptor is None:
+            return await self.reader.readexactly(size)
+
+        while len(self.buffer) < size:
+            chunk_length = struct.unpack("!H", self.decryptor.decrypt(await self.reader.readexactly(2 + AEAD_TAG_LENGTH)))[0]
+            self.buffer += self.decryptor.decrypt(await self.reader.readexactly(chunk_length + AEAD_TAG_LENGTH))
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.writer.close()
+
+async def run_tcp_client(host, inbound, target, payload, deadline, timeout, stats):
+    """
+    Sends payload and waits for the echo, over and over, reconnecting after any error until deadline.
+    """
+
+    while time.monotonic() < deadline:
+        try:
+            tunnel = await asyncio.wait_for(TcpTunnel.open(host, inbound, target), timeout)
+        except Exception as e:
+            add_error(stats, e)
+            await asyncio.sleep(RECONNECT_DELAY)
+            continue
+
+        try:
+            while time.monotonic() < deadline:
+                started_at = time.perf_counter()
+
+                await tunnel.send(payload)
+                echoed = await asyncio.wait_for(tunnel.receive(len(payload)), timeout)
+
+                if echoed != payload:
+                    raise ValueError("echo doesn't match")
+
+                stats["latencies"].append(time.perf_counter() - started_at)
+                stats["requests"] += 1
+                stats["bytes"] += len(payload)
+        except Exception as e:
+            add_error(stats, e)
+            await asyncio.sleep(RECONNECT_DELAY)
+        finally:
+            tunnel.close()
+
+async def run_udp_client(host, inbound, target, payload, deadline, timeout, stats):
+    """
+    One datagram at a time, numbered so a late echo of an earlier one isn't taken for the current.
+    A datagram without an echo within timeout counts as lost.
+    """
+
+    loop = asyncio.get_running_loop()
+    replies = asyncio.Queue()
+
+    class ClientProtocol(asyncio.DatagramProtocol):
+
+        def datagram_received(self, data, addr):
+            replies.put_nowait(data)
+
+    transport, _ = await loop.create_datagram_endpoint(ClientProtocol, remote_addr=(host, inbound.port))
+
+    key_length = SHADOWSOCKS_AEAD_METHODS[inbound.method][0]
+    address = render_socks_address(target)
+    payload = payload[:UDP_MAX_PAYLOAD - 8]
+    sequence = 0
+
+    async def wait_for_echo(expected):
+        while True:
+            response = await replies.get()
+            data = ShadowsocksAead(inbound.method, inbound.password, response[:key_length]).decrypt(response[key_length:])
+
+            # the reply starts with the address it came from
+            if data.endswith(expected):
+                return
+
+    try:
+        while time.monotonic() < deadline:
+            sequence += 1
+            request = struct.pack("!Q", sequence) + payload
+            salt = os.urandom(key_length)
+
+            started_at = time.perf_counter()
+            transport.sendto(salt + ShadowsocksAead(inbound.method, inbound.password, salt).encrypt(address + request))
+
+            try:
+                await asyncio.wait_for(wait_for_echo(request), timeout)
+            except Exception as e:
+                add_error(stats, e)
+                continue
+
+            stats["latencies"].append(time.perf_counter() - started_at)
+            stats["requests"] += 1
+            stats["bytes"] += len(request)
+    finally:
+        transport.close()
+
+async def run_swarm(host, inbounds, target, options):
+    """
+    --clients clients per inbound and transport protocol, all at once. Returns {(tag, protocol): stats}.
+    """
+
+    deadline = time.monotonic() + options["duration"]
+    payload = os.urandom(options["payload_size"])
+
+    stats_by_inbound = {}
+    clients = []
+
+    for inbound in inbounds:
+        for protocol in inbound.transport_protocols:
+            stats = stats_by_inbound.setdefault((inbound.tag, protocol), new_stats())
+            run_client = run_tcp_client if protocol == "tcp" else run_udp_client
+
+            clients.extend(
+                run_client(host, inbound, target, payload, deadline, options["timeout"], stats)
+                for _ in range(options["clients"])
+            )
+
+    await asyncio.gather(*clients)
+
+    return stats_by_inbound
+
+def run_swarm_process(arguments):
+    return asyncio.run(run_swarm(*arguments))
+
+async def serve_sink(host, port, ready):
+    """
+    Echoes back whatever comes in - tcp streams and udp datagrams on the same port.
+    """
+
+    async def echo_stream(reader, writer):
+        try:
+            while data := await reader.read(65536):
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    class EchoProtocol(asyncio.DatagramProtocol):
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            self.transport.sendto(data, addr)
+
+    server = await asyncio.start_server(echo_stream, host=host, port=port)
+    await asyncio.get_running_loop().create_datagram_endpoint(EchoProtocol, local_addr=(host, port))
+
+    ready.set()
+
+    async with server:
+        await server.serve_forever()
+
+def run_sink_process(host, port, ready):
+    asyncio.run(serve_sink(host, port, ready))
+
+def read_generated_inbounds(tmpdir):
+    """
+    The inbounds of every shard config xray runs with.
+    """
+
+    shards_count = get_state_store(tmpdir).shards_count
+    inbounds = []
+
+    for shard in range(shards_count):
+        with open(f"{tmpdir}/{get_shard_config_filename(shards_count, shard)}") as f:
+            xray_config = json.load(f)
+
+        for inbound_object in xray_config["inbounds"]:
+            if inbound_object.get("protocol") in ("shadowsocks", "vless"):
+                inbounds.append(InboundRecord.from_inbound_object(inbound_object, shard=shard))
+
+    return inbounds
+
+def allow_private_addresses(tmpdir):
+    """
+    Drops the routing rule sending private addresses to the blackhole - the sink is one.
+    """
+
+    shards_count = get_state_store(tmpdir).shards_count
+
+    for shard in range(shards_count):
+        path = f"{tmpdir}/{get_shard_config_filename(shards_count, shard)}"
+
+        with open(path) as f:
+            xray_config = json.load(f)
+
+        routing = xray_config.get("routing", {})
+        routing["rules"] = [rule for rule in routing.get("rules", []) if "geoip:private" not in rule.get("ip", [])]
+
+        with open(path, "w") as f:
+            json.dump(xray_config, f, indent=4)
+
+async def wait_until_listening(host, inbounds, timeout):
+
+    deadline = time.monotonic() + timeout
+
+    for inbound in inbounds:
+        while True:
+            try:
+                _, writer = await asyncio.open_connection(host, inbound.port)
+                writer.close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    return False
+                await asyncio.sleep(0.2)
+
+    return True
+
+def load_test_inbounds(inbounds, args):
+
+    supported = [inbound for inbound in inbounds if inbound.protocol == "vless" or inbound.method in SHADOWSOCKS_AEAD_METHODS]
+    skipped = sorted({inbound.method for inbound in inbounds} - {inbound.method for inbound in supported})
+
+    if not supported:
+        return {"skipped_methods": skipped}
+
+    if not asyncio.run(wait_until_listening(args.host, supported, args.startup_timeout)):
+        raise RuntimeError(f"[-] The inbounds didn't start listening within {args.startup_timeout}s!")
+
+    options = {"clients": args.clients, "duration": args.duration, "payload_size": args.payload_size, "timeout": args.timeout}
+    processes_count = min(args.processes, len(supported))
+
+    # every process drives its own share of the inbounds with an event loop of its own
+    with multiprocessing.Pool(processes_count) as pool:
+        results = pool.map(run_swarm_process, [(args.host, supported[n::processes_count], args.sink, options) for n in range(processes_count)])
+
+    inbounds_by_tag = {inbound.tag: inbound for inbound in supported}
+    by_inbound = {}
+    by_cipher = {}
+
+    for stats_by_inbound in results:
+        for (tag, protocol), stats in stats_by_inbound.items():
+            by_inbound[f"{tag}/{protocol}"] = stats
+            merge_stats(by_cipher.setdefault(f"{inbounds_by_tag[tag].method}/{protocol}", new_stats()), stats)
+
+    return {
+        "clients_per_inbound": args.clients,
+        "payload_size": args.payload_size,
+        "duration_seconds": args.duration,
+        "skipped_methods": skipped,
+        "ciphers": {key: summarize_stats(stats, args.duration) for key, stats in sorted(by_cipher.items())},
+        "inbounds": {key: summarize_stats(stats, args.duration) for key, stats in sorted(by_inbound.items())}
+    }
+
+def measure_generated(config, instances_count, method, args):
+
+    config = dict(config)
+    config["docker_ports_publishing"] = "host"
+    config["xray_inbound_protocol"] = args.protocol
+    config["xray_vless_allow_cleartext"] = True
+    config["xray_inbound_multi_user"] = {}
+    config["xray_inbound_separated_instances"] = {"instances_count": instances_count}
+    config["xray_shadowsocks_inbound_method"] = method
+
+    if args.network:
+        config["xray_shadowsocks_inbound_network"] = args.network
+
+    tmpdir = generate_tmpdir()
+
+    try:
+        generate_xray_config(config=config, tmpdir=tmpdir)
+        generate_docker_compose(config=config, tmpdir=tmpdir)
+        allow_private_addresses(tmpdir)
+
+        subprocess.run(["docker", "compose", "-p", BENCH_COMPOSE_PROJECT_NAME, "up", "-d"], check=True, cwd=tmpdir, capture_output=True)
+
+        try:
+            result = load_test_inbounds(read_generated_inbounds(tmpdir), args)
+        finally:
+            subprocess.run(
+                ["docker", "compose", "-p", BENCH_COMPOSE_PROJECT_NAME, "down", "--remove-orphans"],
+                check=True, cwd=tmpdir, capture_output=True
+            )
+    finally:
+        remove_tmpdir(tmpdir)
+
+    return dict({"protocol": args.protocol, "method": method, "network": config["xray_shadowsocks_inbound_network"], "instances": instances_count}, **result)
+
+def run_load_tests(args):
+
+    if args.tmpdir:
+        return [load_test_inbounds(read_generated_inbounds(args.tmpdir), args)]
+
+    config = parse_config()
+    methods = ["none"] if args.protocol == "vless" else (args.methods or [config["xray_shadowsocks_inbound_method"]])
+
+    return [
+        measure_generated(config, instances_count, method, args)
+        for instances_count in args.instances
+        for method in methods
+    ]
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--instances", type=int, nargs="+", default=[10])
+    parser.add_argument("--protocol", default="shadowsocks", choices=["shadowsocks", "vless"])
+    parser.add_argument("--methods", nargs="+", help="default: the method from the settings, ignored for vless")
+    parser.add_argument("--network", help="e.g. tcp or udp,tcp, default: the network from the settings")
+    parser.add_argument("--tmpdir", help="load-test this running generated config instead of generating ones")
+    parser.add_argument("--clients", type=int, default=10, help="concurrent clients per inbound and transport protocol")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--payload-size", type=int, default=4096, help="bytes per request, udp is capped at 1200")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds before a request counts as failed")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="127.0.0.1", help="where the inbounds are reached")
+    parser.add_argument("--sink", default="127.0.0.1:18080", help="the echo sink, as xray-core sees it")
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--output", default="-", help="where to write the json results, - for stdout")
+    args = parser.parse_args()
+
+    if not SHADOWSOCKS_AEAD_METHODS:
+        sys.exit("[-] The load test needs the cryptography package!")
+
+    sink_host, sink_port = args.sink.rsplit(":", 1)
+
+    sink_ready = multiprocessing.Event()
+    sink = multiprocessing.Process(target=run_sink_process, args=(sink_host, int(sink_port), sink_ready), daemon=True)
+    sink.start()
+
+    if not sink_ready.wait(10):
+        sys.exit(f"[-] The sink didn't start on {args.sink}!")
+
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            results = run_load_tests(args)
+    finally:
+        sink.terminate()
+
+    output = json.dumps(results, indent=4)
+
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
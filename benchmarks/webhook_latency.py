@@ -0,0 +1,89 @@
+"""
+Replays recorded telegram updates against the local webhook endpoint of a running xray-cAD.
+
+Record real traffic first with "record_updates" in the "telegram_webhook" settings, then:
+
+    python benchmarks/webhook_latency.py updates.jsonl --url http://127.0.0.1:8443/telegram --secret-token ... --repeat 10
+
+Reports how fast updates are acknowledged (what telegram waits for) and, with --metrics-url,
+how long the handlers took end to end from the "telegram_update" operation metric.
+"""
+
+import argparse
+import json
+import statistics
+import time
+import urllib.request
+
+def post_update(url, secret_token, payload):
+
+    request = urllib.request.Request(url, data=payload, method="POST", headers={"Content-Type": "application/json"})
+
+    if secret_token:
+        request.add_header("X-Telegram-Bot-Api-Secret-Token", secret_token)
+
+    started_at = time.perf_counter()
+
+    with urllib.request.urlopen(request) as response:
+        response.read()
+
+    return time.perf_counter() - started_at
+
+def read_update_metric(metrics_url):
+    """
+    (count, sum of seconds) of the telegram_update operation.
+    """
+
+    with urllib.request.urlopen(metrics_url) as response:
+        lines = response.read().decode("utf-8").splitlines()
+
+    values = {}
+
+    for line in lines:
+        if 'operation="telegram_update"' in line:
+            name, value = line.rsplit(" ", 1)
+            values[name.split("{")[0]] = float(value)
+
+    return values.get("xray_cad_operation_seconds_count", 0), values.get("xray_cad_operation_seconds_sum", 0.0)
+
+def percentile(values, fraction):
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))]
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("updates", help="recorded updates, one JSON payload per line")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret-token", default="")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--metrics-url", help="e.g. http://127.0.0.1:9550/metrics")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds to let the handlers finish before reading the metrics")
+    args = parser.parse_args()
+
+    with open(args.updates, "rb") as f:
+        payloads = [line.strip() for line in f if line.strip()]
+
+    if args.metrics_url:
+        count_before, seconds_before = read_update_metric(args.metrics_url)
+
+    ack_seconds = [post_update(args.url, args.secret_token, payload) for _ in range(args.repeat) for payload in payloads]
+
+    results = {
+        "updates": len(ack_seconds),
+        "ack_mean_seconds": round(statistics.mean(ack_seconds), 6),
+        "ack_p50_seconds": round(percentile(ack_seconds, 0.5), 6),
+        "ack_p99_seconds": round(percentile(ack_seconds, 0.99), 6)
+    }
+
+    if args.metrics_url:
+        time.sleep(args.settle)
+        count_after, seconds_after = read_update_metric(args.metrics_url)
+
+        if count_after > count_before:
+            results["handled"] = int(count_after - count_before)
+            results["handler_mean_seconds"] = round((seconds_after - seconds_before) / (count_after - count_before), 6)
+
+    print(json.dumps(results, indent=4))
+
+if __name__ == "__main__":
+    main()
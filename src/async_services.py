@@ -0,0 +1,226 @@
+import asyncio
+import functools
+import subprocess
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import export
+import reconcile
+import services
+
+from metrics import metrics, timed
+
+# blocking file i/o and the xray api calls are pushed here, so the bot's event loop never waits on them
+BLOCKING_IO_WORKERS = 4
+
+_blocking_io_executor = ThreadPoolExecutor(max_workers=BLOCKING_IO_WORKERS, thread_name_prefix="xray-cAD-io")
+
+# docker compose operations on the same tmpdir must not overlap (e.g. two /restart at once)
+_compose_locks = {}
+
+def get_compose_lock(tmpdir):
+    if tmpdir not in _compose_locks:
+        _compose_locks[tmpdir] = asyncio.Lock()
+    return _compose_locks[tmpdir]
+
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_blocking_io_executor, functools.partial(func, *args, **kwargs))
+
+async def run_docker_compose_command(tmpdir, *args, progress=None):
+    """
+    Runs "docker compose <args>" as an asyncio subprocess.
+    Every output line is handed to the (async) progress callback while the command is running.
+    """
+
+    cmd = ["docker", "compose", *args]
+
+    with timed(f"compose_{args[0]}"):
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            cwd=tmpdir,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+
+        output = []
+
+        async for line in process.stdout:
+            line = line.decode(errors="replace").rstrip()
+            output.append(line)
+
+            if progress is not None and line:
+                await progress(line)
+
+        returncode = await process.wait()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, output="\n".join(output))
+
+async def stop_docker_compose_async(tmpdir, progress=None):
+    await run_docker_compose_command(tmpdir, "down", "--remove-orphans", progress=progress)
+
+async def recreate_docker_compose_async(tmpdir, services=(), progress=None):
+    await run_docker_compose_command(tmpdir, "up", "-d", "--force-recreate", *services, progress=progress)
+
+async def reconcile_docker_compose_async(tmpdir, progress=None):
+    """
+    reconcile.reconcile_docker_compose with the compose output streamed to progress.
+    Returns (services brought up, services restarted).
+    """
+
+    with timed("compose_reconcile"):
+        services_to_up, services_to_restart, has_orphans = await run_blocking(reconcile.plan_docker_compose_reconcile, tmpdir=tmpdir)
+
+        if services_to_up or has_orphans:
+            await run_docker_compose_command(tmpdir, "up", "-d", "--remove-orphans", *services_to_up, progress=progress)
+
+        if services_to_restart:
+            await run_docker_compose_command(tmpdir, "restart", *services_to_restart, progress=progress)
+
+        if services_to_up or services_to_restart:
+            await run_blocking(reconcile.record_applied_services, tmpdir=tmpdir, services=services_to_up + services_to_restart)
+
+    return services_to_up, services_to_restart
+
+async def restart_xray_core_async(config, tmpdir, progress=None):
+
+    async with get_compose_lock(tmpdir):
+        # the new state is swapped in at once, handlers running meanwhile keep reading the old one
+        await run_blocking(services.regenerate_xray_state, config=config, tmpdir=tmpdir)
+
+        # only what actually changed is recreated or restarted, no full down / up
+        await reconcile_docker_compose_async(tmpdir, progress=progress)
+
+async def change_xray_inbound_instances_async(config, tmpdir, refurbish_instance_nums=(), add_count=0, rebalance=True, keep_old_ports=False, progress=None, refurbish_instance_tags=()):
+    """
+    Adds and refurbishes instances (by number or by tag) in one go - everything is applied together, with at most one recreate per service.
+    Returns (added, refurbished, services that had to be recreated).
+    """
+
+    async with get_compose_lock(tmpdir):
+        added = await run_blocking(services.add_xray_inbound_instances, config=config, tmpdir=tmpdir, count=add_count) if add_count else []
+        refurbished = await run_blocking(services.refurbish_xray_inbound_instances, config=config, tmpdir=tmpdir, instance_nums=refurbish_instance_nums, rebalance=rebalance, keep_old_ports=keep_old_ports, instance_tags=refurbish_instance_tags) if refurbish_instance_nums or refurbish_instance_tags else []
+
+        services_to_recreate = await run_blocking(services.apply_xray_inbound_instances_live, config=config, tmpdir=tmpdir, refurbished=added + refurbished)
+
+        if services_to_recreate:
+            await recreate_docker_compose_async(tmpdir, services=services_to_recreate, progress=progress)
+            await run_blocking(reconcile.record_applied_services, tmpdir=tmpdir, services=services_to_recreate)
+
+        return added, refurbished, services_to_recreate
+
+async def refurbish_xray_inbound_instances_async(config, tmpdir, instance_nums=(), rebalance=True, keep_old_ports=False, progress=None, instance_tags=()):
+    """
+    Returns the services that had to be recreated - empty if everything was applied live through the xray api.
+    """
+
+    _, _, services_to_recreate = await change_xray_inbound_instances_async(config=config, tmpdir=tmpdir, refurbish_instance_nums=instance_nums, rebalance=rebalance, keep_old_ports=keep_old_ports, progress=progress, refurbish_instance_tags=instance_tags)
+
+    return services_to_recreate
+
+async def refurbish_xray_inbound_instance_async(config, tmpdir, instance_num, progress=None):
+    """
+    Returns True if the refurbished instance was applied live through the xray api.
+    """
+
+    return not await refurbish_xray_inbound_instances_async(config=config, tmpdir=tmpdir, instance_nums=[instance_num], progress=progress)
+
+async def restart_xray_shard_async(config, tmpdir, shard, progress=None):
+    """
+    Regenerates every instance of one shard. Without port rotation (the default) they are swapped
+    live through the xray api and nothing is recreated - otherwise, or when the api fails, only
+    that shard's container is. Returns the recreated services.
+    """
+
+    instance_nums = await run_blocking(services.list_xray_shard_instances, config=config, tmpdir=tmpdir, shard=shard)
+
+    # instances stay in their shard, so no other container is touched
+    return await refurbish_xray_inbound_instances_async(config=config, tmpdir=tmpdir, instance_nums=instance_nums, rebalance=False, progress=progress)
+
+async def set_xray_log_level_async(config, tmpdir, loglevel):
+    """
+    xray has no api for the log level, so the configs are rewritten and only the containers
+    are restarted - no regeneration, ports and passwords stay, but every connection drops.
+    Returns the restarted services.
+    """
+
+    async with get_compose_lock(tmpdir):
+        if not await run_blocking(services.set_xray_log_level, config=config, tmpdir=tmpdir, loglevel=loglevel):
+            return []
+
+        _, restarted = await reconcile_docker_compose_async(tmpdir)
+
+        return restarted
+
+async def get_xray_log_level_async(config, tmpdir):
+    return await run_blocking(services.get_xray_log_level, config=config, tmpdir=tmpdir)
+
+async def change_xray_users_async(config, tmpdir, add_count=0, refurbish_user_tags=(), revoke_user_tags=(), progress=None):
+    """
+    Adds, refurbishes and revokes users of multi-user listeners (addressed by tag) in one go.
+    Whatever the xray api can't apply is picked up by a config-only restart of its container.
+    Returns (added, refurbished, revoked, services that had to be restarted).
+    """
+
+    async with get_compose_lock(tmpdir):
+        refurbished = await run_blocking(services.refurbish_xray_users, config=config, tmpdir=tmpdir, user_tags=refurbish_user_tags) if refurbish_user_tags else []
+        revoked = await run_blocking(services.revoke_xray_users, config=config, tmpdir=tmpdir, user_tags=revoke_user_tags) if revoke_user_tags else []
+        added = await run_blocking(services.add_xray_users, config=config, tmpdir=tmpdir, count=add_count) if add_count else []
+
+        services_to_restart = await run_blocking(services.apply_xray_users_live, config=config, tmpdir=tmpdir, changes=refurbished + revoked + added)
+
+        # no port changed, the containers only have to re-read their configs
+        if services_to_restart:
+            await run_docker_compose_command(tmpdir, "restart", *services_to_restart, progress=progress)
+            await run_blocking(reconcile.record_applied_services, tmpdir=tmpdir, services=services_to_restart)
+
+        return added, refurbished, revoked, services_to_restart
+
+async def refurbish_xray_user_async(config, tmpdir, user_tag, progress=None):
+    """
+    Returns True if the user's new credential was applied live through the xray api.
+    """
+
+    _, _, _, services_to_restart = await change_xray_users_async(config=config, tmpdir=tmpdir, refurbish_user_tags=[user_tag], progress=progress)
+
+    return not services_to_restart
+
+async def list_xray_users_async(config, tmpdir):
+    return await run_blocking(services.list_xray_users, config=config, tmpdir=tmpdir)
+
+async def count_xray_listener_users_async(config, tmpdir):
+    return await run_blocking(services.count_xray_listener_users, config=config, tmpdir=tmpdir)
+
+async def get_xray_users_version_async(config, tmpdir):
+    return await run_blocking(services.get_xray_users_version, config=config, tmpdir=tmpdir)
+
+async def request_artifacts_for_xray_user_async(config, tmpdir, user_tag):
+    return await run_blocking(export.request_artifacts_for_xray_user, config=config, tmpdir=tmpdir, user_tag=user_tag)
+
+async def get_xray_shards_count_async(config, tmpdir):
+    return await run_blocking(services.get_xray_shards_count, config=config, tmpdir=tmpdir)
+
+async def list_xray_inbound_instances_async(config, tmpdir):
+    return await run_blocking(services.list_xray_inbound_instances, config=config, tmpdir=tmpdir)
+
+async def get_xray_inbound_instances_version_async(config, tmpdir):
+    return await run_blocking(services.get_xray_inbound_instances_version, config=config, tmpdir=tmpdir)
+
+async def request_artifacts_for_xray_inbound_instance_async(config, tmpdir, instance_num):
+    return await run_blocking(export.request_artifacts_for_xray_inbound_instance, config=config, tmpdir=tmpdir, instance_num=instance_num)
+
+async def export_xray_inbound_instances_async(config, tmpdir, tag_filter=""):
+    return await run_blocking(export.export_xray_inbound_instances, config=config, tmpdir=tmpdir, tag_filter=tag_filter)
+
+async def get_top_inbounds_async(config, tmpdir, count):
+    """
+    Busiest inbounds from the metrics poller, polled right away if the poller hasn't run yet.
+    """
+
+    if metrics.polled_at is None:
+        inbound_traffic, inbound_connections = await run_blocking(services.collect_xray_inbound_stats, config=config, tmpdir=tmpdir)
+        metrics.set_inbound_stats(inbound_traffic, inbound_connections, time.time())
+
+    return metrics.top_inbounds(count)
@@ -0,0 +1,127 @@
+"""
+Command line client for the xray-cAD control api (the "control" section of settings.json).
+Works whether the telegram bot runs or not. Run from the repository root:
+
+    python src/cli.py list
+    python src/cli.py get-config 0 shadowsocks-2
+    python src/cli.py refurbish shadowsocks-1 shadowsocks-7
+    python src/cli.py add 100
+    python src/cli.py restart [--shard 1]
+    python src/cli.py stats [N]
+    python src/cli.py loglevel [debug|info|warning|error|none]
+    python src/cli.py users
+    python src/cli.py user-config user-1 user-2
+    python src/cli.py add-users 100
+    python src/cli.py refurbish-users user-1
+    python src/cli.py revoke-users user-1 user-2
+    python src/cli.py batch requests.json    (- for stdin, see control.handle_batch)
+"""
+
+import argparse
+import http.client
+import json
+import socket
+import sys
+
+from control import get_control_socket
+from services import parse_config
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def request_control_api(socket_path, method, path, params=None):
+
+    connection = UnixHTTPConnection(socket_path)
+
+    try:
+        body = json.dumps(params).encode("utf-8") if params is not None else None
+        connection.request(method, path, body=body, headers={"Content-Type": "application/json"} if body else {})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+def split_instances(instances):
+    """
+    Numbers address instances by number, anything else by tag.
+    """
+
+    return {
+        "instances": [int(instance) for instance in instances if instance.isdigit()],
+        "tags": [instance for instance in instances if not instance.isdigit()]
+    }
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--socket", help="control api socket, by default the one from settings.json")
+
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("list")
+    commands.add_parser("get-config").add_argument("instances", nargs="+")
+
+    refurbish_parser = commands.add_parser("refurbish")
+    refurbish_parser.add_argument("instances", nargs="+")
+    refurbish_parser.add_argument("--no-rebalance", action="store_true", help="keep every instance in its shard")
+
+    commands.add_parser("add").add_argument("count", type=int)
+    commands.add_parser("restart").add_argument("--shard", type=int, help="restart only this shard (from 1, as in the bot)")
+    commands.add_parser("stats").add_argument("count", type=int, nargs="?", default=10)
+    commands.add_parser("loglevel").add_argument("level", nargs="?", help="switch to this level (restarts every xray-core container, all connections drop), by default the current one is shown")
+    commands.add_parser("users")
+    commands.add_parser("user-config").add_argument("tags", nargs="+")
+    commands.add_parser("add-users").add_argument("count", type=int)
+    commands.add_parser("refurbish-users").add_argument("tags", nargs="+")
+    commands.add_parser("revoke-users").add_argument("tags", nargs="+")
+    commands.add_parser("batch").add_argument("file", help="JSON with a \"requests\" list, - for stdin")
+
+    args = parser.parse_args()
+    socket_path = args.socket or get_control_socket(parse_config())
+
+    if args.command == "list":
+        request = ("GET", "/list", None)
+    elif args.command == "get-config":
+        request = ("POST", "/get-config", split_instances(args.instances))
+    elif args.command == "refurbish":
+        request = ("POST", "/refurbish", dict(split_instances(args.instances), rebalance=not args.no_rebalance))
+    elif args.command == "add":
+        request = ("POST", "/add", {"count": args.count})
+    elif args.command == "restart":
+        request = ("POST", "/restart", {"shard": args.shard})
+    elif args.command == "stats":
+        request = ("GET", f"/stats?count={args.count}", None)
+    elif args.command == "users":
+        request = ("GET", "/users", None)
+    elif args.command == "user-config":
+        request = ("POST", "/user-config", {"tags": args.tags})
+    elif args.command == "add-users":
+        request = ("POST", "/add-users", {"count": args.count})
+    elif args.command in ("refurbish-users", "revoke-users"):
+        request = ("POST", f"/{args.command}", {"tags": args.tags})
+    elif args.command == "loglevel":
+        request = ("POST", "/set-loglevel", {"level": args.level}) if args.level else ("GET", "/loglevel", None)
+    else:
+        with (sys.stdin if args.file == "-" else open(args.file)) as f:
+            request = ("POST", "/batch", json.load(f))
+
+    try:
+        status, result = request_control_api(socket_path, *request)
+    except OSError as e:
+        sys.exit(f"[-] Cannot reach the control api at {socket_path}: {e}")
+
+    print(json.dumps(result, indent=4, ensure_ascii=False))
+
+    if status != 200:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
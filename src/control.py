@@ -0,0 +1,331 @@
+import asyncio
+import json
+import os
+
+from async_services import (
+    run_blocking,
+    change_xray_inbound_instances_async,
+    restart_xray_core_async,
+    restart_xray_shard_async,
+    get_top_inbounds_async,
+    set_xray_log_level_async,
+    get_xray_log_level_async,
+    change_xray_users_async
+)
+from export import request_artifacts_for_xray_inbound_instance, request_artifacts_for_xray_user
+from http_server import HttpError, read_http_request, write_http_response
+from state import get_state_store
+from xray_api import XrayApiError
+
+CONTROL_DEFAULT_SOCKET = "/run/xray-cad/control.sock"
+
+# a batch may carry thousands of operations, but not an unbounded body
+CONTROL_MAX_BODY_SIZE = 16 * 1024 * 1024
+
+class ControlError(HttpError):
+    pass
+
+def get_control_settings(config):
+    return config.get("control") or {}
+
+def is_control_enabled(config):
+    return bool(get_control_settings(config).get("enabled", True))
+
+def get_control_socket(config):
+    return get_control_settings(config).get("socket", CONTROL_DEFAULT_SOCKET)
+
+def get_store_or_fail(tmpdir):
+
+    store = get_state_store(tmpdir)
+
+    if store is None:
+        raise ControlError(503, "Nothing is generated right now (a restart is running?)")
+
+    return store
+
+def fail_in_multi_user_mode(tmpdir):
+    """
+    A listener's port and server key are in every config of its users - listeners aren't refurbished,
+    and a new listener would have no users.
+    """
+
+    if get_store_or_fail(tmpdir).multi_user:
+        raise ControlError(409, "Listeners aren't refurbished or added in multi-user mode, use refurbish-users or add-users")
+
+def resolve_instance_nums(tmpdir, params):
+    """
+    Instances are addressed by number ("instances": [0, 1]) or by tag ("tags": ["shadowsocks-1"]).
+    """
+
+    store = get_store_or_fail(tmpdir)
+    instance_nums = [int(instance_num) for instance_num in params.get("instances", [])]
+
+    if params.get("tags"):
+        instance_nums_by_tag = {tag: instance_num for instance_num, tag in store.list_tags().items()}
+
+        for tag in params["tags"]:
+            if tag not in instance_nums_by_tag:
+                raise ControlError(404, f"There is no instance {tag}")
+            instance_nums.append(instance_nums_by_tag[tag])
+
+    for instance_num in instance_nums:
+        if not 0 <= instance_num < len(store.inbounds):
+            raise ControlError(404, f"There is no instance {instance_num}")
+
+    return instance_nums
+
+def render_instance(instance_num, inbound):
+    # shards are numbered from 1, the same as in the bot and the service names
+    return {"instance": instance_num, "tag": inbound.tag, "protocol": inbound.protocol, "port": inbound.port, "shard": inbound.shard + 1}
+
+def list_instances(config, tmpdir, params):
+
+    store = get_store_or_fail(tmpdir)
+
+    with store.lock:
+        return [render_instance(instance_num, inbound) for instance_num, inbound in enumerate(store.inbounds)]
+
+def get_instances_configs(config, tmpdir, params):
+
+    configs = []
+
+    for instance_num in resolve_instance_nums(tmpdir, params):
+        artifacts = request_artifacts_for_xray_inbound_instance(config=config, tmpdir=tmpdir, instance_num=instance_num)
+        configs.append({"instance": instance_num, "config": artifacts["config"], "uri": artifacts["uri"]})
+
+    return configs
+
+async def run_changes(config, tmpdir, refurbish_instance_nums, add_count, rebalance):
+
+    added, refurbished, services_to_recreate = await change_xray_inbound_instances_async(
+        config=config,
+        tmpdir=tmpdir,
+        refurbish_instance_nums=refurbish_instance_nums,
+        add_count=add_count,
+        rebalance=rebalance
+    )
+
+    return {
+        "added": [inbound.tag for _, inbound in added],
+        "refurbished": [inbound.tag for _, inbound in refurbished],
+        "recreated": services_to_recreate
+    }
+
+async def handle_list(config, tmpdir, params):
+    return await run_blocking(list_instances, config, tmpdir, params)
+
+async def handle_get_config(config, tmpdir, params):
+    return await run_blocking(get_instances_configs, config, tmpdir, params)
+
+async def handle_refurbish(config, tmpdir, params):
+    await run_blocking(fail_in_multi_user_mode, tmpdir)
+    instance_nums = await run_blocking(resolve_instance_nums, tmpdir, params)
+    return await run_changes(config, tmpdir, instance_nums, 0, params.get("rebalance", True))
+
+async def handle_add(config, tmpdir, params):
+    await run_blocking(fail_in_multi_user_mode, tmpdir)
+    return await run_changes(config, tmpdir, [], int(params.get("count", 1)), True)
+
+async def handle_restart(config, tmpdir, params):
+
+    if params.get("shard") is not None:
+        await run_blocking(fail_in_multi_user_mode, tmpdir)
+
+        shard = int(params["shard"])
+        shards_count = (await run_blocking(get_store_or_fail, tmpdir)).shards_count
+
+        if not 1 <= shard <= shards_count:
+            raise ControlError(404, f"There is no shard {shard}, shards: 1-{shards_count}")
+
+        return {"recreated": await restart_xray_shard_async(config=config, tmpdir=tmpdir, shard=shard - 1)} # because it's starts from zero
+
+    await restart_xray_core_async(config=config, tmpdir=tmpdir)
+    return {"restarted": True}
+
+async def handle_stats(config, tmpdir, params):
+    return await get_top_inbounds_async(config=config, tmpdir=tmpdir, count=int(params.get("count", 10)))
+
+def list_users(config, tmpdir, params):
+
+    store = get_store_or_fail(tmpdir)
+
+    if not store.multi_user:
+        raise ControlError(409, "Users only exist in multi-user mode")
+
+    with store.lock:
+        return [{"user": user.tag, "listener": user.inbound_tag} for user in store.users]
+
+def get_users_configs(config, tmpdir, params):
+
+    configs = []
+
+    for user_tag in params.get("tags", []):
+        artifacts = request_artifacts_for_xray_user(config=config, tmpdir=tmpdir, user_tag=user_tag)
+        configs.append({"user": user_tag, "config": artifacts["config"], "uri": artifacts["uri"]})
+
+    return configs
+
+async def handle_users(config, tmpdir, params):
+    return await run_blocking(list_users, config, tmpdir, params)
+
+async def handle_user_config(config, tmpdir, params):
+    return await run_blocking(get_users_configs, config, tmpdir, params)
+
+async def handle_change_users(config, tmpdir, add_count=0, refurbish_user_tags=(), revoke_user_tags=()):
+
+    added, refurbished, revoked, services_to_restart = await change_xray_users_async(
+        config=config,
+        tmpdir=tmpdir,
+        add_count=add_count,
+        refurbish_user_tags=refurbish_user_tags,
+        revoke_user_tags=revoke_user_tags
+    )
+
+    return {
+        "added": [user.tag for _, user in added],
+        "refurbished": [user.tag for _, user in refurbished],
+        "revoked": [user.tag for user, _ in revoked],
+        "restarted": services_to_restart
+    }
+
+async def handle_add_users(config, tmpdir, params):
+    return await handle_change_users(config, tmpdir, add_count=int(params.get("count", 1)))
+
+async def handle_refurbish_users(config, tmpdir, params):
+    return await handle_change_users(config, tmpdir, refurbish_user_tags=params.get("tags", []))
+
+async def handle_revoke_users(config, tmpdir, params):
+    return await handle_change_users(config, tmpdir, revoke_user_tags=params.get("tags", []))
+
+async def handle_loglevel(config, tmpdir, params):
+    return {"level": await get_xray_log_level_async(config=config, tmpdir=tmpdir)}
+
+async def handle_set_loglevel(config, tmpdir, params):
+    return {"level": params["level"], "restarted": await set_xray_log_level_async(config=config, tmpdir=tmpdir, loglevel=params["level"])}
+
+# op -> (handler, changes instances)
+CONTROL_OPERATIONS = {
+    "list": (handle_list, False),
+    "get-config": (handle_get_config, False),
+    "refurbish": (handle_refurbish, True),
+    "add": (handle_add, True),
+    "restart": (handle_restart, True),
+    "stats": (handle_stats, False),
+    "loglevel": (handle_loglevel, False),
+    "set-loglevel": (handle_set_loglevel, True),
+    "users": (handle_users, False),
+    "user-config": (handle_user_config, False),
+    "add-users": (handle_add_users, True),
+    "refurbish-users": (handle_refurbish_users, True),
+    "revoke-users": (handle_revoke_users, True)
+}
+
+# a batch merges instance changes only, these are applied on their own
+CONTROL_UNBATCHED_OPERATIONS = ("restart", "set-loglevel", "add-users", "refurbish-users", "revoke-users")
+
+async def handle_batch(config, tmpdir, params):
+    """
+    {"requests": [{"op": "refurbish", "tags": [...]}, {"op": "add", "count": 100}, {"op": "list"}, ...]}
+
+    Every refurbish and add of the batch is merged into a single change - one config write,
+    one apply - then the read operations run on the result, in request order.
+    A batch of read operations only changes nothing.
+    """
+
+    requests = params.get("requests", [])
+
+    refurbish_instance_nums = []
+    add_count = 0
+    rebalance = True
+
+    for request in requests:
+        if request.get("op") not in CONTROL_OPERATIONS or request["op"] in CONTROL_UNBATCHED_OPERATIONS:
+            raise ControlError(400, f"Operation {request.get('op')} can't be batched")
+
+        if request["op"] == "refurbish":
+            await run_blocking(fail_in_multi_user_mode, tmpdir)
+            refurbish_instance_nums.extend(await run_blocking(resolve_instance_nums, tmpdir, request))
+            rebalance = rebalance and request.get("rebalance", True)
+
+        if request["op"] == "add":
+            await run_blocking(fail_in_multi_user_mode, tmpdir)
+            add_count += int(request.get("count", 1))
+
+    # the same instance twice in one batch is refurbished once
+    refurbish_instance_nums = list(dict.fromkeys(refurbish_instance_nums))
+
+    if refurbish_instance_nums or add_count:
+        changes = await run_changes(config, tmpdir, refurbish_instance_nums, add_count, rebalance)
+    else:
+        changes = {"added": [], "refurbished": [], "recreated": []}
+
+    results = []
+
+    for request in requests:
+        handler, changes_instances = CONTROL_OPERATIONS[request["op"]]
+        results.append({"ok": True} if changes_instances else await handler(config, tmpdir, request))
+
+    return dict(changes, results=results)
+
+async def dispatch_control_request(config, tmpdir, method, path, params):
+
+    op = path.strip("/")
+
+    if op == "batch":
+        handler, changes_instances = handle_batch, True
+    elif op in CONTROL_OPERATIONS:
+        handler, changes_instances = CONTROL_OPERATIONS[op]
+    else:
+        raise ControlError(404, f"Unknown operation {op}")
+
+    if changes_instances and method != "POST":
+        raise ControlError(405, f"{op} changes instances, use POST")
+
+    return await handler(config, tmpdir, params)
+
+async def start_control_server(config, tmpdir):
+    """
+    Serves the control api - small JSON over HTTP/1.1 - on a unix socket only root can reach.
+    GET /list, GET /get-config?instances=0, GET /stats?count=10, GET /loglevel, GET /users, GET /user-config?tags=user-1,
+    POST /refurbish, /add, /restart, /set-loglevel, /add-users, /refurbish-users, /revoke-users, /batch
+    with a JSON body. One request per connection.
+    """
+
+    socket_path = get_control_socket(config)
+
+    async def handle_connection(reader, writer):
+
+        try:
+            method, path, params, headers, body = await read_http_request(reader, CONTROL_MAX_BODY_SIZE)
+
+            # list style query parameters: ?instances=1,2,3
+            for key in ("instances", "tags"):
+                if key in params:
+                    params[key] = params[key].split(",")
+
+            if body:
+                params.update(json.loads(body))
+
+            status, result = 200, await dispatch_control_request(config, tmpdir, method, path, params)
+        except HttpError as e:
+            status, result = e.status, {"error": str(e)}
+        except (ValueError, KeyError, TypeError) as e:
+            status, result = 400, {"error": f"{type(e).__name__}: {e}"}
+        except XrayApiError as e:
+            status, result = 503, {"error": str(e)}
+        except Exception as e:
+            print(f"[-] control: request failed: {e}")
+            status, result = 500, {"error": f"{type(e).__name__}: {e}"}
+
+        await write_http_response(writer, status, (json.dumps(result, ensure_ascii=False) + "\n").encode("utf-8"))
+
+    os.makedirs(os.path.dirname(socket_path), mode=0o700, exist_ok=True)
+
+    # left over from a previous run that didn't get to clean up
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    server = await asyncio.start_unix_server(handle_connection, path=socket_path)
+    os.chmod(socket_path, 0o600)
+
+    return server
@@ -0,0 +1,66 @@
+import asyncio
+
+from async_services import run_blocking
+from control import get_control_socket, is_control_enabled, start_control_server
+from health import HealthProber, is_health_enabled
+from metrics import metrics
+from rotation import RotationScheduler, is_rotation_enabled
+from services import get_xray_shards_count
+from shards import get_shard_service_name
+from xray_logs import AccessLogTailer, LOG_TAILER_DEFAULT_INTERVAL, get_xray_log_settings, is_access_log_tailer_enabled
+
+async def run_access_log_tailer(config, tmpdir):
+    """
+    Feeds the accepted / rejected counts of the access logs into the metrics - accepted per instance, rejected per shard.
+    """
+
+    tailer = AccessLogTailer(config)
+    interval = get_xray_log_settings(config).get("tail_interval", LOG_TAILER_DEFAULT_INTERVAL)
+
+    while True:
+        try:
+            shards_count = await run_blocking(get_xray_shards_count, config=config, tmpdir=tmpdir)
+
+            if shards_count is not None:
+                await run_blocking(tailer.poll, [get_shard_service_name(shards_count, shard) for shard in range(shards_count)])
+                metrics.set_access_log_counts(tailer.counts, tailer.service_counts)
+        except Exception as e:
+            print(f"[-] xray log: cannot tail the access log: {e}")
+
+        await asyncio.sleep(interval)
+
+async def start_background_tasks(config, tmpdir, notify=None):
+    """
+    Starts whatever runs next to the bot in its event loop - rotation, health checks, the access log tailer, the control api.
+    Returns the started tasks and servers, they have to be referenced for as long as they run.
+    """
+
+    started = {}
+
+    if is_rotation_enabled(config):
+        started["rotation"] = asyncio.create_task(RotationScheduler(config=config, tmpdir=tmpdir, notify=notify).run())
+
+    if is_health_enabled(config):
+        started["health"] = asyncio.create_task(HealthProber(config=config, tmpdir=tmpdir, notify=notify).run())
+
+    if is_access_log_tailer_enabled(config):
+        started["access_log"] = asyncio.create_task(run_access_log_tailer(config, tmpdir))
+
+    if is_control_enabled(config):
+        started["control"] = await start_control_server(config, tmpdir)
+        print(f"control api: listening on {get_control_socket(config)}")
+
+    return started
+
+async def run_headless(config, tmpdir):
+    """
+    Everything but the telegram bot, until the process is stopped.
+    """
+
+    started = await start_background_tasks(config, tmpdir)
+
+    if not started:
+        print("[-] Neither the telegram bot nor the control api is enabled, there is nothing to serve.")
+        return
+
+    await asyncio.Event().wait()
@@ -0,0 +1,114 @@
+import io
+import json
+import threading
+import zipfile
+
+try:
+    import qrcode
+except ImportError:
+    qrcode = None
+
+from protocols import get_inbound_engine
+from services import get_server_public_ip, render_inbound_client_config
+from state import get_state_store
+
+# tag -> (inbound record, user record, server ip, artifacts); a refurbish replaces the record, which invalidates the entry.
+# In multi-user mode the tags are the users' ("user-1"), the inbound is kept too - its port and server key are in the config
+_rendered_artifacts = {}
+_rendered_artifacts_lock = threading.Lock()
+
+def render_qr_png(text):
+
+    # qrcode is optional - without it the export simply has no pictures
+    if qrcode is None:
+        return None
+
+    qr_png = io.BytesIO()
+    qrcode.make(text).save(qr_png)
+
+    return qr_png.getvalue()
+
+def render_inbound_artifacts(inbound, server_public_ip, user=None):
+    """
+    Client config, share uri (ss:// or vless://) and QR code of one inbound (or of one user of a multi-user listener),
+    memoized until the inbound or the user is refurbished.
+    """
+
+    tag = user.tag if user is not None else inbound.tag
+
+    with _rendered_artifacts_lock:
+        cached = _rendered_artifacts.get(tag)
+
+    if cached is not None and cached[0] is inbound and cached[1] is user and cached[2] == server_public_ip:
+        return cached[3]
+
+    uri = get_inbound_engine(inbound).render_uri(inbound, server_public_ip, user=user)
+
+    artifacts = {
+        "config": render_inbound_client_config(inbound, server_public_ip, user=user),
+        "uri": uri,
+        "qr_png": render_qr_png(uri)
+    }
+
+    with _rendered_artifacts_lock:
+        _rendered_artifacts[tag] = (inbound, user, server_public_ip, artifacts)
+
+    return artifacts
+
+def request_artifacts_for_xray_inbound_instance(config, tmpdir, instance_num):
+
+    store = get_state_store(tmpdir)
+
+    if store is not None:
+        return render_inbound_artifacts(store.get(instance_num), get_server_public_ip(config))
+
+def request_artifacts_for_xray_user(config, tmpdir, user_tag):
+
+    store = get_state_store(tmpdir)
+
+    if store is not None:
+        with store.lock:
+            user = store.get_user(store.find_user_nums([user_tag])[0])
+            inbound = store.get_inbound_by_tag(user.inbound_tag)
+
+        return render_inbound_artifacts(inbound, get_server_public_ip(config), user=user)
+
+def export_xray_inbound_instances(config, tmpdir, tag_filter=""):
+    """
+    Renders every inbound whose tag contains tag_filter in one pass - every user, in multi-user mode.
+    Returns (zip archive bytes, [(tag, uri), ...]); the public ip is resolved once for the whole batch.
+    """
+
+    store = get_state_store(tmpdir)
+
+    if store is None:
+        return None, []
+
+    server_public_ip = get_server_public_ip(config)
+
+    with store.lock:
+        if store.multi_user:
+            inbounds_by_tag = {inbound.tag: inbound for inbound in store.inbounds}
+            exported = [(inbounds_by_tag[user.inbound_tag], user) for user in store.users if tag_filter in user.tag]
+        else:
+            exported = [(inbound, None) for inbound in store.inbounds if tag_filter in inbound.tag]
+
+    uris = []
+    archive = io.BytesIO()
+
+    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+        for inbound, user in exported:
+            tag = user.tag if user is not None else inbound.tag
+
+            artifacts = render_inbound_artifacts(inbound, server_public_ip, user=user)
+            uris.append((tag, artifacts["uri"]))
+
+            zip_file.writestr(f"{tag}/config.json", json.dumps(artifacts["config"], indent=4, ensure_ascii=False) + "\n")
+            zip_file.writestr(f"{tag}/uri.txt", artifacts["uri"] + "\n")
+
+            if artifacts["qr_png"] is not None:
+                zip_file.writestr(f"{tag}/qr.png", artifacts["qr_png"])
+
+        zip_file.writestr("uris.txt", "".join(f"{uri}\n" for tag, uri in uris))
+
+    return archive.getvalue(), uris
@@ -0,0 +1,356 @@
+import asyncio
+import hashlib
+import ipaddress
+import os
+import struct
+import time
+import uuid
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+    from cryptography.hazmat.primitives.hashes import SHA1
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+except ImportError:
+    AESGCM = None
+
+from async_services import run_blocking, refurbish_xray_inbound_instances_async
+from metrics import metrics
+from protocols import is_multi_user_enabled
+from state import get_state_store
+
+HEALTH_DEFAULT_INTERVAL = 300
+HEALTH_DEFAULT_CONCURRENCY = 200
+HEALTH_DEFAULT_TIMEOUT = 3.0
+HEALTH_DEFAULT_HOST = "127.0.0.1"
+HEALTH_DEFAULT_PROBE_TARGET = "1.1.1.1:53"
+HEALTH_DEFAULT_FAILURES_BEFORE_REFURBISH = 2
+
+# with more instances failing than this it's the host, the outbound or a whole container - refurbishing won't help
+HEALTH_DEFAULT_MAX_FAILED_RATIO = 0.5
+
+# a dns query for example.com - goes through the inbound to the probe target and has to come back
+DNS_PROBE_QUERY = struct.pack("!HHHHHH", 0x7863, 0x0100, 1, 0, 0, 0) + b"\x07example\x03com\x00" + struct.pack("!HH", 1, 1)
+
+AEAD_TAG_LENGTH = 16
+
+# cryptography is optional - without it tcp ports are only checked for accepting connections and udp is skipped
+if AESGCM is not None:
+    SHADOWSOCKS_AEAD_METHODS = {
+        "aes-128-gcm": (16, AESGCM),
+        "aes-256-gcm": (32, AESGCM),
+        "chacha20-poly1305": (32, ChaCha20Poly1305),
+        "chacha20-ietf-poly1305": (32, ChaCha20Poly1305)
+    }
+else:
+    SHADOWSOCKS_AEAD_METHODS = {}
+
+def get_health_settings(config):
+    return config.get("health") or {}
+
+def is_health_enabled(config):
+    return bool(get_health_settings(config).get("enabled", False))
+
+def derive_shadowsocks_key(password, key_length):
+    """
+    EVP_BytesToKey with md5, as every shadowsocks implementation does for the non-2022 methods.
+    """
+
+    key = b""
+    previous = b""
+
+    while len(key) < key_length:
+        previous = hashlib.md5(previous + password.encode("utf-8")).digest()
+        key += previous
+
+    return key[:key_length]
+
+class ShadowsocksAead:
+    """
+    One direction of a shadowsocks AEAD stream (https://shadowsocks.org/doc/aead.html):
+    a per-salt subkey and a little endian nonce counter, bumped after every chunk.
+    """
+
+    def __init__(self, method, password, salt):
+        key_length, aead = SHADOWSOCKS_AEAD_METHODS[method]
+
+        subkey = HKDF(algorithm=SHA1(), length=key_length, salt=salt, info=b"ss-subkey").derive(derive_shadowsocks_key(password, key_length))
+
+        self.aead = aead(subkey)
+        self.nonce = 0
+
+    def _next_nonce(self):
+        nonce = self.nonce.to_bytes(12, "little")
+        self.nonce += 1
+        return nonce
+
+    def encrypt(self, data):
+        return self.aead.encrypt(self._next_nonce(), data, None)
+
+    def decrypt(self, data):
+        return self.aead.decrypt(self._next_nonce(), data, None)
+
+def render_socks_address(target):
+
+    host, port = target.rsplit(":", 1)
+
+    try:
+        address = ipaddress.ip_address(host)
+        address_type = 1 if address.version == 4 else 4
+        return bytes([address_type]) + address.packed + struct.pack("!H", int(port))
+    except ValueError:
+        return bytes([3, len(host)]) + host.encode("ascii") + struct.pack("!H", int(port))
+
+def render_vless_address(target):
+    """
+    Same idea as socks, other type numbers: 1 - ipv4, 2 - domain, 3 - ipv6, and the port goes first.
+    """
+
+    host, port = target.rsplit(":", 1)
+
+    try:
+        address = ipaddress.ip_address(host)
+        return struct.pack("!H", int(port)) + bytes([1 if address.version == 4 else 3]) + address.packed
+    except ValueError:
+        return struct.pack("!H", int(port)) + bytes([2, len(host)]) + host.encode("ascii")
+
+async def probe_vless_tcp(reader, writer, inbound, target):
+
+    # version 0, the user's uuid, no addons, command 1 (tcp), then the target - the payload follows right away
+    request = b"\x00" + uuid.UUID(inbound.password).bytes + b"\x00\x01" + render_vless_address(target)
+
+    writer.write(request + struct.pack("!H", len(DNS_PROBE_QUERY)) + DNS_PROBE_QUERY)
+    await writer.drain()
+
+    # an unknown uuid gets the connection closed - the reply header (version, addons) is the handshake
+    version, addons_length = await reader.readexactly(2)
+    await reader.readexactly(addons_length)
+
+    response_length = struct.unpack("!H", await reader.readexactly(2))[0]
+    await reader.readexactly(response_length)
+
+async def probe_tcp(host, inbound, target):
+
+    reader, writer = await asyncio.open_connection(host, inbound.port)
+
+    try:
+        if inbound.protocol == "vless":
+            await probe_vless_tcp(reader, writer, inbound, target)
+            return
+
+        # shadowsocks-2022 needs blake3, which isn't around - accepting the connection has to do
+        if inbound.method not in SHADOWSOCKS_AEAD_METHODS:
+            return
+
+        key_length = SHADOWSOCKS_AEAD_METHODS[inbound.method][0]
+
+        salt = os.urandom(key_length)
+        cipher = ShadowsocksAead(inbound.method, inbound.password, salt)
+
+        # dns over tcp carries a length prefix of its own
+        payload = render_socks_address(target) + struct.pack("!H", len(DNS_PROBE_QUERY)) + DNS_PROBE_QUERY
+
+        writer.write(salt + cipher.encrypt(struct.pack("!H", len(payload))) + cipher.encrypt(payload))
+        await writer.drain()
+
+        # a reply that decrypts with our key is the handshake - a wrong password just gets the connection drained
+        response_salt = await reader.readexactly(key_length)
+        response_cipher = ShadowsocksAead(inbound.method, inbound.password, response_salt)
+
+        response_length = struct.unpack("!H", response_cipher.decrypt(await reader.readexactly(2 + AEAD_TAG_LENGTH)))[0]
+        response_cipher.decrypt(await reader.readexactly(response_length + AEAD_TAG_LENGTH))
+    finally:
+        writer.close()
+
+async def probe_udp(host, inbound, target):
+
+    loop = asyncio.get_running_loop()
+    received = loop.create_future()
+
+    class ProbeProtocol(asyncio.DatagramProtocol):
+
+        def datagram_received(self, data, addr):
+            if not received.done():
+                received.set_result(data)
+
+        def error_received(self, exc):
+            if not received.done():
+                received.set_exception(exc)
+
+    transport, _ = await loop.create_datagram_endpoint(ProbeProtocol, remote_addr=(host, inbound.port))
+
+    try:
+        key_length = SHADOWSOCKS_AEAD_METHODS[inbound.method][0]
+
+        salt = os.urandom(key_length)
+        transport.sendto(salt + ShadowsocksAead(inbound.method, inbound.password, salt).encrypt(render_socks_address(target) + DNS_PROBE_QUERY))
+
+        response = await received
+        ShadowsocksAead(inbound.method, inbound.password, response[:key_length]).decrypt(response[key_length:])
+    finally:
+        transport.close()
+
+def describe_probe_error(e):
+
+    if isinstance(e, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(e, ConnectionRefusedError):
+        return "connection refused"
+    if isinstance(e, asyncio.IncompleteReadError):
+        return "closed without a reply"
+    if AESGCM is not None and isinstance(e, InvalidTag):
+        return "reply doesn't decrypt"
+
+    return f"{type(e).__name__}: {e}"
+
+async def probe_inbound(host, inbound, target, timeout):
+    """
+    Returns {transport protocol: None if healthy, else what went wrong}. Unprobeable udp is left out.
+    """
+
+    errors = {}
+
+    for protocol in inbound.transport_protocols:
+        if protocol == "udp" and inbound.method not in SHADOWSOCKS_AEAD_METHODS:
+            continue
+
+        try:
+            await asyncio.wait_for((probe_tcp if protocol == "tcp" else probe_udp)(host, inbound, target), timeout)
+            errors[protocol] = None
+        except Exception as e:
+            errors[protocol] = describe_probe_error(e)
+
+    return errors
+
+async def sweep_inbounds(config, tmpdir):
+    """
+    Probes every inbound of every shard, at most "concurrency" at a time.
+    Returns [(instance_num, inbound record, {protocol: error or None}), ...].
+    """
+
+    health_settings = get_health_settings(config)
+
+    host = health_settings.get("host", HEALTH_DEFAULT_HOST)
+    target = health_settings.get("probe_target", HEALTH_DEFAULT_PROBE_TARGET)
+    timeout = health_settings.get("timeout", HEALTH_DEFAULT_TIMEOUT)
+    semaphore = asyncio.Semaphore(health_settings.get("concurrency", HEALTH_DEFAULT_CONCURRENCY))
+
+    store = await run_blocking(get_state_store, tmpdir)
+
+    if store is None:
+        return []
+
+    with store.lock:
+        inbounds = list(enumerate(store.inbounds))
+
+    async def probe(instance_num, inbound):
+        async with semaphore:
+            return instance_num, inbound, await probe_inbound(host, inbound, target, timeout)
+
+    started_at = time.perf_counter()
+    results = await asyncio.gather(*(probe(instance_num, inbound) for instance_num, inbound in inbounds))
+    metrics.observe("health_sweep", time.perf_counter() - started_at)
+
+    return results
+
+def render_health_report(report):
+
+    report_str = f"Health check: {report['checked'] - len(report['failed'])}/{report['checked']} inbound instances healthy ({report['seconds']:.1f}s).\n"
+
+    for tag, errors in report["failed"]:
+        errors_str = ", ".join(f"{protocol}: {error}" for protocol, error in errors.items() if error is not None)
+        report_str = report_str + f"{tag} - {errors_str}\n"
+
+    if report["systemic"]:
+        report_str = report_str + "\nToo many instances fail at once, looks like the host, the outbound or a container - nothing was refurbished.\n"
+    elif report["multi_user"]:
+        report_str = report_str + "\nListeners are never refurbished in multi-user mode, their port and server key are in every config of their users - nothing was changed.\n"
+    elif report["refurbished"]:
+        report_str = report_str + f"\nRefurbished on new ports: {', '.join(report['refurbished'])}. Request new configs with /gc.\n"
+
+    return report_str
+
+class HealthProber:
+    """
+    Sweeps all inbounds every "interval" seconds. An instance failing "failures_before_refurbish"
+    sweeps in a row is refurbished on a fresh port (its old port is kept out of the allocator),
+    unless so many fail that the cause can't be the instances themselves.
+
+    In multi-user mode a listener's port and server key are in every config of its users, so failures are
+    only reported. New user credentials wouldn't help either, the probe uses the listener's own one.
+    """
+
+    def __init__(self, config, tmpdir, notify=None):
+        health_settings = get_health_settings(config)
+
+        self.config = config
+        self.tmpdir = tmpdir
+        self.notify = notify
+
+        self.interval = health_settings.get("interval", HEALTH_DEFAULT_INTERVAL)
+        self.auto_refurbish = health_settings.get("auto_refurbish", True)
+        self.failures_before_refurbish = health_settings.get("failures_before_refurbish", HEALTH_DEFAULT_FAILURES_BEFORE_REFURBISH)
+        self.max_failed_ratio = health_settings.get("max_failed_ratio", HEALTH_DEFAULT_MAX_FAILED_RATIO)
+        self.multi_user = is_multi_user_enabled(config)
+
+        # instance_num -> (inbound record, failed sweeps in a row); a refurbished record starts over
+        self.failures = {}
+
+    async def check(self):
+        started_at = time.perf_counter()
+        results = await sweep_inbounds(self.config, self.tmpdir)
+
+        failed = []
+        to_refurbish = []
+
+        for instance_num, inbound, errors in results:
+            if not any(error is not None for error in errors.values()):
+                self.failures.pop(instance_num, None)
+                continue
+
+            failed.append((inbound.tag, errors))
+
+            previous_inbound, failures_count = self.failures.get(instance_num, (None, 0))
+            failures_count = failures_count + 1 if previous_inbound is inbound else 1
+            self.failures[instance_num] = (inbound, failures_count)
+
+            if failures_count >= self.failures_before_refurbish:
+                to_refurbish.append((instance_num, inbound))
+
+        systemic = bool(results) and len(failed) / len(results) > self.max_failed_ratio
+        refurbished = []
+
+        if self.auto_refurbish and to_refurbish and not systemic and not self.multi_user:
+            # the same port would fail again - whatever holds it isn't ours
+            await refurbish_xray_inbound_instances_async(
+                config=dict(self.config, xray_refurbish_rotate_port=True),
+                tmpdir=self.tmpdir,
+                instance_nums=[instance_num for instance_num, _ in to_refurbish],
+                rebalance=False,
+                keep_old_ports=True
+            )
+
+            for instance_num, inbound in to_refurbish:
+                self.failures.pop(instance_num, None)
+                refurbished.append(inbound.tag)
+
+        return {
+            "checked": len(results),
+            "failed": failed,
+            "refurbished": refurbished,
+            "systemic": systemic,
+            "multi_user": self.multi_user,
+            "seconds": time.perf_counter() - started_at
+        }
+
+    async def run(self):
+        while True:
+            try:
+                report = await self.check()
+
+                if self.notify is not None and report["failed"]:
+                    await self.notify(render_health_report(report))
+            except Exception as e:
+                print(f"[-] health: cannot check inbound instances: {e}")
+
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,60 @@
+from urllib.parse import parse_qsl
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    409: "Conflict",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable"
+}
+
+class HttpError(ValueError):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+async def read_http_request(reader, max_body_size):
+    """
+    Just enough HTTP/1.1 for the local endpoints (control api, telegram webhook): one request per connection.
+    Returns (method, path, query params, headers with lowercase names, body bytes).
+    """
+
+    try:
+        method, target, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HttpError(400, "Malformed request line")
+
+    headers = {}
+
+    while (line := (await reader.readline()).decode("latin-1").strip()):
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    content_length = int(headers.get("content-length", 0))
+
+    if content_length > max_body_size:
+        raise HttpError(413, "Request body is too large")
+
+    path, _, query = target.partition("?")
+    body = await reader.readexactly(content_length) if content_length else b""
+
+    return method, path, dict(parse_qsl(query)), headers, body
+
+async def write_http_response(writer, status, body, content_type="application/json"):
+
+    writer.write(
+        f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1")
+        + body
+    )
+
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass # the client is gone, nothing to tell it anymore
+    finally:
+        writer.close()
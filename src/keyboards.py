@@ -0,0 +1,108 @@
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from collections import OrderedDict
+
+from async_services import (
+    list_xray_inbound_instances_async,
+    get_xray_inbound_instances_version_async,
+    list_xray_users_async,
+    get_xray_users_version_async
+)
+
+KEYBOARD_COLUMNS = 3
+KEYBOARD_ROWS = 8
+KEYBOARD_PAGE_SIZE = KEYBOARD_COLUMNS * KEYBOARD_ROWS
+
+# telegram allows 64 bytes of callback data, the filter travels inside it
+KEYBOARD_FILTER_MAX_LENGTH = 32
+
+KEYBOARD_CACHE_SIZE = 256
+
+# /gc and /rc keyboards differ only in what a button does
+KEYBOARD_ACTIONS = {
+    "gc": "getconfigforinboundnum",
+    "rc": "refurbishinboundnum",
+    "gcu": "getconfigforuser",
+    "rcu": "refurbishuser",
+    "ru": "revokeuser"
+}
+
+# these list the users of multi-user listeners instead of the inbound instances.
+# Their buttons carry the user's tag, a revoke shifts the numbers of everyone behind
+USER_KEYBOARD_ACTIONS = ("gcu", "rcu", "ru")
+
+_keyboard_pages = OrderedDict()
+_filtered_inbounds = OrderedDict()
+
+def _cache_put(cache, key, value):
+    cache[key] = value
+    cache.move_to_end(key)
+
+    while len(cache) > KEYBOARD_CACHE_SIZE:
+        cache.popitem(last=False)
+
+def render_inbounds_keyboard_page(action, tag_filter, page, pages_count, page_inbounds):
+
+    keyboard = [
+        [
+            InlineKeyboardButton(text=tag, callback_data=f"{KEYBOARD_ACTIONS[action]}:{tag if action in USER_KEYBOARD_ACTIONS else num}")
+            for num, tag in page_inbounds[row_start:row_start + KEYBOARD_COLUMNS]
+        ]
+        for row_start in range(0, len(page_inbounds), KEYBOARD_COLUMNS)
+    ]
+
+    if pages_count > 1:
+        navigation_row = []
+
+        if page > 0:
+            navigation_row.append(InlineKeyboardButton(text="« prev", callback_data=f"inboundspage:{action}:{page - 1}:{tag_filter}"))
+
+        navigation_row.append(InlineKeyboardButton(text=f"{page + 1}/{pages_count}", callback_data=f"inboundspage:{action}:{page}:{tag_filter}"))
+
+        if page < pages_count - 1:
+            navigation_row.append(InlineKeyboardButton(text="next »", callback_data=f"inboundspage:{action}:{page + 1}:{tag_filter}"))
+
+        keyboard.append(navigation_row)
+
+    return InlineKeyboardMarkup(keyboard)
+
+async def get_inbounds_keyboard_page(config, tmpdir, action, page=0, tag_filter=""):
+    """
+    Returns (reply_markup, page, pages_count, matches_count) for one page of the /gc or /rc keyboard.
+    Pages are cached until the set of inbound tags (or the users) changes.
+    """
+
+    tag_filter = tag_filter.encode("utf-8")[:KEYBOARD_FILTER_MAX_LENGTH].decode("utf-8", errors="ignore")
+    lists_users = action in USER_KEYBOARD_ACTIONS
+
+    if lists_users:
+        version = await get_xray_users_version_async(config=config, tmpdir=tmpdir)
+    else:
+        version = await get_xray_inbound_instances_version_async(config=config, tmpdir=tmpdir)
+
+    filtered_key = (lists_users, version, tag_filter)
+
+    if filtered_key in _filtered_inbounds:
+        _filtered_inbounds.move_to_end(filtered_key)
+        filtered_inbounds = _filtered_inbounds[filtered_key]
+    else:
+        if lists_users:
+            xray_inbound_intances = await list_xray_users_async(config=config, tmpdir=tmpdir) or {}
+        else:
+            xray_inbound_intances = await list_xray_inbound_instances_async(config=config, tmpdir=tmpdir) or {}
+
+        filtered_inbounds = [(num, tag) for num, tag in xray_inbound_intances.items() if tag_filter in tag]
+        _cache_put(_filtered_inbounds, filtered_key, filtered_inbounds)
+
+    pages_count = max(1, -(-len(filtered_inbounds) // KEYBOARD_PAGE_SIZE))
+    page = min(max(page, 0), pages_count - 1)
+
+    page_key = (version, action, tag_filter, page)
+
+    if page_key in _keyboard_pages:
+        _keyboard_pages.move_to_end(page_key)
+    else:
+        page_inbounds = filtered_inbounds[page * KEYBOARD_PAGE_SIZE:(page + 1) * KEYBOARD_PAGE_SIZE]
+        _cache_put(_keyboard_pages, page_key, render_inbounds_keyboard_page(action, tag_filter, page, pages_count, page_inbounds))
+
+    return _keyboard_pages[page_key], page, pages_count, len(filtered_inbounds)
@@ -1,21 +1,50 @@
+import argparse
+import asyncio
+import time
+
+from contextlib import contextmanager
+
 from services import (
     generate_xray_config, 
     generate_docker_compose, 
     generate_tmpdir,
     remove_tmpdir,
     clean_all,
+    find_reusable_tmpdir,
+    get_state_dir,
+    load_state_dir,
+    reset_state_dir,
+    sync_xray_log_settings,
+    sync_xray_api_settings,
     parse_config,
     run_docker_compose,
-    stop_docker_compose
+    stop_docker_compose,
+    collect_xray_inbound_stats
 )
 
-from telebot import main as run_telegram_bot
+from daemon import run_headless
+from metrics import is_metrics_enabled, metrics, start_metrics_server
+from reconcile import reconcile_docker_compose
+
+@contextmanager
+def startup_phase(name):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started_at
+        metrics.observe(f"startup_{name}", seconds)
+        print(f"startup: {name} took {seconds:.3f}s")
 
 def main():
-    clean_all()
+    parser = argparse.ArgumentParser(description="xray-cAD")
+    parser.add_argument("--reset-state", action="store_true", help="wipe the generated state (all passwords and ports) and exit")
+    args = parser.parse_args()
+
+    started_at = time.perf_counter()
 
-    config = parse_config()
-    tmpdir = generate_tmpdir()
+    with startup_phase("parse_config"):
+        config = parse_config()
 
     if config is None:
         raise ValueError("[-] Config can't be empty!")
@@ -23,15 +52,70 @@ def main():
         telegram_bot_token = config["telegram_bot_token"]
         telegram_bot_users_whitelist = config["telegram_users_whitelist"] 
 
-    generate_xray_config(config=config, tmpdir=tmpdir)    
-    generate_docker_compose(config=config, tmpdir=tmpdir)
+    state_dir = get_state_dir(config)
+
+    # the only way to get new passwords and ports for everything, besides /restart
+    if args.reset_state:
+        if state_dir is not None:
+            reset_state_dir(state_dir)
+        else:
+            clean_all()
+        return
+
+    # a restarted bot picks up the configs (and the running containers) of the previous run
+    reattach = config.get("xray_reattach_on_boot", True)
+
+    with startup_phase("load_state"):
+        if state_dir is not None:
+            tmpdir = state_dir if load_state_dir(config, state_dir) else None
+        else:
+            tmpdir = find_reusable_tmpdir(config) if reattach else None
+
+    if tmpdir is None:
+        with startup_phase("generate_state"):
+            if state_dir is not None:
+                tmpdir = state_dir
+            else:
+                clean_all()
+                tmpdir = generate_tmpdir()
 
-    run_docker_compose(tmpdir)
+            generate_xray_config(config=config, tmpdir=tmpdir)
+    else:
+        sync_xray_log_settings(config=config, tmpdir=tmpdir)
+        sync_xray_api_settings(config=config, tmpdir=tmpdir)
+
+    with startup_phase("render_compose"):
+        generate_docker_compose(config=config, tmpdir=tmpdir)
+
+    with startup_phase("compose_up"):
+        if reattach:
+            reconcile_docker_compose(tmpdir)
+        else:
+            run_docker_compose(tmpdir)
+
+    print(f"startup: ready in {time.perf_counter() - started_at:.3f}s")
+
+    if is_metrics_enabled(config):
+        start_metrics_server(config, lambda: collect_xray_inbound_stats(config=config, tmpdir=tmpdir))
+
+    # without the bot the control api (and the background tasks) run on their own
+    if config.get("telegram_enabled", True):
+        # python-telegram-bot is only needed when the bot actually runs
+        from telebot import main as run_telegram_bot
+
+        run_telegram_bot(bot_token=telegram_bot_token, users_whitelist=telegram_bot_users_whitelist, config=config, tmpdir=tmpdir)
+    else:
+        try:
+            asyncio.run(run_headless(config, tmpdir))
+        except KeyboardInterrupt:
+            pass
 
-    run_telegram_bot(bot_token=telegram_bot_token, users_whitelist=telegram_bot_users_whitelist, config=config, tmpdir=tmpdir)
+    # with reattach the containers keep serving until the next start, /shutdown tears everything down
+    if not reattach:
+        stop_docker_compose(tmpdir)
 
-    stop_docker_compose(tmpdir)
-    remove_tmpdir(tmpdir)
+        if state_dir is None:
+            remove_tmpdir(tmpdir)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
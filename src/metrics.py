@@ -0,0 +1,190 @@
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_DEFAULT_LISTEN = "127.0.0.1:9550"
+METRICS_DEFAULT_POLL_INTERVAL = 15
+
+class Metrics:
+    """
+    Process wide registry: durations of internal operations and the last polled per-inbound xray stats.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # name -> [count, sum of seconds, max seconds]
+        self.durations = {}
+
+        # tag -> {"uplink": bytes, "downlink": bytes}
+        self.inbound_traffic = {}
+        self.inbound_connections = {}
+
+        # tag -> bytes per second between the last two polls
+        self.inbound_rates = {}
+        self.polled_at = None
+
+        # tag (or service, for rejects xray doesn't tag) -> {"accepted": count, "rejected": count} from the access log
+        self.access_log_counts = {}
+
+        # service -> {"accepted": count, "rejected": count}, all connections of the shard
+        self.access_log_service_counts = {}
+
+    def observe(self, name, seconds):
+        with self.lock:
+            duration = self.durations.setdefault(name, [0, 0.0, 0.0])
+            duration[0] += 1
+            duration[1] += seconds
+            duration[2] = max(duration[2], seconds)
+
+    def set_inbound_stats(self, inbound_traffic, inbound_connections, polled_at):
+        with self.lock:
+            if self.polled_at is not None and polled_at > self.polled_at:
+                elapsed = polled_at - self.polled_at
+                self.inbound_rates = {
+                    tag: max(0, sum(traffic.values()) - sum(self.inbound_traffic.get(tag, {}).values())) / elapsed
+                    for tag, traffic in inbound_traffic.items()
+                }
+
+            self.inbound_traffic = inbound_traffic
+            self.inbound_connections = inbound_connections
+            self.polled_at = polled_at
+
+    def set_access_log_counts(self, access_log_counts, access_log_service_counts):
+        with self.lock:
+            self.access_log_counts = {tag: dict(counts) for tag, counts in access_log_counts.items()}
+            self.access_log_service_counts = {service: dict(counts) for service, counts in access_log_service_counts.items()}
+
+    def access_log_error_rates(self, count):
+        """
+        Shards with the highest share of rejected connections first - rejects carry no inbound tag, so there's no per instance rate.
+        """
+
+        with self.lock:
+            rows = [
+                {
+                    "service": service,
+                    "accepted": counts["accepted"],
+                    "rejected": counts["rejected"],
+                    "error_rate": counts["rejected"] / (counts["accepted"] + counts["rejected"])
+                }
+                for service, counts in self.access_log_service_counts.items()
+                if counts["accepted"] + counts["rejected"] > 0
+            ]
+
+        rows.sort(key=lambda row: (row["error_rate"], row["rejected"]), reverse=True)
+        return rows[:count]
+
+    def top_inbounds(self, count):
+        """
+        Busiest tags first - by current rate once two polls are in, by total bytes before that.
+        """
+
+        with self.lock:
+            rows = [
+                {
+                    "tag": tag,
+                    "uplink": traffic.get("uplink", 0),
+                    "downlink": traffic.get("downlink", 0),
+                    "connections": self.inbound_connections.get(tag, 0),
+                    "rate": self.inbound_rates.get(tag)
+                }
+                for tag, traffic in self.inbound_traffic.items()
+            ]
+
+        rows.sort(key=lambda row: (row["rate"] or 0, row["uplink"] + row["downlink"]), reverse=True)
+        return rows[:count]
+
+    def render_prometheus(self):
+
+        lines = []
+
+        with self.lock:
+            lines.append("# TYPE xray_cad_inbound_traffic_bytes counter")
+            for tag, traffic in sorted(self.inbound_traffic.items()):
+                for direction, value in sorted(traffic.items()):
+                    lines.append(f'xray_cad_inbound_traffic_bytes{{tag="{tag}",direction="{direction}"}} {value}')
+
+            lines.append("# TYPE xray_cad_inbound_connections gauge")
+            for tag, connections in sorted(self.inbound_connections.items()):
+                lines.append(f'xray_cad_inbound_connections{{tag="{tag}"}} {connections}')
+
+            lines.append("# TYPE xray_cad_access_log_connections_total counter")
+            for tag, counts in sorted(self.access_log_counts.items()):
+                for status, value in sorted(counts.items()):
+                    lines.append(f'xray_cad_access_log_connections_total{{tag="{tag}",status="{status}"}} {value}')
+
+            lines.append("# TYPE xray_cad_operation_seconds summary")
+            for name, (count, total, maximum) in sorted(self.durations.items()):
+                lines.append(f'xray_cad_operation_seconds_count{{operation="{name}"}} {count}')
+                lines.append(f'xray_cad_operation_seconds_sum{{operation="{name}"}} {total:.6f}')
+                lines.append(f'xray_cad_operation_seconds_max{{operation="{name}"}} {maximum:.6f}')
+
+            if self.polled_at is not None:
+                lines.append("# TYPE xray_cad_stats_polled_timestamp_seconds gauge")
+                lines.append(f"xray_cad_stats_polled_timestamp_seconds {self.polled_at:.3f}")
+
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+@contextmanager
+def timed(name):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(name, time.perf_counter() - started_at)
+
+def get_metrics_settings(config):
+    return config.get("metrics") or {}
+
+def is_metrics_enabled(config):
+    return bool(get_metrics_settings(config).get("enabled", False))
+
+def start_metrics_server(config, collect_inbound_stats):
+    """
+    Starts the stats poller and the local /metrics http endpoint as daemon threads.
+    collect_inbound_stats() has to return (inbound_traffic, inbound_connections).
+    """
+
+    metrics_settings = get_metrics_settings(config)
+    poll_interval = metrics_settings.get("poll_interval", METRICS_DEFAULT_POLL_INTERVAL)
+    host, port = metrics_settings.get("listen", METRICS_DEFAULT_LISTEN).rsplit(":", 1)
+
+    def poll_inbound_stats():
+        while True:
+            try:
+                inbound_traffic, inbound_connections = collect_inbound_stats()
+                metrics.set_inbound_stats(inbound_traffic, inbound_connections, time.time())
+            except Exception as e:
+                print(f"[-] metrics: cannot poll xray-core stats: {e}")
+
+            time.sleep(poll_interval)
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+
+            body = metrics.render_prometheus().encode("utf-8")
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    metrics_server = ThreadingHTTPServer((host, int(port)), MetricsRequestHandler)
+
+    threading.Thread(target=poll_inbound_stats, name="xray-cAD-stats-poller", daemon=True).start()
+    threading.Thread(target=metrics_server.serve_forever, name="xray-cAD-metrics", daemon=True).start()
+
+    return metrics_server
@@ -0,0 +1,149 @@
+import random
+
+from pathlib import Path
+
+PORT_RANGE_START = 2000
+PORT_RANGE_END = 26000
+
+ALLOWED_PORTS_PATH = "src/configuration/allowed_ports.txt"
+EXCLUDED_PORTS_PATH = "src/configuration/excluded_ports.txt"
+
+class PortAllocator:
+    """
+    Free-list over the configured port range.
+
+    Free ports live in a plain list with a port -> position index next to it,
+    so allocating a random port is a swap-and-pop and releasing one is an
+    append - both O(1), no matter how many ports are already taken.
+    """
+
+    def __init__(self, candidate_ports, used_ports=()):
+        self._candidates = frozenset(candidate_ports)
+        self._used = set(used_ports)
+        self._free = [port for port in sorted(self._candidates) if port not in self._used]
+        self._index = {port: position for position, port in enumerate(self._free)}
+
+    def __contains__(self, port):
+        return port in self._used
+
+    def __len__(self):
+        return len(self._used)
+
+    @property
+    def free_count(self):
+        return len(self._free)
+
+    def _take(self, position):
+        port = self._free[position]
+        last_port = self._free.pop()
+
+        if last_port != port:
+            self._free[position] = last_port
+            self._index[last_port] = position
+
+        del self._index[port]
+        self._used.add(port)
+
+        return port
+
+    def allocate(self):
+        if not self._free:
+            raise ValueError("[-] Port allocator: no free ports left!")
+
+        return self._take(random.randrange(len(self._free)))
+
+    def allocate_many(self, count):
+        if count > len(self._free):
+            raise ValueError(f"[-] Port allocator: {count} ports requested, only {len(self._free)} left!")
+
+        return [self._take(random.randrange(len(self._free))) for _ in range(count)]
+
+    def allocate_block(self, size):
+        """
+        Takes a contiguous run of free ports, returns it as (first_port, last_port).
+        """
+
+        run_start = None
+        previous_port = None
+
+        for port in sorted(self._free):
+            if previous_port is None or port != previous_port + 1:
+                run_start = port
+
+            previous_port = port
+
+            if port - run_start + 1 == size:
+                for block_port in range(run_start, port + 1):
+                    self._take(self._index[block_port])
+                return run_start, port
+
+        raise ValueError(f"[-] Port allocator: no contiguous block of {size} free ports left!")
+
+    def reserve(self, port):
+        if port in self._index:
+            self._take(self._index[port])
+        else:
+            self._used.add(port)
+
+    def release(self, port):
+        if port not in self._used:
+            return
+
+        self._used.discard(port)
+
+        if port in self._candidates:
+            self._index[port] = len(self._free)
+            self._free.append(port)
+
+def read_ports_file(path):
+    return set(
+        int(line.split(":")[0])
+        for line in Path(path).read_text(encoding="utf-8").splitlines()
+        if line.strip()
+    )
+
+def read_port_blocks_file(path):
+    """
+    port_blocks.txt has a "shard:first_port-last_port" line per published port range.
+    """
+
+    port_blocks = []
+
+    for line in Path(path).read_text(encoding="utf-8").splitlines():
+        if line.strip():
+            shard, port_range = line.strip().split(":")
+            first_port, last_port = port_range.split("-")
+            port_blocks.append((int(shard), int(first_port), int(last_port)))
+
+    return port_blocks
+
+def load_port_allocator(tmpdir):
+
+    if Path(f"{tmpdir}/used_ports.txt").exists():
+        used_ports = read_ports_file(f"{tmpdir}/used_ports.txt")
+    else:
+        used_ports = set()
+
+    # a published range is taken as a whole, even the ports no inbound listens on yet
+    if Path(f"{tmpdir}/port_blocks.txt").exists():
+        for shard, first_port, last_port in read_port_blocks_file(f"{tmpdir}/port_blocks.txt"):
+            used_ports.update(range(first_port, last_port + 1))
+
+    # allowed_ports.txt (if not empty) replaces the whole range, otherwise excluded_ports.txt is cut out of it
+    if Path(ALLOWED_PORTS_PATH).exists() and Path(ALLOWED_PORTS_PATH).stat().st_size > 0:
+        candidate_ports = read_ports_file(ALLOWED_PORTS_PATH)
+    else:
+        excluded_ports = read_ports_file(EXCLUDED_PORTS_PATH) if Path(EXCLUDED_PORTS_PATH).exists() else set()
+        candidate_ports = set(range(PORT_RANGE_START, PORT_RANGE_END + 1)) - excluded_ports
+
+    return PortAllocator(candidate_ports=candidate_ports, used_ports=used_ports)
+
+_port_allocators = {}
+
+def get_port_allocator(tmpdir):
+    if tmpdir not in _port_allocators:
+        _port_allocators[tmpdir] = load_port_allocator(tmpdir)
+    return _port_allocators[tmpdir]
+
+def reset_port_allocator(tmpdir):
+    _port_allocators.pop(tmpdir, None)
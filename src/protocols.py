@@ -0,0 +1,296 @@
+import base64
+import secrets
+import uuid
+
+from urllib.parse import quote, urlencode
+
+# the key of a 2022 method is raw random bytes of exactly the cipher's key length, not a password
+SHADOWSOCKS_2022_KEY_LENGTHS = {
+    "2022-blake3-aes-128-gcm": 16,
+    "2022-blake3-aes-256-gcm": 32,
+    "2022-blake3-chacha20-poly1305": 32
+}
+
+PROTOCOL_DEFAULT_ENGINE = "shadowsocks"
+
+MULTI_USER_DEFAULT_LISTENERS_COUNT = 1
+MULTI_USER_DEFAULT_USERS_COUNT = 10
+
+def get_multi_user_settings(config):
+    return config.get("xray_inbound_multi_user") or {}
+
+def is_multi_user_enabled(config):
+    return bool(get_multi_user_settings(config).get("enabled", False))
+
+def generate_random_password():
+    return base64.b64encode(secrets.token_bytes(32)).decode()
+
+def render_shadowsocks_mode(network):
+
+    if network in ("tcp,udp", "udp,tcp"):
+        return "tcp_and_udp"
+
+    if network == "tcp":
+        return "tcp_only"
+
+    if network == "udp":
+        return "udp_only"
+
+class ShadowsocksEngine:
+    """
+    Classic shadowsocks AEAD (aes-*-gcm, chacha20-poly1305) - one password per inbound.
+
+    xray could put several users on one port with these methods, but it has to try every
+    user's key on every connection, so it's kept to one user per listener.
+    """
+
+    name = "shadowsocks"
+    xray_protocol = "shadowsocks"
+    supports_multi_user = False
+
+    def validate(self, config):
+        if config["xray_shadowsocks_inbound_method"].startswith("2022-"):
+            raise ValueError(f"[-] {config['xray_shadowsocks_inbound_method']} is a shadowsocks-2022 method, set \"xray_inbound_protocol\" to \"shadowsocks-2022\"!")
+
+    def get_method(self, config):
+        return config["xray_shadowsocks_inbound_method"]
+
+    def get_network(self, config):
+        return config["xray_shadowsocks_inbound_network"]
+
+    def generate_credential(self, method):
+        return generate_random_password()
+
+    def render_user_object(self, user):
+        return {"password": user.password, "email": user.tag}
+
+    def render_inbound_object(self, inbound, users=None):
+        """
+        With users (a list, even an empty one) the inbound is a multi-user listener.
+        """
+
+        inbound_object = {
+            "tag": inbound.tag,
+            "protocol": self.xray_protocol,
+            "port": inbound.port,
+            "listen": inbound.listen,
+            "settings": {
+                "method": inbound.method,
+                "network": inbound.network,
+                "password": inbound.password
+            }
+        }
+
+        if users is not None:
+            inbound_object["settings"]["clients"] = [self.render_user_object(user) for user in users]
+
+        return inbound_object
+
+    def render_users_object(self, inbound, users):
+        """
+        The inbound carrying only these users as clients - what the api adds to the running inbound.
+        """
+
+        return self.render_inbound_object(inbound, users=users)
+
+    def parse_inbound_object(self, inbound_object):
+        """
+        Returns (method, network, credential) of an inbound object from an xray config.
+        """
+
+        settings = inbound_object.get("settings", {})
+        return settings.get("method", ""), settings.get("network", ""), settings.get("password", "")
+
+    def get_client_password(self, inbound, user=None):
+        return user.password if user is not None else inbound.password
+
+    def render_client_config(self, inbound, server_public_ip, user=None):
+        return {
+            "server": server_public_ip,
+            "server_port": inbound.port,
+            "method": inbound.method,
+            "password": self.get_client_password(inbound, user),
+            "mode": render_shadowsocks_mode(inbound.network),
+            "local_address": "127.0.0.1",
+            "local_port": "1080"
+        }
+
+    def render_uri(self, inbound, server_public_ip, user=None):
+        """
+        ss://base64url(method:password)@host:port#tag - https://shadowsocks.org/doc/sip002.html
+        """
+
+        userinfo = base64.urlsafe_b64encode(f"{inbound.method}:{self.get_client_password(inbound, user)}".encode("utf-8")).decode().rstrip("=")
+        tag = user.tag if user is not None else inbound.tag
+
+        return f"ss://{userinfo}@{server_public_ip}:{inbound.port}#{quote(tag)}"
+
+class Shadowsocks2022Engine(ShadowsocksEngine):
+    """
+    shadowsocks-2022 (2022-blake3-*): no per connection key derivation from a password, replay protection,
+    and users of a shared port are found by an identity header instead of trial decryption.
+    """
+
+    name = "shadowsocks-2022"
+    supports_multi_user = True
+
+    def validate(self, config):
+        if config["xray_shadowsocks_inbound_method"] not in SHADOWSOCKS_2022_KEY_LENGTHS:
+            raise ValueError(f"[-] shadowsocks-2022 needs one of these methods: {', '.join(SHADOWSOCKS_2022_KEY_LENGTHS)}!")
+
+        if is_multi_user_enabled(config) and "chacha20" in config["xray_shadowsocks_inbound_method"]:
+            raise ValueError("[-] xray-core serves many shadowsocks-2022 users on one port only with the aes methods!")
+
+    def generate_credential(self, method):
+        return base64.b64encode(secrets.token_bytes(SHADOWSOCKS_2022_KEY_LENGTHS[method])).decode()
+
+    def get_client_password(self, inbound, user=None):
+        """
+        A user of a shared port sends the server key (the inbound's) and its own key - "server_key:user_key".
+        """
+
+        return f"{inbound.password}:{user.password}" if user is not None else inbound.password
+
+    def render_uri(self, inbound, server_public_ip, user=None):
+        """
+        2022 keys are already base64, so SIP002 takes the userinfo percent-encoded instead.
+        """
+
+        userinfo = quote(f"{inbound.method}:{self.get_client_password(inbound, user)}", safe="")
+        tag = user.tag if user is not None else inbound.tag
+
+        return f"ss://{userinfo}@{server_public_ip}:{inbound.port}#{quote(tag)}"
+
+class VlessEngine:
+    """
+    VLESS over plain tcp - no encryption of its own (that's left to the transport), users are matched by uuid.
+    There's no TLS/REALITY transport here, so the traffic and the uuid go over the wire in cleartext -
+    it has to be allowed with "xray_vless_allow_cleartext".
+    """
+
+    name = "vless"
+    xray_protocol = "vless"
+    supports_multi_user = True
+
+    def validate(self, config):
+        if not config.get("xray_vless_allow_cleartext", False):
+            raise ValueError("[-] vless inbounds carry traffic and uuids in cleartext (no TLS/REALITY), set \"xray_vless_allow_cleartext\" to true if that's what you want!")
+
+    def get_method(self, config):
+        return "none"
+
+    def get_network(self, config):
+        return "tcp"
+
+    def generate_credential(self, method):
+        return str(uuid.uuid4())
+
+    def render_user_object(self, user):
+        return {"id": user.password, "email": user.tag}
+
+    def render_inbound_object(self, inbound, users=None):
+        """
+        The inbound's own uuid stays a client of a multi-user listener, health checks connect with it.
+        """
+
+        clients = [{"id": inbound.password, "email": inbound.tag}]
+
+        if users is not None:
+            clients.extend(self.render_user_object(user) for user in users)
+
+        return {
+            "tag": inbound.tag,
+            "protocol": self.xray_protocol,
+            "port": inbound.port,
+            "listen": inbound.listen,
+            "settings": {
+                "clients": clients,
+                "decryption": inbound.method
+            },
+            "streamSettings": {
+                "network": inbound.network
+            }
+        }
+
+    def render_users_object(self, inbound, users):
+        inbound_object = self.render_inbound_object(inbound, users=users)
+        inbound_object["settings"]["clients"] = [self.render_user_object(user) for user in users]
+        return inbound_object
+
+    def parse_inbound_object(self, inbound_object):
+        settings = inbound_object.get("settings", {})
+        clients = settings.get("clients") or [{}]
+
+        return settings.get("decryption", "none"), inbound_object.get("streamSettings", {}).get("network", "tcp"), clients[0].get("id", "")
+
+    def get_client_password(self, inbound, user=None):
+        return user.password if user is not None else inbound.password
+
+    def render_client_config(self, inbound, server_public_ip, user=None):
+        """
+        An xray client config: a local socks proxy on 127.0.0.1:1080 going out through the inbound.
+        """
+
+        return {
+            "inbounds": [{"listen": "127.0.0.1", "port": 1080, "protocol": "socks", "settings": {"udp": True}}],
+            "outbounds": [{
+                "protocol": self.xray_protocol,
+                "settings": {
+                    "vnext": [{
+                        "address": server_public_ip,
+                        "port": inbound.port,
+                        "users": [{"id": self.get_client_password(inbound, user), "encryption": inbound.method}]
+                    }]
+                },
+                "streamSettings": {"network": inbound.network}
+            }]
+        }
+
+    def render_uri(self, inbound, server_public_ip, user=None):
+        """
+        vless://uuid@host:port?encryption=none&security=none&type=tcp#tag
+        """
+
+        params = urlencode({"encryption": inbound.method, "security": "none", "type": inbound.network})
+        tag = user.tag if user is not None else inbound.tag
+
+        return f"vless://{self.get_client_password(inbound, user)}@{server_public_ip}:{inbound.port}?{params}#{quote(tag)}"
+
+PROTOCOL_ENGINES = {engine.name: engine for engine in (ShadowsocksEngine(), Shadowsocks2022Engine(), VlessEngine())}
+
+def get_protocol_engine(name):
+
+    if name not in PROTOCOL_ENGINES:
+        raise ValueError(f"[-] Unknown inbound protocol {name}, use one of: {', '.join(PROTOCOL_ENGINES)}!")
+
+    return PROTOCOL_ENGINES[name]
+
+def get_configured_engine(config):
+    """
+    The engine new instances are generated with ("xray_inbound_protocol" in settings.json), checked against the settings.
+    """
+
+    engine = get_protocol_engine(config.get("xray_inbound_protocol") or PROTOCOL_DEFAULT_ENGINE)
+    engine.validate(config)
+
+    if is_multi_user_enabled(config) and not engine.supports_multi_user:
+        raise ValueError(f"[-] {engine.name} can't serve many users on one port, use one of: {', '.join(name for name, engine in PROTOCOL_ENGINES.items() if engine.supports_multi_user)}!")
+
+    return engine
+
+def get_engine_for(xray_protocol, method):
+    """
+    Engine of an existing inbound - shadowsocks and shadowsocks-2022 share xray's protocol name and differ by method.
+    """
+
+    if xray_protocol == "shadowsocks" and method.startswith("2022-"):
+        return PROTOCOL_ENGINES["shadowsocks-2022"]
+
+    for engine in PROTOCOL_ENGINES.values():
+        if engine.xray_protocol == xray_protocol:
+            return engine
+
+    raise ValueError(f"[-] There is no engine for {xray_protocol} inbounds!")
+
+def get_inbound_engine(inbound):
+    return get_engine_for(inbound.protocol, inbound.method)
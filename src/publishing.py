@@ -0,0 +1,40 @@
+import math
+
+# how the inbound ports of the xray-core containers are made reachable from outside:
+#   "ports"  - a "port:port/proto" docker mapping per inbound (docker-proxy + nat rules per port)
+#   "ranges" - every shard gets a contiguous block of ports, published as a single range mapping
+#   "host"   - network_mode: host, nothing is published at all
+PORTS_PUBLISHING_MODES = ("ports", "ranges", "host")
+
+def get_ports_publishing_mode(config):
+
+    ports_publishing_mode = config.get("docker_ports_publishing", "ports")
+
+    if ports_publishing_mode not in PORTS_PUBLISHING_MODES:
+        raise ValueError(f"[-] docker: unknown ports publishing mode {ports_publishing_mode}!")
+
+    return ports_publishing_mode
+
+def get_port_block_size(config, instances_count):
+    """
+    A block is bigger than its shard, so a refurbish can rotate to a port that is already published.
+    """
+
+    spare_ports_count = math.ceil(instances_count * config.get("docker_ports_range_spare_ratio", 0.25))
+
+    return instances_count + max(1, spare_ports_count)
+
+def is_port_published(config, store, shard, port):
+
+    ports_publishing_mode = get_ports_publishing_mode(config)
+
+    if ports_publishing_mode == "host":
+        return True
+
+    if ports_publishing_mode == "ranges":
+        return any(
+            block_shard == shard and first_port <= port <= last_port
+            for block_shard, first_port, last_port in store.port_blocks
+        )
+
+    return False
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import subprocess
+
+from pathlib import Path
+
+from metrics import timed
+from shards import get_shard_config_filename, get_shard_service_name
+from state import get_state_store, load_docker_compose, write_file_atomic
+
+# one fixed project, so every tmpdir (and every restart of the bot) addresses the same containers
+COMPOSE_PROJECT_NAME = "xray-cad"
+
+SERVICE_HASH_LABEL = "xray-cad.service-hash"
+
+# the tmpdir is mounted as a directory - a bind-mounted single file keeps pointing at the old inode after an atomic rename
+CONTAINER_CONFIG_DIR = "/etc/xray-cad"
+
+def hash_service_definition(service_definition):
+    return hashlib.sha256(json.dumps(service_definition, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def hash_shard_config(tmpdir, shards_count, shard):
+    with open(f"{tmpdir}/{get_shard_config_filename(shards_count, shard)}", "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+def inspect_compose_containers(tmpdir):
+    """
+    Returns {service: {"id": ..., "running": ..., "service_hash": ...}} for the project's containers, stopped ones included.
+    """
+
+    container_ids = subprocess.run(["docker", "compose", "ps", "-a", "-q"], check=True, cwd=tmpdir, capture_output=True, text=True).stdout.split()
+
+    if not container_ids:
+        return {}
+
+    inspected = json.loads(subprocess.run(["docker", "inspect", *container_ids], check=True, capture_output=True, text=True).stdout)
+    containers = {}
+
+    for container in inspected:
+        labels = container["Config"].get("Labels") or {}
+
+        containers[labels.get("com.docker.compose.service")] = {
+            "id": container["Id"],
+            "running": container["State"]["Running"],
+            "service_hash": labels.get(SERVICE_HASH_LABEL)
+        }
+
+    return containers
+
+def read_applied_services(tmpdir):
+    """
+    {service: {"container": id, "config_hash": ...}} - the config each container was last brought up to date with.
+    Labels can't change on a running container, so config-only changes are tracked here.
+    """
+
+    if not Path(f"{tmpdir}/applied.json").exists():
+        return {}
+
+    with open(f"{tmpdir}/applied.json") as f:
+        return json.load(f)
+
+def record_applied_services(tmpdir, services=None):
+    """
+    Call after containers were (re)created or restarted - they run the configs that are on disk now.
+    """
+
+    store = get_state_store(tmpdir)
+    containers = inspect_compose_containers(tmpdir)
+    applied_services = read_applied_services(tmpdir)
+
+    for shard in range(store.shards_count):
+        service = get_shard_service_name(store.shards_count, shard)
+
+        if (services is None or service in services) and service in containers:
+            applied_services[service] = {"container": containers[service]["id"], "config_hash": hash_shard_config(tmpdir, store.shards_count, shard)}
+
+    write_file_atomic(f"{tmpdir}/applied.json", json.dumps(applied_services, indent=4))
+
+def mark_config_applied(tmpdir, services):
+    """
+    The configs of these services were changed in place through the xray api, the running containers already match the files.
+    """
+
+    store = get_state_store(tmpdir)
+    applied_services = read_applied_services(tmpdir)
+
+    for shard in range(store.shards_count):
+        service = get_shard_service_name(store.shards_count, shard)
+
+        if service in services and service in applied_services:
+            applied_services[service]["config_hash"] = hash_shard_config(tmpdir, store.shards_count, shard)
+
+    write_file_atomic(f"{tmpdir}/applied.json", json.dumps(applied_services, indent=4))
+
+def plan_docker_compose_reconcile(tmpdir):
+    """
+    Diffs docker-compose.yml and the shard configs against the running containers.
+    Returns (services to bring up, services to restart, whether there are orphan containers).
+    """
+
+    store = get_state_store(tmpdir)
+    docker_compose = load_docker_compose(f"{tmpdir}/docker-compose.yml")
+
+    containers = inspect_compose_containers(tmpdir)
+    applied_services = read_applied_services(tmpdir)
+
+    services_to_up = []
+    services_to_restart = []
+
+    for shard in range(store.shards_count):
+        service = get_shard_service_name(store.shards_count, shard)
+        container = containers.get(service)
+
+        # missing, stopped or created from an older definition (ports, cpuset, image, ...)
+        if container is None or not container["running"] or container["service_hash"] != docker_compose["services"][service]["labels"][SERVICE_HASH_LABEL]:
+            services_to_up.append(service)
+            continue
+
+        applied_service = applied_services.get(service, {})
+
+        if applied_service.get("container") != container["id"] or applied_service.get("config_hash") != hash_shard_config(tmpdir, store.shards_count, shard):
+            services_to_restart.append(service)
+
+    has_orphans = any(service not in docker_compose["services"] for service in containers)
+
+    return services_to_up, services_to_restart, has_orphans
+
+def reconcile_docker_compose(tmpdir):
+    """
+    Brings the running containers in line with what is generated in tmpdir and touches only what differs:
+    a changed service definition or a missing container is (re)created, a changed config only restarts
+    the same container. Healthy, up to date containers are left alone - e.g. when the bot itself restarts.
+    Returns (services brought up, services restarted).
+    """
+
+    with timed("compose_reconcile"):
+        services_to_up, services_to_restart, has_orphans = plan_docker_compose_reconcile(tmpdir)
+
+        if services_to_up or has_orphans:
+            subprocess.run(["docker", "compose", "up", "-d", "--remove-orphans", *services_to_up], check=True, cwd=tmpdir)
+
+        if services_to_restart:
+            subprocess.run(["docker", "compose", "restart", *services_to_restart], check=True, cwd=tmpdir)
+
+        if services_to_up or services_to_restart:
+            record_applied_services(tmpdir, services=services_to_up + services_to_restart)
+
+    return services_to_up, services_to_restart
@@ -0,0 +1,224 @@
+import asyncio
+import time
+
+from async_services import run_blocking, refurbish_xray_inbound_instances_async, change_xray_users_async
+from metrics import metrics
+from protocols import is_multi_user_enabled
+from state import get_state_store
+
+ROTATION_DEFAULT_CHECK_INTERVAL = 60
+ROTATION_DEFAULT_MAX_PER_WINDOW = 10
+
+# minute, hour, day of month, month, day of week
+CRON_FIELDS_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+def get_rotation_settings(config):
+    return config.get("rotation") or {}
+
+def is_rotation_enabled(config):
+    return bool(get_rotation_settings(config).get("enabled", False))
+
+def parse_cron_field(field, low, high):
+
+    values = set()
+
+    for part in field.split(","):
+        part_range, _, step = part.partition("/")
+
+        if part_range == "*":
+            first, last = low, high
+        elif "-" in part_range:
+            first, last = (int(value) for value in part_range.split("-", 1))
+        else:
+            first = last = int(part_range)
+
+        if not low <= first <= last <= high:
+            raise ValueError(f"[-] Cron field \"{field}\" is out of range {low}-{high}!")
+
+        values.update(range(first, last + 1, int(step) if step else 1))
+
+    return values
+
+def parse_cron_schedule(schedule):
+    """
+    "minute hour day-of-month month day-of-week", e.g. "0 4 * * *" - every day at 04:00 local time.
+    Supports *, lists, ranges and steps. Day of week: 0 is sunday.
+    """
+
+    fields = schedule.split()
+
+    if len(fields) != len(CRON_FIELDS_RANGES):
+        raise ValueError(f"[-] Cron schedule \"{schedule}\" must have {len(CRON_FIELDS_RANGES)} fields!")
+
+    parsed = [parse_cron_field(field, low, high) for field, (low, high) in zip(fields, CRON_FIELDS_RANGES)]
+
+    # like cron, a restricted day of month and day of week match either of them
+    days_restricted = fields[2] != "*" and fields[4] != "*"
+
+    return parsed, days_restricted
+
+def cron_schedule_matches(parsed_schedule, timestamp):
+
+    (minutes, hours, days, months, weekdays), days_restricted = parsed_schedule
+    t = time.localtime(timestamp)
+
+    day_matches = t.tm_mday in days
+    weekday_matches = (t.tm_wday + 1) % 7 in weekdays
+
+    if days_restricted:
+        days_match = day_matches or weekday_matches
+    else:
+        days_match = day_matches and weekday_matches
+
+    return t.tm_min in minutes and t.tm_hour in hours and t.tm_mon in months and days_match
+
+class RotationScheduler:
+    """
+    Rotates inbounds in the background on the "rotation" policy from settings.json:
+    max_age (seconds), max_traffic (bytes, needs "metrics") and a cron-like schedule.
+
+    Every check_interval all due instances are refurbished in one batch - one config write,
+    one apply. At most max_per_window instances go per batch (oldest first), the rest wait
+    for the next window, so clients are not all dropped at once. Rotation changes credentials
+    only, ports stay (xray_refurbish_rotate_port applies to /rc).
+
+    Ages come from the creation times in the state (they survive a restart of the process),
+    instances are addressed by tag, so a /restart between picking and rotating can't redirect a batch.
+
+    In multi-user mode the users are rotated, by tag, instead of the listeners - a listener's port
+    and server key are in every config of its users. Traffic is only counted per listener there,
+    so max_traffic doesn't apply to users.
+    """
+
+    def __init__(self, config, tmpdir, notify=None):
+        rotation_settings = get_rotation_settings(config)
+
+        self.config = config
+        self.tmpdir = tmpdir
+        self.notify = notify
+
+        self.max_age = rotation_settings.get("max_age", 0)
+        self.max_traffic = rotation_settings.get("max_traffic", 0)
+        self.check_interval = rotation_settings.get("check_interval", ROTATION_DEFAULT_CHECK_INTERVAL)
+        self.max_per_window = rotation_settings.get("max_per_window", ROTATION_DEFAULT_MAX_PER_WINDOW)
+        self.schedule = parse_cron_schedule(rotation_settings["schedule"]) if rotation_settings.get("schedule") else None
+
+        self.multi_user = is_multi_user_enabled(config)
+
+        # tag -> (record, traffic bytes when it was seen first). A new record means the instance
+        # was refurbished (by us, /rc or /restart) - its traffic counts from there
+        self.traffic_baselines = {}
+
+        # tags a schedule tick made due, drained window by window
+        self.scheduled = set()
+        self.last_checked_minute = None
+
+    def inbound_traffic(self, tag):
+        with metrics.lock:
+            return sum(metrics.inbound_traffic.get(tag, {}).values())
+
+    def schedule_fired(self, now):
+
+        current_minute = int(now // 60) * 60
+
+        if self.last_checked_minute is None:
+            checked_minutes = [current_minute]
+        else:
+            checked_minutes = range(self.last_checked_minute + 60, current_minute + 1, 60)
+
+        self.last_checked_minute = current_minute
+
+        return any(cron_schedule_matches(self.schedule, minute) for minute in checked_minutes)
+
+    def collect_due(self, now):
+        """
+        Returns [(tag, reason), ...] for this window - instance tags, user tags in multi-user mode.
+        """
+
+        store = get_state_store(self.tmpdir)
+
+        if store is None:
+            return []
+
+        with store.lock:
+            records = list(store.users) if self.multi_user else list(store.inbounds)
+            created_at = {record.tag: store.created_at.get(record.tag, now) for record in records}
+
+        for tag in [tag for tag in self.traffic_baselines if tag not in created_at]:
+            del self.traffic_baselines[tag]
+
+        self.scheduled.intersection_update(created_at)
+
+        if self.schedule is not None and self.schedule_fired(now):
+            self.scheduled.update(created_at)
+
+        due = []
+
+        for record in records:
+            traffic = self.inbound_traffic(record.tag)
+            tracked = self.traffic_baselines.get(record.tag)
+
+            # counters drop back to zero when the container is recreated
+            if tracked is None or tracked[0] is not record or traffic < tracked[1]:
+                tracked = self.traffic_baselines[record.tag] = (record, traffic)
+
+            if record.tag in self.scheduled:
+                reason = "schedule"
+            elif self.max_age and now - created_at[record.tag] >= self.max_age:
+                reason = "age"
+            elif self.max_traffic and traffic - tracked[1] >= self.max_traffic:
+                reason = "traffic"
+            else:
+                continue
+
+            due.append((created_at[record.tag], record.tag, reason))
+
+        due.sort()
+
+        return [(tag, reason) for _, tag, reason in due[:self.max_per_window]]
+
+    async def rotate_due(self):
+        """
+        Rotates one window worth of due instances. Returns what was rotated.
+        """
+
+        due = await run_blocking(self.collect_due, time.time())
+
+        if not due:
+            return []
+
+        tags = [tag for tag, _ in due]
+
+        if self.multi_user:
+            _, _, _, applied_services = await change_xray_users_async(config=self.config, tmpdir=self.tmpdir, refurbish_user_tags=tags)
+            rotated_what, applied_how = "users", "Restarted"
+        else:
+            # only the credentials rotate - a new port isn't published by the running container (in "ports" mode),
+            # so every window would recreate the whole shard and drop all of its clients. Same port and same shard
+            # let the batch go live through the xray api
+            applied_services = await refurbish_xray_inbound_instances_async(
+                config=dict(self.config, xray_refurbish_rotate_port=False),
+                tmpdir=self.tmpdir,
+                instance_tags=tags,
+                rebalance=False
+            )
+            rotated_what, applied_how = "inbound instances", "Recreated"
+
+        self.scheduled.difference_update(tags)
+
+        if self.notify is not None:
+            rotated_str = "".join(f"{tag} ({reason})\n" for tag, reason in due)
+            applied_str = f"{applied_how}: {', '.join(applied_services)}." if applied_services else "Applied live."
+
+            await self.notify(f"Rotated {len(due)} {rotated_what}:\n\n{rotated_str}\n{applied_str} Their old configs no longer work, request new ones with /gc.")
+
+        return due
+
+    async def run(self):
+        while True:
+            try:
+                await self.rotate_due()
+            except Exception as e:
+                print(f"[-] rotation: cannot rotate inbound instances: {e}")
+
+            await asyncio.sleep(self.check_interval)
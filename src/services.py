@@ -1,32 +1,118 @@
-import secrets
-import base64
 import json
-import random
 import subprocess
 import tempfile
-import yaml
 import shutil
 import socket
 import os
+import time
 
 from pathlib import Path
 
-def generate_random_password():
-    return base64.b64encode(secrets.token_bytes(32)).decode()
+from metrics import is_metrics_enabled, timed
+from ports import PortAllocator, get_port_allocator, reset_port_allocator
+from protocols import (
+    MULTI_USER_DEFAULT_LISTENERS_COUNT,
+    MULTI_USER_DEFAULT_USERS_COUNT,
+    get_configured_engine,
+    get_inbound_engine,
+    get_multi_user_settings,
+    is_multi_user_enabled
+)
+from publishing import get_ports_publishing_mode, get_port_block_size, is_port_published
+from reconcile import (
+    COMPOSE_PROJECT_NAME,
+    CONTAINER_CONFIG_DIR,
+    SERVICE_HASH_LABEL,
+    hash_service_definition,
+    mark_config_applied
+)
+from shards import get_shards_count, get_shard_cpusets, get_shard_service_name, get_shard_config_filename, pick_least_loaded_shard
+from state import InboundRecord, UserRecord, StateStore, get_state_store, set_state_store, reset_state_store, write_file_atomic, dump_docker_compose
+from xray_logs import CONTAINER_LOG_DIR, XRAY_LOG_LEVELS, generate_xray_log_object, get_xray_log_dir
+from xray_api import (
+    generate_xray_api_object,
+    generate_xray_stats_objects,
+    get_xray_api_listen,
+    is_xray_api_enabled,
+    insert_inbound,
+    query_inbound_traffic,
+    replace_inbound,
+    add_users,
+    remove_users,
+    XrayApiError
+)
 
 def generate_random_port(tmpdir):
-    if Path(f"{tmpdir}/used_ports.txt").exists():
-        used_ports = set(int(line.split(":")[0]) for line in Path(f"{tmpdir}/used_ports.txt").read_text(encoding="utf-8").splitlines() if line.strip())
-    else:
-        used_ports = set()
+    return get_port_allocator(tmpdir).allocate()
 
-    if Path("src/configuration/allowed_ports.txt").stat().st_size > 0:
-        allowed_ports = set(int(line) for line in Path("src/configuration/allowed_ports.txt").read_text(encoding="utf-8").splitlines() if line.strip())
-        return random.choice(list(allowed_ports))
-    else:
-        excluded_ports = set(int(line) for line in Path("src/configuration/excluded_ports.txt").read_text().splitlines() if line.strip())
-        available_ports = set(range(2000, 26000 + 1)) - excluded_ports - used_ports
-        return random.choice(list(available_ports))
+def allocate_instance_ports(config, tmpdir, instances_count, shards_count):
+    """
+    Returns a port per instance (instance n lives in shard n % shards_count) and the published port blocks.
+    """
+
+    # with host networking the api ports live on the host as well, no inbound may take them
+    if get_ports_publishing_mode(config) == "host" and is_xray_api_enabled(config):
+        for shard in range(shards_count):
+            get_port_allocator(tmpdir).reserve(int(get_xray_api_listen(config, shard=shard).rsplit(":", 1)[1]))
+
+    if get_ports_publishing_mode(config) != "ranges":
+        return get_port_allocator(tmpdir).allocate_many(instances_count), []
+
+    instance_ports = [None] * instances_count
+    port_blocks = []
+
+    for shard in range(shards_count):
+        shard_instance_nums = range(shard, instances_count, shards_count)
+
+        first_port, last_port = get_port_allocator(tmpdir).allocate_block(get_port_block_size(config, len(shard_instance_nums)))
+        port_blocks.append((shard, first_port, last_port))
+
+        shard_ports = PortAllocator(candidate_ports=range(first_port, last_port + 1)).allocate_many(len(shard_instance_nums))
+
+        for instance_num, port in zip(shard_instance_nums, shard_ports):
+            instance_ports[instance_num] = port
+
+    return instance_ports, port_blocks
+
+def get_separated_instances_count(config):
+    """
+    "instances_count", or "shadowsocks_instances_count" of settings written before there were other protocols.
+    """
+
+    separated_instances = config["xray_inbound_separated_instances"]
+
+    return separated_instances.get("instances_count", separated_instances.get("shadowsocks_instances_count"))
+
+def get_listeners_count(config):
+    """
+    How many inbounds are generated - one per instance, or a few shared listeners in multi-user mode.
+    """
+
+    if is_multi_user_enabled(config):
+        return get_multi_user_settings(config).get("listeners_count", MULTI_USER_DEFAULT_LISTENERS_COUNT)
+
+    return get_separated_instances_count(config)
+
+def generate_inbound_record(config, engine, tag, port, shard=0):
+    """
+    A new inbound of the given protocol engine with a fresh credential.
+    """
+
+    method = engine.get_method(config)
+
+    return InboundRecord(
+        tag=tag,
+        protocol=engine.xray_protocol,
+        port=port,
+        listen="0.0.0.0",
+        method=method,
+        network=engine.get_network(config),
+        password=engine.generate_credential(method),
+        shard=shard
+    )
+
+def generate_user_record(engine, inbound, tag):
+    return UserRecord(tag=tag, inbound_tag=inbound.tag, password=engine.generate_credential(inbound.method))
 
 def parse_config():
     if Path("src/configuration/settings.json").stat().st_size == 0:
@@ -37,41 +123,53 @@ def parse_config():
 def generate_tmpdir():
     return tempfile.mkdtemp(prefix="xray-cAD-")
 
+def get_state_dir(config):
+    """
+    Persistent directory for the generated state, None to keep using a throwaway tmpdir.
+    """
+
+    return config.get("state_dir") or None
+
+def load_state_dir(config, state_dir):
+    """
+    Returns True if state_dir already holds a state that fits the settings, False if it has to be generated.
+    """
+
+    os.makedirs(state_dir, mode=0o700, exist_ok=True)
+
+    store = get_state_store(state_dir)
+
+    if store is None:
+        return False
+
+    if not store_matches_config(config, store):
+        raise ValueError(f"[-] {state_dir} was generated with other settings! Run \"python src/main.py --reset-state\" to regenerate it.")
+
+    return True
+
+def reset_state_dir(state_dir):
+    if Path(state_dir).exists():
+        remove_content_of_tmpdir(state_dir); print(f"{state_dir} : reset")
+
 def generate_xray_config(config, tmpdir):
     
-    def generate_shadowsocks_inbound(config):
-        
-        shadowsocks_instances_count = config["xray_inbound_separated_instances"]["shadowsocks_instances_count"]
-        shadowsocks_inbound_objects = {}
-
-        for instance_num in range(shadowsocks_instances_count):
-
-            shadowsocks_port = generate_random_port(tmpdir=tmpdir)
-            shadowsocks_password = generate_random_password()
-
-            shadowsocks_inbound_object = {
-                "tag": f"shadowsocks-{instance_num + 1}", # because it's starts from zero
-                "protocol": "shadowsocks",
-                "port": shadowsocks_port,
-                "listen": "0.0.0.0",
-                "settings": {
-                    "method": config["xray_shadowsocks_inbound_method"],
-                    "network": config["xray_shadowsocks_inbound_network"],
-                    "password": shadowsocks_password
-                }
-            }
+    def generate_separated_inbounds(config):
+
+        engine = get_configured_engine(config)
 
-            shadowsocks_inbound_objects[instance_num] = shadowsocks_inbound_object
+        instances_count = get_listeners_count(config)
+        inbound_objects = {}
+        instance_ports, instance_port_blocks = allocate_instance_ports(config, tmpdir, instances_count, shards_count)
 
-            if config is not None and config["xray_shadowsocks_inbound_network"] in ["tcp,udp", "udp,tcp"]:
-                paste_to_used_ports(tmpdir, shadowsocks_port, "tcp")
-                paste_to_used_ports(tmpdir, shadowsocks_port, "udp")
-            elif config is not None and config["xray_shadowsocks_inbound_network"] == "tcp":
-                paste_to_used_ports(tmpdir, shadowsocks_port, "tcp")
-            elif config is not None and config["xray_shadowsocks_inbound_network"] == "udp":
-                paste_to_used_ports(tmpdir, shadowsocks_port, "udp")
+        port_blocks.extend(instance_port_blocks)
 
-        return shadowsocks_inbound_objects
+        for instance_num, instance_port in enumerate(instance_ports):
+
+            inbound = generate_inbound_record(config, engine, tag=f"{engine.name}-{instance_num + 1}", port=instance_port) # because it's starts from zero
+
+            inbound_objects[instance_num] = inbound.to_inbound_object()
+
+        return inbound_objects
 
     def generate_wireguard_outbound(config):
 
@@ -116,14 +214,17 @@ def generate_xray_config(config, tmpdir):
         else:
             return bool(dictionary)
 
-    shadowsocks_inbound_objects = generate_shadowsocks_inbound(config=config)
+    shards_count = get_shards_count(config, get_listeners_count(config))
+    port_blocks = []
+
+    inbound_objects = generate_separated_inbounds(config=config)
     
     wireguard_outbound_object = generate_wireguard_outbound(config=config)
     freedom_outbound_object = generate_freedom_outbound()
     blackhole_outbound_object = generate_blackhole_outbound()
 
     xray_config = {
-        "log": {"loglevel":  "debug"},
+        "log": generate_xray_log_object(config),
         "routing": {
             "rules": [
                 {
@@ -137,8 +238,8 @@ def generate_xray_config(config, tmpdir):
         "outbounds": []
     }
 
-    if check_if_all_values_is_not_empty(shadowsocks_inbound_objects):
-        xray_config["inbounds"].extend(shadowsocks_inbound_objects.values())
+    if check_if_all_values_is_not_empty(inbound_objects):
+        xray_config["inbounds"].extend(inbound_objects.values())
 
     if check_if_all_values_is_not_empty(wireguard_outbound_object):
         xray_config["outbounds"].append(wireguard_outbound_object)
@@ -151,38 +252,159 @@ def generate_xray_config(config, tmpdir):
     if not xray_config["inbounds"]:
         raise ValueError("[-] xray-core: Inbounds can't be empty!")
 
-    with open(f"{tmpdir}/config.json", "w", encoding="utf-8") as f:
-        json.dump(xray_config, f, indent=4)
+    if is_metrics_enabled(config):
+        xray_config.update(generate_xray_stats_objects())
 
-def generate_docker_compose(config, tmpdir):
+    shard_overrides = [{} for _ in range(shards_count)]
+
+    if is_xray_api_enabled(config):
+        for shard in range(shards_count):
+            shard_overrides[shard]["api"] = generate_xray_api_object(config, shard=shard)
+
+    # round robin is exactly "least loaded first" when all shards start empty
+    inbound_records = [
+        InboundRecord.from_inbound_object(inbound_object, shard=instance_num % shards_count)
+        for instance_num, inbound_object in enumerate(xray_config["inbounds"])
+    ]
+
+    users = None
+
+    # the users are dealt round robin over the listeners, and so over the shards
+    if is_multi_user_enabled(config):
+        engine = get_configured_engine(config)
+        users_count = get_multi_user_settings(config).get("users_count", MULTI_USER_DEFAULT_USERS_COUNT)
+
+        users = [
+            generate_user_record(engine, inbound_records[user_num % len(inbound_records)], tag=f"user-{user_num + 1}") # because it's starts from zero
+            for user_num in range(users_count)
+        ]
+
+    store = StateStore(
+        tmpdir=tmpdir,
+        xray_config=xray_config,
+        inbounds=inbound_records,
+        shards_count=shards_count,
+        shard_overrides=shard_overrides,
+        port_blocks=port_blocks,
+        users=users
+    )
+    store.rebuild_used_ports()
+    store.commit()
+
+    set_state_store(tmpdir, store)
+
+def render_docker_compose(config, tmpdir, store):
     
     docker_compose = {
-        "services": {
-            "xray-core": {
-                "image": "ghcr.io/xtls/xray-core:latest",
-                "volumes": [f"{tmpdir}/config.json:/usr/local/etc/xray/config.json:ro"],
-                "ports": [],
-                "restart": "no",
-                "dns": ["1.1.1.1","1.0.0.1"]
-            }
-        }
+        "name": COMPOSE_PROJECT_NAME,
+        "services": {}
     }
 
-    with open(f"{tmpdir}/used_ports.txt") as f:
-        for line in f:
-            port, protocol = line.strip().split(":")
-            docker_compose["services"]["xray-core"]["ports"].append(f"{port}:{port}/{protocol}")
+    cpusets = get_shard_cpusets(config, store.shards_count)
+    ports_publishing_mode = get_ports_publishing_mode(config)
+    log_dir = get_xray_log_dir(config)
+
+    for shard in range(store.shards_count):
+
+        xray_core_service = {
+            "image": "ghcr.io/xtls/xray-core:latest",
+            "command": ["run", "-c", f"{CONTAINER_CONFIG_DIR}/{get_shard_config_filename(store.shards_count, shard)}"],
+            "volumes": [f"{tmpdir}:{CONTAINER_CONFIG_DIR}:ro"],
+            "ports": [],
+            "restart": "no",
+            "dns": ["1.1.1.1","1.0.0.1"]
+        }
+
+        if cpusets[shard] is not None:
+            xray_core_service["cpuset"] = cpusets[shard]
+
+        # every shard logs into a directory of its own, the file names inside the container are the same
+        if log_dir is not None:
+            xray_core_service["volumes"].append(f"{log_dir}/{get_shard_service_name(store.shards_count, shard)}:{CONTAINER_LOG_DIR}")
+
+        shard_inbounds = store.shard_inbounds(shard)
+
+        if ports_publishing_mode == "host":
+            del xray_core_service["ports"]
+            xray_core_service["network_mode"] = "host"
+
+        elif ports_publishing_mode == "ranges":
+            shard_protocols = [protocol for protocol in ("tcp", "udp") if any(protocol in inbound.transport_protocols for inbound in shard_inbounds)]
+
+            for block_shard, first_port, last_port in store.port_blocks:
+                if block_shard == shard:
+                    for protocol in shard_protocols:
+                        xray_core_service["ports"].append(f"{first_port}-{last_port}:{first_port}-{last_port}/{protocol}")
+
+        else:
+            for inbound in shard_inbounds:
+                for protocol in inbound.transport_protocols:
+                    xray_core_service["ports"].append(f"{inbound.port}:{inbound.port}/{protocol}")
+
+        # lets a reconcile tell whether the running container was created from this very definition
+        xray_core_service["labels"] = {SERVICE_HASH_LABEL: hash_service_definition(xray_core_service)}
+
+        docker_compose["services"][get_shard_service_name(store.shards_count, shard)] = xray_core_service
+
+    return docker_compose
+
+def generate_docker_compose(config, tmpdir):
+
+    store = get_state_store(tmpdir)
+
+    with store.lock:
+        docker_compose = render_docker_compose(config=config, tmpdir=tmpdir, store=store)
 
-    with open(f"{tmpdir}/docker-compose.yml", "w", encoding="utf-8") as f:
-        yaml.dump(docker_compose, f, allow_unicode=True, sort_keys=False)
+    write_file_atomic(f"{tmpdir}/docker-compose.yml", dump_docker_compose(docker_compose))
+
+def regenerate_xray_state(config, tmpdir):
+    """
+    Generates everything anew (ports, credentials, compose file) in a staging directory inside tmpdir
+    and swaps the files in under the store's lock. Until the swap concurrent readers keep the old state,
+    they never see an emptied or half-written tmpdir.
+    """
+
+    staging_dir = tempfile.mkdtemp(prefix=".regenerate-", dir=tmpdir)
+
+    try:
+        generate_xray_config(config=config, tmpdir=staging_dir)
+
+        store = get_state_store(staging_dir)
+        old_store = get_state_store(tmpdir)
+
+        with (old_store or store).lock:
+            generated = {item.name for item in Path(staging_dir).iterdir()}
+
+            # leftovers of the old state go - e.g. the configs of shards that are gone, applied.json
+            for item in Path(tmpdir).iterdir():
+                if (item.is_file() or item.is_symlink()) and item.name not in generated:
+                    item.unlink()
+
+            for name in generated:
+                os.replace(f"{staging_dir}/{name}", f"{tmpdir}/{name}")
+
+            store.tmpdir = tmpdir
+            write_file_atomic(f"{tmpdir}/docker-compose.yml", dump_docker_compose(render_docker_compose(config=config, tmpdir=tmpdir, store=store)))
+
+            # the allocator re-reads the new used_ports.txt on next use
+            reset_port_allocator(tmpdir)
+            set_state_store(tmpdir, store)
+    finally:
+        reset_port_allocator(staging_dir)
+        reset_state_store(staging_dir)
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
 def run_docker_compose(tmpdir):
-    subprocess.run(["docker", "compose", "up", "-d"], check=True, cwd=tmpdir)
+    with timed("compose_up"):
+        subprocess.run(["docker", "compose", "up", "-d"], check=True, cwd=tmpdir)
 
 def stop_docker_compose(tmpdir):
-    subprocess.run(["docker", "compose", "down"], check=True, cwd=tmpdir)
+    with timed("compose_down"):
+        subprocess.run(["docker", "compose", "down", "--remove-orphans"], check=True, cwd=tmpdir)
 
 def remove_tmpdir(tmpdir):
+    reset_port_allocator(tmpdir)
+    reset_state_store(tmpdir)
     shutil.rmtree(tmpdir); print(f"{tmpdir} : removed")
 
 def clean_all():
@@ -190,151 +412,664 @@ def clean_all():
         for item in list(Path(tempfile.gettempdir()).glob("xray-cAD-*")):
             shutil.rmtree(item); #print(f"{item} : removed")
 
-def paste_to_used_ports(tmpdir, port, protocol):
-    with open(f"{tmpdir}/used_ports.txt", "a", encoding="utf-8") as f:
-        f.write(f"{port}:{protocol}\n")
-
-def parse_xray_config(tmpdir):
-    if Path(f"{tmpdir}/config.json").stat().st_size == 0:
-        return None
-    with open(f"{tmpdir}/config.json") as f: 
-        return json.load(f)
+def store_matches_config(config, store):
+    """
+    Whether a generated state can keep serving with these settings (same instances, shards and inbound settings).
+    Instances added later on top of the configured count don't count as a mismatch.
+    Only what shapes the credentials and ports is compared - the log, api and stats sections are synced on boot instead.
+    """
+
+    instances_count = get_listeners_count(config)
+    engine = get_configured_engine(config)
+
+    return (
+        store.multi_user == is_multi_user_enabled(config)
+        and len(store.inbounds) >= instances_count
+        and store.shards_count == get_shards_count(config, instances_count)
+        and bool(store.port_blocks) == (get_ports_publishing_mode(config) == "ranges")
+        and all(
+            inbound.protocol == engine.xray_protocol and inbound.method == engine.get_method(config) and inbound.network == engine.get_network(config)
+            for inbound in store.inbounds
+        )
+    )
+
+def find_reusable_tmpdir(config):
+    """
+    The newest tmpdir left by a previous run whose state still fits the settings, or None.
+    Every other xray-cAD tmpdir is removed.
+    """
+
+    tmpdirs = sorted(Path(tempfile.gettempdir()).glob("xray-cAD-*"), key=lambda item: item.stat().st_mtime, reverse=True)
+    reusable_tmpdir = None
+
+    for item in tmpdirs:
+        if reusable_tmpdir is None and item.is_dir():
+            try:
+                store = get_state_store(str(item))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"[-] {item} : cannot load state: {e}")
+                store = None
+
+            if store is not None and store_matches_config(config, store):
+                reusable_tmpdir = str(item)
+                continue
+
+            reset_state_store(str(item))
+
+        shutil.rmtree(item)
+
+    return reusable_tmpdir
 
 def list_xray_inbound_instances(config, tmpdir):
 
-    xray_config = parse_xray_config(tmpdir=tmpdir)
-    
-    if xray_config is not None:     
-        
-        xray_inbound_instances = {
-            num: instance["tag"]
-            for num, instance in enumerate(xray_config["inbounds"])
-        }
+    store = get_state_store(tmpdir)
+
+    if store is not None:
+        return store.list_tags()
+
+def refurbish_xray_inbound_instances(config, tmpdir, instance_nums=(), rebalance=True, keep_old_ports=False, instance_tags=()):
+    """
+    Refurbishes several instances with a single batched write.
+    instance_tags are resolved under the store lock (tags that are gone are skipped) - for callers
+    that picked the instances earlier, when a /restart may have changed the numbers meanwhile.
+    With rebalance an instance may move to the least loaded shard - only when its port is rotated,
+    a kept port is published by (and in "ranges" mode belongs to the block of) the shard it's on.
+    With keep_old_ports the old ports never go back to the allocator (e.g. something else holds them).
+    Returns a list of (old_inbound, inbound) records.
+    """
+
+    def refurbish_port(old_inbound, shard):
+
+        # without port rotation the instance can be swapped through the xray api, no new port has to be published
+        if not rotate_port:
+            return old_inbound.port
+
+        # in "ranges" mode the new port comes from the shard's already published block
+        if ports_publishing_mode == "ranges":
+            if store.get_block_allocator(shard).free_count == 0:
+                return old_inbound.port
+
+            port = store.get_block_allocator(shard).allocate()
+
+            if not keep_old_ports:
+                store.get_block_allocator(old_inbound.shard).release(old_inbound.port)
+
+            return port
+
+        # the old port goes back first - with an exhausted pool it's the only one left to take
+        if not keep_old_ports:
+            get_port_allocator(tmpdir).release(old_inbound.port)
+
+        return generate_random_port(tmpdir=tmpdir)
+
+    def refurbish_inbound_instance(old_inbound, shard):
+
+        # the instance keeps its protocol, method and tag - only the port and the credential are new
+        engine = get_inbound_engine(old_inbound)
+        port = refurbish_port(old_inbound, shard)
+
+        inbound = InboundRecord(
+            tag=old_inbound.tag,
+            protocol=old_inbound.protocol,
+            port=port,
+            listen=old_inbound.listen,
+            method=old_inbound.method,
+            network=old_inbound.network,
+            password=engine.generate_credential(old_inbound.method),
+            shard=shard
+        )
+
+        if port != old_inbound.port:
+            store.release_used_port(old_inbound.port)
+
+            for protocol in inbound.transport_protocols:
+                store.add_used_port(port, protocol)
+
+        return inbound
+
+    store = get_state_store(tmpdir)
+
+    if store is None:
+        return []
 
-    return xray_inbound_instances
+    # a listener's port and server key are in every one of its users' configs
+    if store.multi_user:
+        raise ValueError("[-] Listeners aren't refurbished in multi-user mode, that would break the configs of all their users - refurbish the users instead!")
+
+    refurbished = []
+    ports_publishing_mode = get_ports_publishing_mode(config)
+    rotate_port = bool(config.get("xray_refurbish_rotate_port", False))
+
+    # shard configs, used_ports.txt and docker-compose.yml go out together, nobody sees a half-applied refurbish
+    with store.lock:
+        shard_loads = store.shard_loads()
+
+        for instance_num in list(instance_nums) + store.find_instance_nums(instance_tags):
+            old_inbound = store.get(instance_num)
+
+            if rebalance and rotate_port:
+                shard = pick_least_loaded_shard(shard_loads, current_shard=old_inbound.shard)
+
+                # moving into a shard whose published block is full would need a new block (and a recreate)
+                if ports_publishing_mode == "ranges" and store.get_block_allocator(shard).free_count == 0:
+                    shard = old_inbound.shard
+
+                shard_loads[old_inbound.shard] -= 1
+                shard_loads[shard] += 1
+            else:
+                shard = old_inbound.shard
+
+            inbound = refurbish_inbound_instance(old_inbound, shard)
+
+            store.replace(instance_num, inbound)
+            refurbished.append((old_inbound, inbound))
+
+        touched_shards = sorted({inbound.shard for pair in refurbished for inbound in pair})
+        store.commit(docker_compose=render_docker_compose(config=config, tmpdir=tmpdir, store=store), shards=touched_shards)
+
+    return refurbished
 
 def refurbish_xray_inbound_intance(config, tmpdir, instance_num):
 
-    def refurbish_shadowsocks_inbound_instance():
+    refurbished = refurbish_xray_inbound_instances(config=config, tmpdir=tmpdir, instance_nums=[instance_num])
 
-        shadowsocks_port = generate_random_port(tmpdir=tmpdir)
-        shadowsocks_password = generate_random_password()
+    if refurbished:
+        return refurbished[0]
 
-        shadowsocks_inbound_object = {
-            "tag": f"shadowsocks-{instance_num + 1}", # because it's starts from zero
-            "protocol": "shadowsocks",
-            "port": shadowsocks_port,
-            "listen": "0.0.0.0",
-            "settings": {
-                "method": config["xray_shadowsocks_inbound_method"],
-                "network": config["xray_shadowsocks_inbound_network"],
-                "password": shadowsocks_password
-            }
-        }
+def add_xray_inbound_instances(config, tmpdir, count):
+    """
+    Adds count new instances of the configured protocol, each to the least loaded shard, with a single batched write.
+    Returns a list of (None, inbound) records - the same shape refurbish returns, so both apply alike.
+    """
 
-        if config is not None and config["xray_shadowsocks_inbound_network"] in ["tcp,udp", "udp,tcp"]:
-            paste_to_used_ports(tmpdir, shadowsocks_port, "tcp")
-            paste_to_used_ports(tmpdir, shadowsocks_port, "udp")
-        elif config is not None and config["xray_shadowsocks_inbound_network"] == "tcp":
-            paste_to_used_ports(tmpdir, shadowsocks_port, "tcp")
-        elif config is not None and config["xray_shadowsocks_inbound_network"] == "udp":
-            paste_to_used_ports(tmpdir, shadowsocks_port, "udp")
+    store = get_state_store(tmpdir)
 
-        return shadowsocks_inbound_object
+    if store is None:
+        return []
 
-    xray_config = parse_xray_config(tmpdir=tmpdir)
+    # a listener without users serves nobody, users are spread over the generated listeners
+    if store.multi_user:
+        raise ValueError("[-] Listeners aren't added in multi-user mode - add users instead!")
 
-    if xray_config is not None:        
+    added = []
+    ports_publishing_mode = get_ports_publishing_mode(config)
+    engine = get_configured_engine(config)
 
-        if xray_config["inbounds"][instance_num]["protocol"] == "shadowsocks":
-            inbound_object = refurbish_shadowsocks_inbound_instance()
-        else:
-            raise ValueError("[-] ... something went wrong. Honestly, I don't really know what exactly.")
-        
-        xray_config["inbounds"][instance_num] = inbound_object
+    with store.lock:
+        shard_loads = store.shard_loads()
 
-        with open(f"{tmpdir}/config.json", "w", encoding="utf-8") as f:
-            json.dump(xray_config, f, indent=4)
+        for _ in range(count):
+            # in "ranges" mode new instances have to fit into the already published blocks
+            if ports_publishing_mode == "ranges":
+                shard = max(range(store.shards_count), key=lambda block_shard: store.get_block_allocator(block_shard).free_count)
 
-def request_config_for_xray_inbound_instance(config, tmpdir, instance_num):
-    
-    def get_server_public_ip():
-        
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                if store.get_block_allocator(shard).free_count == 0:
+                    raise ValueError("[-] No free ports left in the published port blocks! Regenerate with a bigger docker_ports_range_spare_ratio.")
 
-        try:
-            sock.connect(("1.1.1.1", 80))
-            ip = sock.getsockname()[0]
-        except Exception as e:
-            raise ValueError("[-] Cannot get server public ip address!")
-        finally:
-            sock.close()
+                port = store.get_block_allocator(shard).allocate()
+            else:
+                shard = pick_least_loaded_shard(shard_loads)
+                port = generate_random_port(tmpdir=tmpdir)
 
-        return ip
-    
-    server_public_ip = get_server_public_ip()
-    xray_config = parse_xray_config(tmpdir=tmpdir)
+            shard_loads[shard] += 1
+
+            inbound = generate_inbound_record(config, engine, tag=f"{engine.name}-{len(store.inbounds) + 1}", port=port, shard=shard) # because it's starts from zero
+
+            for protocol in inbound.transport_protocols:
+                store.add_used_port(port, protocol)
+
+            store.append(inbound)
+            added.append((None, inbound))
+
+        touched_shards = sorted({inbound.shard for _, inbound in added})
+        store.commit(docker_compose=render_docker_compose(config=config, tmpdir=tmpdir, store=store), shards=touched_shards)
 
-    if xray_config is None or server_public_ip is None:
+    return added
+
+def reconcile_used_ports(config, tmpdir):
+    """
+    Rebuilds the used-port index (used_ports.txt, compose ports and the allocator) from the live inbound list.
+    """
+
+    store = get_state_store(tmpdir)
+
+    if store is None:
         return
 
-    def get_shadowsocks_inbound_instance_config():
-        
-        def refactor_mode_parameter(xray_shadowsocks_inbound_method):
-        
-            if xray_shadowsocks_inbound_method in ("tcp,udp", "udp,tcp"):
-                shadowsocks_mode_parameter = "tcp_and_udp"
-        
-            if xray_shadowsocks_inbound_method == "tcp":
-                shadowsocks_mode_parameter = "tcp_only"
-        
-            if xray_shadowsocks_inbound_method == "udp":
-                shadowsocks_mode_parameter = "udp_only"
-
-            return shadowsocks_mode_parameter
-
-        shadowsocks_config = {
-            "server": server_public_ip,
-            "server_port": xray_config["inbounds"][instance_num]["port"],
-            "method": xray_config["inbounds"][instance_num]["settings"]["method"],
-            "password": xray_config["inbounds"][instance_num]["settings"]["password"],
-            "mode": refactor_mode_parameter(xray_config["inbounds"][instance_num]["settings"]["network"]),
-            "local_address": "127.0.0.1",
-            "local_port": "1080"
-        }
+    with store.lock:
+        store.rebuild_used_ports()
+        store.commit(docker_compose=render_docker_compose(config=config, tmpdir=tmpdir, store=store))
 
-        return shadowsocks_config
+        # the allocator re-reads the compacted used_ports.txt on next use
+        reset_port_allocator(tmpdir)
 
-    if xray_config["inbounds"][instance_num]["protocol"] == "shadowsocks":
-        inbound_instance_config = get_shadowsocks_inbound_instance_config()
-    else:
-        raise ValueError("[-] ... something went wrong. Honestly, I don't really know what exactly.")
+def apply_xray_inbound_instances_live(config, tmpdir, refurbished):
+    """
+    Hot-swaps refurbished (and adds new) inbounds through the xray api of their shard.
+    Takes (old_inbound, inbound) pairs, old_inbound is None for a new instance.
+    Returns the service names that still have to be recreated.
+    """
+
+    store = get_state_store(tmpdir)
+    services_to_recreate = set()
+    services_applied_live = set()
+
+    for old_inbound, inbound in refurbished:
+
+        service = get_shard_service_name(store.shards_count, inbound.shard)
+        old_service = get_shard_service_name(store.shards_count, old_inbound.shard) if old_inbound is not None else service
+
+        port_is_published = (old_inbound is not None and inbound.port == old_inbound.port) or is_port_published(config, store, inbound.shard, inbound.port)
+
+        # a port that isn't published by this container yet needs a new container anyway, the api can't help with that
+        if is_xray_api_enabled(config) and port_is_published and service == old_service and service not in services_to_recreate:
+            try:
+                if old_inbound is None:
+                    insert_inbound(config, tmpdir, store.render_inbound_object(inbound), shard=inbound.shard, shards_count=store.shards_count)
+                else:
+                    replace_inbound(config, tmpdir, inbound.tag, store.render_inbound_object(inbound), shard=inbound.shard, shards_count=store.shards_count)
+
+                services_applied_live.add(service)
+                continue
+            except XrayApiError as e:
+                print(f"{e} Falling back to container recreate.")
+
+        services_to_recreate.update((old_service, service))
+
+    mark_config_applied(tmpdir, services_applied_live - services_to_recreate)
+
+    return sorted(services_to_recreate)
+
+def set_xray_log_level(config, tmpdir, loglevel):
+    """
+    Writes the new level into every shard config. The containers pick it up on their next restart.
+    Returns False if the configs already had this level.
+    """
+
+    if loglevel not in XRAY_LOG_LEVELS:
+        raise ValueError(f"[-] Unknown xray log level {loglevel}, use one of: {', '.join(XRAY_LOG_LEVELS)}!")
+
+    store = get_state_store(tmpdir)
+
+    with store.lock:
+        if store.xray_config["log"]["loglevel"] == loglevel:
+            return False
+
+        store.xray_config["log"] = dict(store.xray_config["log"], loglevel=loglevel)
+        store.commit()
+
+    return True
+
+def get_xray_log_level(config, tmpdir):
+
+    store = get_state_store(tmpdir)
+
+    if store is not None:
+        return store.xray_config["log"]["loglevel"]
+
+def sync_xray_log_settings(config, tmpdir):
+    """
+    A reused state keeps the log section it was generated with - settings.json wins on boot,
+    a level switched at runtime only lasts until the next start.
+    """
+
+    store = get_state_store(tmpdir)
+    log_object = generate_xray_log_object(config)
+
+    with store.lock:
+        if store.xray_config.get("log") == log_object:
+            return False
+
+        store.xray_config["log"] = log_object
+        store.commit()
+
+    return True
+
+def sync_xray_api_settings(config, tmpdir):
+    """
+    The api, stats and policy sections don't touch any credential or port, so a reused state
+    simply gets them rebuilt from settings.json when xray_api_enabled or metrics changed.
+    """
+
+    store = get_state_store(tmpdir)
+
+    with store.lock:
+        xray_config = {key: value for key, value in store.xray_config.items() if key not in ("stats", "policy")}
+
+        if is_metrics_enabled(config):
+            xray_config.update(generate_xray_stats_objects())
+
+        shard_overrides = []
+
+        for shard, shard_override in enumerate(store.shard_overrides):
+            shard_override = {key: value for key, value in shard_override.items() if key != "api"}
+
+            if is_xray_api_enabled(config):
+                shard_override["api"] = generate_xray_api_object(config, shard=shard)
+
+            shard_overrides.append(shard_override)
+
+        if xray_config == store.xray_config and shard_overrides == store.shard_overrides:
+            return False
+
+        store.xray_config = xray_config
+        store.shard_overrides = shard_overrides
+        store.commit()
+
+    return True
+
+def get_multi_user_store(tmpdir):
+
+    store = get_state_store(tmpdir)
+
+    if store is not None and not store.multi_user:
+        raise ValueError("[-] Users only exist in multi-user mode (\"xray_inbound_multi_user\" in settings.json)!")
+
+    return store
+
+def list_xray_users(config, tmpdir):
+
+    store = get_multi_user_store(tmpdir)
+
+    if store is not None:
+        return store.list_user_tags()
+
+def count_xray_listener_users(config, tmpdir):
+    """
+    {listener tag: users count}.
+    """
+
+    store = get_multi_user_store(tmpdir)
+
+    if store is not None:
+        return {tag: len(users) for tag, users in store.group_users().items()}
+
+def get_xray_users_version(config, tmpdir):
+    """
+    Changes whenever a user is added, refurbished or revoked - a cache key for anything rendered from the users.
+    """
+
+    store = get_state_store(tmpdir)
+
+    if store is not None:
+        return store.store_id, store.users_version
+
+def get_users_shards(store, changed):
+    return sorted({store.get_inbound_by_tag(user.inbound_tag).shard for pair in changed for user in pair if user is not None})
+
+def add_xray_users(config, tmpdir, count):
+    """
+    Adds count users, each to the listener with the fewest users. No port changes - only the configs
+    of the touched shards are rewritten. Returns a list of (None, user), the shape refurbish and revoke return too.
+    """
+
+    store = get_multi_user_store(tmpdir)
+
+    if store is None:
+        return []
+
+    added = []
+
+    with store.lock:
+        inbounds_by_tag = {inbound.tag: inbound for inbound in store.inbounds}
+        listener_loads = {tag: len(users) for tag, users in store.group_users().items()}
+
+        # revoked users leave gaps, their tags are never handed out again
+        next_user_num = store.last_user_num + 1
+
+        for user_num in range(next_user_num, next_user_num + count):
+            inbound = inbounds_by_tag[min(listener_loads, key=listener_loads.get)]
+            listener_loads[inbound.tag] += 1
+
+            user = generate_user_record(get_inbound_engine(inbound), inbound, tag=f"user-{user_num}")
+
+            store.append_user(user)
+            added.append((None, user))
+
+        store.commit(shards=get_users_shards(store, added))
+
+    return added
+
+def refurbish_xray_users(config, tmpdir, user_tags):
+    """
+    New credentials for the users, they keep their tag and listener. Returns a list of (old_user, user).
+    """
+
+    store = get_multi_user_store(tmpdir)
+
+    if store is None:
+        return []
+
+    refurbished = []
+
+    with store.lock:
+        for user_num in store.find_user_nums(list(dict.fromkeys(user_tags))):
+            old_user = store.get_user(user_num)
+            inbound = store.get_inbound_by_tag(old_user.inbound_tag)
+
+            user = generate_user_record(get_inbound_engine(inbound), inbound, tag=old_user.tag)
 
-    return inbound_instance_config
+            store.replace_user(user_num, user)
+            refurbished.append((old_user, user))
+
+        store.commit(shards=get_users_shards(store, refurbished))
+
+    return refurbished
+
+def revoke_xray_users(config, tmpdir, user_tags):
+    """
+    Removes the users for good. Returns a list of (user, None).
+    """
+
+    store = get_multi_user_store(tmpdir)
+
+    if store is None:
+        return []
+
+    with store.lock:
+        user_nums = store.find_user_nums(list(dict.fromkeys(user_tags)))
+        revoked = [(store.get_user(user_num), None) for user_num in user_nums]
+
+        store.remove_users(user_nums)
+        store.commit(shards=get_users_shards(store, revoked))
+
+    return revoked
+
+def apply_xray_users_live(config, tmpdir, changes):
+    """
+    Applies (old_user, user) changes to the running listeners through the xray api of their shard:
+    old users are removed, new ones added - one call of each per listener, every other user stays connected.
+    Returns the service names that still have to be restarted to pick up their config.
+    """
+
+    store = get_state_store(tmpdir)
+
+    emails_to_remove = {}
+    users_to_add = {}
+
+    for old_user, user in changes:
+        if old_user is not None:
+            emails_to_remove.setdefault(old_user.inbound_tag, []).append(old_user.tag)
+
+        if user is not None:
+            users_to_add.setdefault(user.inbound_tag, []).append(user)
+
+    services_to_restart = set()
+    services_applied_live = set()
+
+    for inbound_tag in dict.fromkeys([*emails_to_remove, *users_to_add]):
+        inbound = store.get_inbound_by_tag(inbound_tag)
+        service = get_shard_service_name(store.shards_count, inbound.shard)
+
+        if is_xray_api_enabled(config) and service not in services_to_restart:
+            try:
+                if inbound_tag in emails_to_remove:
+                    remove_users(config, tmpdir, inbound_tag, emails_to_remove[inbound_tag], shard=inbound.shard, shards_count=store.shards_count)
+
+                if inbound_tag in users_to_add:
+                    users_object = get_inbound_engine(inbound).render_users_object(inbound, users_to_add[inbound_tag])
+                    add_users(config, tmpdir, users_object, shard=inbound.shard, shards_count=store.shards_count)
+
+                services_applied_live.add(service)
+                continue
+            except XrayApiError as e:
+                print(f"{e} Falling back to container restart.")
+
+        services_to_restart.add(service)
+
+    mark_config_applied(tmpdir, services_applied_live - services_to_restart)
+
+    return sorted(services_to_restart)
+
+def get_xray_inbound_instances_version(config, tmpdir):
+    """
+    Changes whenever the list of inbound tags changes - a cache key for anything rendered from it.
+    """
+
+    store = get_state_store(tmpdir)
+
+    if store is not None:
+        return store.store_id, store.tags_version
+
+def list_xray_shard_instances(config, tmpdir, shard):
+
+    store = get_state_store(tmpdir)
+
+    if store is not None:
+        return [instance_num for instance_num, inbound in enumerate(store.inbounds) if inbound.shard == shard]
+
+def get_xray_shards_count(config, tmpdir):
+
+    store = get_state_store(tmpdir)
+
+    if store is not None:
+        return store.shards_count
+
+# the address only changes when the host is moved, no need to probe it for every single request
+SERVER_PUBLIC_IP_TTL = 300
+
+_server_public_ip = {"ip": None, "resolved_at": 0.0}
+
+def get_server_public_ip(config=None):
+
+    # behind nat the outgoing interface address is a private one - settings can name the right address
+    if config is not None and config.get("server_public_address"):
+        return config["server_public_address"]
+
+    if _server_public_ip["ip"] is not None and time.monotonic() - _server_public_ip["resolved_at"] < SERVER_PUBLIC_IP_TTL:
+        return _server_public_ip["ip"]
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    try:
+        sock.connect(("1.1.1.1", 80))
+        ip = sock.getsockname()[0]
+    except Exception as e:
+        raise ValueError("[-] Cannot get server public ip address!")
+    finally:
+        sock.close()
+
+    _server_public_ip["ip"] = ip
+    _server_public_ip["resolved_at"] = time.monotonic()
+
+    return ip
+
+def render_inbound_client_config(inbound, server_public_ip, user=None):
+    return get_inbound_engine(inbound).render_client_config(inbound, server_public_ip, user=user)
+
+def request_config_for_xray_inbound_instance(config, tmpdir, instance_num):
+    
+    server_public_ip = get_server_public_ip(config)
+    store = get_state_store(tmpdir)
+
+    if store is None or server_public_ip is None:
+        return
+
+    return render_inbound_client_config(store.get(instance_num), server_public_ip)
 
 def request_instance_protocol(config, tmpdir, instance_num):
 
-    xray_config = parse_xray_config(tmpdir=tmpdir)
+    store = get_state_store(tmpdir)
 
-    if xray_config is not None:
-        return xray_config["inbounds"][instance_num]["protocol"]
+    if store is not None:
+        return store.get(instance_num).protocol
     else:
         return None
 
 def request_instance_tag(config, tmpdir, instance_num):
 
-    xray_config = parse_xray_config(tmpdir=tmpdir)
+    store = get_state_store(tmpdir)
 
-    if xray_config is not None:
-        return xray_config["inbounds"][instance_num]["tag"]
+    if store is not None:
+        return store.get(instance_num).tag
     else:
         return None
 
 def remove_content_of_tmpdir(tmpdir):
 
+    # used_ports.txt and config.json are gone after this, so the in-memory copies have to go as well
+    reset_port_allocator(tmpdir)
+    reset_state_store(tmpdir)
+
     for item in Path(tmpdir).iterdir():
         if item.is_file() or item.is_symlink():
             item.unlink()
 
         if item.is_dir():
-            shutil.rmtree(item)
\ No newline at end of file
+            shutil.rmtree(item)
+
+def count_established_connections(tmpdir, service, ports):
+    """
+    Counts established tcp connections per local port inside a container, straight from the
+    kernel's tables in /proc/<container pid>/net (the xray image has no shell to run anything in).
+    """
+
+    container_id = subprocess.run(["docker", "compose", "ps", "-q", service], check=True, cwd=tmpdir, capture_output=True, text=True).stdout.strip()
+
+    connections = dict.fromkeys(ports, 0)
+
+    if not container_id:
+        return connections
+
+    container_pid = subprocess.run(["docker", "inspect", "-f", "{{.State.Pid}}", container_id], check=True, capture_output=True, text=True).stdout.strip()
+
+    for table in ("tcp", "tcp6"):
+        if not Path(f"/proc/{container_pid}/net/{table}").exists():
+            continue
+
+        with open(f"/proc/{container_pid}/net/{table}") as f:
+            next(f) # header
+
+            for line in f:
+                fields = line.split()
+                local_port = int(fields[1].rsplit(":", 1)[1], 16)
+
+                # "01" is TCP_ESTABLISHED
+                if fields[3] == "01" and local_port in connections:
+                    connections[local_port] += 1
+
+    return connections
+
+def collect_xray_inbound_stats(config, tmpdir):
+    """
+    Returns ({tag: {"uplink": bytes, "downlink": bytes}}, {tag: established tcp connections}) over all shards.
+    """
+
+    store = get_state_store(tmpdir)
+
+    if store is None:
+        return {}, {}
+
+    inbound_traffic = {}
+    inbound_connections = {}
+
+    for shard in range(store.shards_count):
+        inbound_traffic.update(query_inbound_traffic(config, tmpdir, shard=shard, shards_count=store.shards_count))
+
+        shard_inbounds = store.shard_inbounds(shard)
+        port_connections = count_established_connections(tmpdir, get_shard_service_name(store.shards_count, shard), [inbound.port for inbound in shard_inbounds])
+
+        for inbound in shard_inbounds:
+            inbound_connections[inbound.tag] = port_connections.get(inbound.port, 0)
+
+    return inbound_traffic, inbound_connections
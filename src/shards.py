@@ -0,0 +1,68 @@
+import os
+
+def get_shards_settings(config):
+    return config.get("xray_shards") or {}
+
+def get_shards_count(config, instances_count):
+    """
+    "count" is either a number or "auto" (one shard per cpu core).
+    There is never more shards than instances and never less than one.
+    """
+
+    shards_count = get_shards_settings(config).get("count", 1)
+
+    if shards_count == "auto":
+        shards_count = os.cpu_count() or 1
+
+    return max(1, min(int(shards_count), instances_count))
+
+def get_shard_cpusets(config, shards_count):
+    """
+    Returns a cpuset string (e.g. "0-1") per shard, or None per shard if cpu pinning is disabled.
+    Explicit "cpusets" from settings win, otherwise the host cores are split into equal contiguous blocks.
+    """
+
+    shards_settings = get_shards_settings(config)
+
+    if shards_count == 1 and not shards_settings.get("cpusets"):
+        return [None]
+
+    if shards_settings.get("cpusets"):
+        cpusets = list(shards_settings["cpusets"])
+        if len(cpusets) < shards_count:
+            raise ValueError(f"[-] xray shards: {shards_count} shards but only {len(cpusets)} cpusets given!")
+        return cpusets[:shards_count]
+
+    if not shards_settings.get("pin_cpus", True):
+        return [None] * shards_count
+
+    cpus_count = os.cpu_count() or 1
+    cpusets = []
+
+    for shard in range(shards_count):
+        first_cpu = shard * cpus_count // shards_count
+        last_cpu = max(first_cpu, (shard + 1) * cpus_count // shards_count - 1) % cpus_count
+        cpusets.append(f"{first_cpu}" if first_cpu == last_cpu else f"{first_cpu}-{last_cpu}")
+
+    return cpusets
+
+# a single shard keeps the old names, so existing deployments see no difference
+
+def get_shard_service_name(shards_count, shard):
+    return "xray-core" if shards_count == 1 else f"xray-core-{shard + 1}"
+
+def get_shard_config_filename(shards_count, shard):
+    return "config.json" if shards_count == 1 else f"config-{shard + 1}.json"
+
+def pick_least_loaded_shard(shard_loads, current_shard=None):
+    """
+    Index of the shard with the fewest inbounds.
+    The current shard is kept unless moving away actually evens the load out.
+    """
+
+    least_loaded_shard = min(range(len(shard_loads)), key=lambda shard: shard_loads[shard])
+
+    if current_shard is not None and shard_loads[current_shard] - 1 <= shard_loads[least_loaded_shard]:
+        return current_shard
+
+    return least_loaded_shard
@@ -0,0 +1,542 @@
+import itertools
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import yaml
+
+from pathlib import Path
+
+from metrics import timed
+from ports import PortAllocator, read_port_blocks_file
+from protocols import get_engine_for, get_inbound_engine
+from shards import get_shard_config_filename
+
+# parts of the xray config that differ between shards (e.g. the api port in host network mode)
+SHARD_SPECIFIC_KEYS = ("api",)
+
+# bumped whenever state.json / inbounds.tsv change in a way older code can't read
+STATE_FORMAT_VERSION = 1
+
+class InboundRecord:
+    """
+    One xray inbound, kept as a compact record instead of a nested dict.
+    The protocol engine (protocols.py) turns it into an inbound object and back -
+    "password" is whatever credential the protocol has (a shadowsocks key, a vless uuid).
+    """
+
+    __slots__ = ("tag", "protocol", "port", "listen", "method", "network", "password", "shard")
+
+    def __init__(self, tag:str, protocol:str, port:int, listen:str, method:str, network:str, password:str, shard:int = 0):
+        self.tag = tag
+        self.protocol = protocol
+        self.port = port
+        self.listen = listen
+        self.method = method
+        self.network = network
+        self.password = password
+        self.shard = shard
+
+    @classmethod
+    def from_inbound_object(cls, inbound_object, shard=0):
+        engine = get_engine_for(inbound_object["protocol"], inbound_object.get("settings", {}).get("method", ""))
+        method, network, password = engine.parse_inbound_object(inbound_object)
+
+        return cls(
+            tag=inbound_object["tag"],
+            protocol=inbound_object["protocol"],
+            port=inbound_object["port"],
+            listen=inbound_object.get("listen", "0.0.0.0"),
+            method=method,
+            network=network,
+            password=password,
+            shard=shard
+        )
+
+    def to_inbound_object(self, users=None):
+        return get_inbound_engine(self).render_inbound_object(self, users=users)
+
+    @classmethod
+    def from_row(cls, row):
+        tag, protocol, port, listen, method, network, password, shard = row.rstrip("\n").split("\t")
+        return cls(tag, protocol, int(port), listen, method, network, password, int(shard))
+
+    def to_row(self):
+        return f"{self.tag}\t{self.protocol}\t{self.port}\t{self.listen}\t{self.method}\t{self.network}\t{self.password}\t{self.shard}\n"
+
+    @property
+    def transport_protocols(self):
+        return [protocol for protocol in ("tcp", "udp") if protocol in self.network.split(",")]
+
+class UserRecord:
+    """
+    One credential on a multi-user listener (the inbound tagged inbound_tag). The tag is the user's "email" in xray.
+    """
+
+    __slots__ = ("tag", "inbound_tag", "password")
+
+    def __init__(self, tag:str, inbound_tag:str, password:str):
+        self.tag = tag
+        self.inbound_tag = inbound_tag
+        self.password = password
+
+    @classmethod
+    def from_row(cls, row):
+        tag, inbound_tag, password = row.rstrip("\n").split("\t")
+        return cls(tag, inbound_tag, password)
+
+    def to_row(self):
+        return f"{self.tag}\t{self.inbound_tag}\t{self.password}\n"
+
+_store_ids = itertools.count()
+
+class StateStore:
+    """
+    Single in-memory copy of everything generated for a tmpdir.
+
+    All reads are served from memory. commit() writes config.json, used_ports.txt and
+    docker-compose.yml in one batch, each file through temp file + fsync + rename, under
+    a lock - so concurrent handlers never see (or produce) a half-written file.
+
+    With sharding every shard gets its own config-<n>.json, instance numbers stay global.
+
+    In multi-user mode the inbounds are a few listeners and the users (users.tsv) are spread over them,
+    every listener is rendered with its users as clients.
+
+    The state itself is kept in state.json (format version, shared xray config, per shard parts)
+    and inbounds.tsv (a line per inbound record), the xray configs are rendered from them.
+    Loading those is much cheaper than parsing the xray configs back.
+    """
+
+    def __init__(self, tmpdir, xray_config, inbounds, used_ports=(), shards_count=1, shard_overrides=None, port_blocks=(), users=None, last_user_num=None, created_at=None):
+        self.tmpdir = tmpdir
+        self.lock = threading.RLock()
+        self.shards_count = shards_count
+
+        # everything except "inbounds" (kept as records) and the per shard parts
+        self.xray_config = {key: value for key, value in xray_config.items() if key != "inbounds" and key not in SHARD_SPECIFIC_KEYS}
+        self.shard_overrides = shard_overrides or [{} for _ in range(shards_count)]
+        self.inbounds = list(inbounds)
+        self.used_ports = list(used_ports)
+
+        # None unless the store is in multi-user mode
+        self.users = list(users) if users is not None else None
+
+        # the highest "user-<n>" ever handed out - revoked users leave gaps, their tags are never handed out again
+        if last_user_num is None:
+            last_user_num = max((int(user.tag.rsplit("-", 1)[1]) for user in self.users or ()), default=0)
+
+        self.last_user_num = last_user_num
+
+        # tag (of an inbound or a user) -> when its credential was generated, the age rotation goes by.
+        # Kept in state.json, so a restart of the process doesn't make everything new again
+        now = time.time()
+        created_at = created_at or {}
+        self.created_at = {tag: created_at.get(tag, now) for tag in self.list_credential_tags()}
+
+        # (shard, first_port, last_port) ranges published in "ranges" mode, with a port allocator per shard on top
+        self.port_blocks = list(port_blocks)
+        self._block_allocators = {}
+
+        # bumped on every change of the inbound set, for anything cached on top of the store.
+        # tags_version only moves when the list of tags changes (a refurbish keeps the tag)
+        self.store_id = next(_store_ids)
+        self.version = 0
+        self.tags_version = 0
+        self.users_version = 0
+
+    @property
+    def multi_user(self):
+        return self.users is not None
+
+    @classmethod
+    def load(cls, tmpdir):
+        if Path(f"{tmpdir}/state.json").exists():
+            return cls.load_state(tmpdir)
+
+        # tmpdirs written before state.json existed
+        if Path(f"{tmpdir}/config.json").exists():
+            shard_config_paths = [Path(f"{tmpdir}/config.json")]
+        else:
+            shard_config_paths = sorted(
+                Path(tmpdir).glob("config-*.json"),
+                key=lambda path: int(re.search(r"config-(\d+)\.json$", path.name).group(1))
+            )
+
+        if not shard_config_paths or any(path.stat().st_size == 0 for path in shard_config_paths):
+            return None
+
+        inbounds = []
+        shard_overrides = []
+
+        for shard, shard_config_path in enumerate(shard_config_paths):
+            with open(shard_config_path) as f:
+                xray_config = json.load(f)
+
+            inbounds.extend(InboundRecord.from_inbound_object(inbound_object, shard=shard) for inbound_object in xray_config["inbounds"])
+            shard_overrides.append({key: xray_config[key] for key in SHARD_SPECIFIC_KEYS if key in xray_config})
+
+        port_blocks = read_port_blocks_file(f"{tmpdir}/port_blocks.txt") if Path(f"{tmpdir}/port_blocks.txt").exists() else []
+
+        store = cls(
+            tmpdir=tmpdir,
+            xray_config=xray_config,
+            inbounds=inbounds,
+            shards_count=len(shard_config_paths),
+            shard_overrides=shard_overrides,
+            port_blocks=port_blocks
+        )
+
+        store.load_used_ports()
+
+        return store
+
+    @classmethod
+    def load_state(cls, tmpdir):
+
+        with open(f"{tmpdir}/state.json") as f:
+            state = json.load(f)
+
+        if state.get("version") != STATE_FORMAT_VERSION:
+            raise ValueError(f"[-] {tmpdir}: state format version {state.get('version')} is not supported, expected {STATE_FORMAT_VERSION}!")
+
+        with open(f"{tmpdir}/inbounds.tsv") as f:
+            inbounds = [InboundRecord.from_row(row) for row in f if row.strip()]
+
+        shards_count = state["shards_count"]
+
+        if len(state["shard_overrides"]) != shards_count or any(not 0 <= inbound.shard < shards_count for inbound in inbounds):
+            raise ValueError(f"[-] {tmpdir}: inbounds.tsv doesn't match the shards in state.json!")
+
+        if len({inbound.tag for inbound in inbounds}) != len(inbounds):
+            raise ValueError(f"[-] {tmpdir}: inbounds.tsv has duplicate tags!")
+
+        users = None
+
+        if state.get("multi_user", False):
+            with open(f"{tmpdir}/users.tsv") as f:
+                users = [UserRecord.from_row(row) for row in f if row.strip()]
+
+            inbound_tags = {inbound.tag for inbound in inbounds}
+
+            if any(user.inbound_tag not in inbound_tags for user in users):
+                raise ValueError(f"[-] {tmpdir}: users.tsv has users of listeners that don't exist!")
+
+        port_blocks = read_port_blocks_file(f"{tmpdir}/port_blocks.txt") if Path(f"{tmpdir}/port_blocks.txt").exists() else []
+
+        store = cls(
+            tmpdir=tmpdir,
+            xray_config=state["xray_config"],
+            inbounds=inbounds,
+            shards_count=shards_count,
+            shard_overrides=state["shard_overrides"],
+            port_blocks=port_blocks,
+            users=users,
+            last_user_num=state.get("last_user_num"),
+            created_at=state.get("created_at")
+        )
+
+        store.load_used_ports()
+
+        # the xray configs are derived, a missing one is simply rendered again
+        if any(not Path(f"{tmpdir}/{get_shard_config_filename(shards_count, shard)}").exists() for shard in range(shards_count)):
+            store.commit()
+
+        return store
+
+    def load_used_ports(self):
+
+        if Path(f"{self.tmpdir}/used_ports.txt").exists():
+            with open(f"{self.tmpdir}/used_ports.txt") as f:
+                for line in f:
+                    if line.strip():
+                        port, protocol = line.strip().split(":")
+                        self.used_ports.append((int(port), protocol))
+
+        # used_ports.txt written by older versions keeps every port ever handed out
+        if set(self.used_ports) != set(self.live_used_ports()):
+            self.rebuild_used_ports()
+
+    def list_tags(self):
+        with self.lock:
+            return {num: inbound.tag for num, inbound in enumerate(self.inbounds)}
+
+    def list_credential_tags(self):
+        """
+        Tags of everything that carries a credential - the inbounds, and the users in multi-user mode.
+        """
+
+        with self.lock:
+            return [inbound.tag for inbound in self.inbounds] + [user.tag for user in self.users or ()]
+
+    def find_instance_nums(self, tags):
+        """
+        Numbers of the inbounds with these tags, tags that no longer exist are skipped.
+        """
+
+        with self.lock:
+            instance_nums_by_tag = {inbound.tag: instance_num for instance_num, inbound in enumerate(self.inbounds)}
+            return [instance_nums_by_tag[tag] for tag in tags if tag in instance_nums_by_tag]
+
+    def get(self, instance_num):
+        with self.lock:
+            return self.inbounds[instance_num]
+
+    def replace(self, instance_num, inbound):
+        with self.lock:
+            if self.inbounds[instance_num].tag != inbound.tag:
+                self.tags_version += 1
+                self.created_at.pop(self.inbounds[instance_num].tag, None)
+
+            self.inbounds[instance_num] = inbound
+            self.created_at[inbound.tag] = time.time()
+            self.version += 1
+
+    def append(self, inbound):
+        """
+        Returns the instance number of the new inbound.
+        """
+
+        with self.lock:
+            self.inbounds.append(inbound)
+            self.created_at[inbound.tag] = time.time()
+            self.tags_version += 1
+            self.version += 1
+            return len(self.inbounds) - 1
+
+    def get_inbound_by_tag(self, tag):
+        with self.lock:
+            for inbound in self.inbounds:
+                if inbound.tag == tag:
+                    return inbound
+
+    def list_user_tags(self):
+        with self.lock:
+            return {num: user.tag for num, user in enumerate(self.users)}
+
+    def get_user(self, user_num):
+        with self.lock:
+            return self.users[user_num]
+
+    def find_user_nums(self, user_tags):
+        """
+        Users are addressed by tag - their numbers shift whenever someone is revoked.
+        """
+
+        with self.lock:
+            user_nums_by_tag = {user.tag: user_num for user_num, user in enumerate(self.users)}
+
+            for user_tag in user_tags:
+                if user_tag not in user_nums_by_tag:
+                    raise ValueError(f"[-] There is no user {user_tag}!")
+
+            return [user_nums_by_tag[user_tag] for user_tag in user_tags]
+
+    def replace_user(self, user_num, user):
+        with self.lock:
+            self.users[user_num] = user
+            self.created_at[user.tag] = time.time()
+            self.users_version += 1
+
+    def append_user(self, user):
+        """
+        Returns the number of the new user.
+        """
+
+        with self.lock:
+            self.users.append(user)
+            self.created_at[user.tag] = time.time()
+            self.last_user_num = max(self.last_user_num, int(user.tag.rsplit("-", 1)[1]))
+            self.users_version += 1
+            return len(self.users) - 1
+
+    def remove_users(self, user_nums):
+        """
+        The users behind them shift down.
+        """
+
+        with self.lock:
+            user_nums = set(user_nums)
+
+            for user_num in user_nums:
+                self.created_at.pop(self.users[user_num].tag, None)
+
+            self.users = [user for user_num, user in enumerate(self.users) if user_num not in user_nums]
+            self.users_version += 1
+
+    def group_users(self):
+        """
+        {inbound tag: [users]} with an entry for every listener, even one without users.
+        """
+
+        with self.lock:
+            users_by_inbound = {inbound.tag: [] for inbound in self.inbounds}
+            for user in self.users:
+                users_by_inbound[user.inbound_tag].append(user)
+            return users_by_inbound
+
+    def render_inbound_object(self, inbound, users_by_inbound=None):
+        with self.lock:
+            if not self.multi_user:
+                return inbound.to_inbound_object()
+
+            if users_by_inbound is None:
+                users_by_inbound = self.group_users()
+
+            return inbound.to_inbound_object(users=users_by_inbound[inbound.tag])
+
+    def shard_loads(self):
+        with self.lock:
+            shard_loads = [0] * self.shards_count
+            for inbound in self.inbounds:
+                shard_loads[inbound.shard] += 1
+            return shard_loads
+
+    def shard_inbounds(self, shard):
+        with self.lock:
+            return [inbound for inbound in self.inbounds if inbound.shard == shard]
+
+    def get_block_allocator(self, shard):
+        """
+        Allocator over the published port blocks of a shard, ports of the shard's live inbounds are taken.
+        """
+
+        with self.lock:
+            if shard not in self._block_allocators:
+                self._block_allocators[shard] = PortAllocator(
+                    candidate_ports=[
+                        port
+                        for block_shard, first_port, last_port in self.port_blocks if block_shard == shard
+                        for port in range(first_port, last_port + 1)
+                    ],
+                    used_ports=[inbound.port for inbound in self.inbounds if inbound.shard == shard]
+                )
+            return self._block_allocators[shard]
+
+    def add_used_port(self, port, protocol):
+        with self.lock:
+            self.used_ports.append((port, protocol))
+
+    def release_used_port(self, port):
+        with self.lock:
+            self.used_ports = [(used_port, protocol) for used_port, protocol in self.used_ports if used_port != port]
+
+    def live_used_ports(self):
+        with self.lock:
+            return [(inbound.port, protocol) for inbound in self.inbounds for protocol in inbound.transport_protocols]
+
+    def rebuild_used_ports(self):
+        with self.lock:
+            self.used_ports = self.live_used_ports()
+
+    def render_xray_config(self, shard=0):
+        with self.lock:
+            xray_config = dict(self.xray_config)
+            xray_config.update(self.shard_overrides[shard])
+            users_by_inbound = self.group_users() if self.multi_user else None
+            xray_config["inbounds"] = [self.render_inbound_object(inbound, users_by_inbound) for inbound in self.shard_inbounds(shard)]
+            return xray_config
+
+    def render_used_ports(self):
+        with self.lock:
+            return "".join(f"{port}:{protocol}\n" for port, protocol in self.used_ports)
+
+    def render_inbounds(self):
+        with self.lock:
+            return "".join(inbound.to_row() for inbound in self.inbounds)
+
+    def render_users(self):
+        with self.lock:
+            return "".join(user.to_row() for user in self.users)
+
+    def render_state(self):
+        with self.lock:
+            return {
+                "version": STATE_FORMAT_VERSION,
+                "shards_count": self.shards_count,
+                "multi_user": self.multi_user,
+                "last_user_num": self.last_user_num,
+                "created_at": self.created_at,
+                "xray_config": self.xray_config,
+                "shard_overrides": self.shard_overrides
+            }
+
+    def render_port_blocks(self):
+        with self.lock:
+            return "".join(f"{shard}:{first_port}-{last_port}\n" for shard, first_port, last_port in self.port_blocks)
+
+    def commit(self, docker_compose=None, shards=None):
+        """
+        shards limits which shard configs are rewritten, by default all of them are.
+        """
+
+        with self.lock, timed("config_write"):
+            # the state goes first - the xray configs can always be rendered again from it
+            write_file_atomic(f"{self.tmpdir}/inbounds.tsv", self.render_inbounds())
+
+            if self.multi_user:
+                write_file_atomic(f"{self.tmpdir}/users.tsv", self.render_users())
+            write_file_atomic(f"{self.tmpdir}/state.json", json.dumps(self.render_state(), indent=4))
+
+            for shard in (range(self.shards_count) if shards is None else shards):
+                write_file_atomic(
+                    f"{self.tmpdir}/{get_shard_config_filename(self.shards_count, shard)}",
+                    json.dumps(self.render_xray_config(shard=shard), indent=4)
+                )
+
+            write_file_atomic(f"{self.tmpdir}/used_ports.txt", self.render_used_ports())
+
+            if self.port_blocks:
+                write_file_atomic(f"{self.tmpdir}/port_blocks.txt", self.render_port_blocks())
+
+            if docker_compose is not None:
+                write_file_atomic(f"{self.tmpdir}/docker-compose.yml", dump_docker_compose(docker_compose))
+
+# the compose file has a line per published port, libyaml is an order of magnitude faster on it
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+def dump_docker_compose(docker_compose):
+    return yaml.dump(docker_compose, Dumper=YAML_DUMPER, allow_unicode=True, sort_keys=False)
+
+def load_docker_compose(path):
+    with open(path) as f:
+        return yaml.load(f, Loader=YAML_LOADER)
+
+def write_file_atomic(path, content):
+
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.")
+
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # mkstemp creates 0600 files, the config is mounted into the container and must stay readable
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+_state_stores = {}
+_state_stores_lock = threading.Lock()
+
+def get_state_store(tmpdir):
+    with _state_stores_lock:
+        if _state_stores.get(tmpdir) is None:
+            _state_stores[tmpdir] = StateStore.load(tmpdir)
+        return _state_stores[tmpdir]
+
+def set_state_store(tmpdir, store):
+    with _state_stores_lock:
+        _state_stores[tmpdir] = store
+
+def reset_state_store(tmpdir):
+    with _state_stores_lock:
+        _state_stores.pop(tmpdir, None)
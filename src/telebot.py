@@ -1,62 +1,166 @@
 from telegram import Update, ForceReply, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import Application, CommandHandler, CallbackContext, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 
+import asyncio
 import json
 import io
+import signal
 import sys
-
-from services import (
-    generate_xray_config,
-    generate_docker_compose,
-    run_docker_compose,
-    stop_docker_compose,
-    remove_tmpdir,
-    clean_all,
-    refurbish_xray_inbound_intance,
-    request_config_for_xray_inbound_instance,
-    request_instance_protocol,
-    request_instance_tag,
-    list_xray_inbound_instances,
-    remove_content_of_tmpdir
+import time
+
+from async_services import (
+    run_blocking,
+    get_compose_lock,
+    stop_docker_compose_async,
+    restart_xray_core_async,
+    restart_xray_shard_async,
+    get_xray_shards_count_async,
+    refurbish_xray_inbound_instance_async,
+    request_artifacts_for_xray_inbound_instance_async,
+    export_xray_inbound_instances_async,
+    list_xray_inbound_instances_async,
+    get_top_inbounds_async,
+    set_xray_log_level_async,
+    get_xray_log_level_async,
+    change_xray_users_async,
+    refurbish_xray_user_async,
+    count_xray_listener_users_async,
+    request_artifacts_for_xray_user_async
 )
 
-def main(bot_token:str, users_whitelist:list, config, tmpdir):
-    
+from daemon import start_background_tasks
+from health import HealthProber, render_health_report
+from keyboards import get_inbounds_keyboard_page
+from metrics import metrics
+from protocols import is_multi_user_enabled
+from services import get_state_dir, remove_tmpdir
+from webhook import get_webhook_settings, is_webhook_enabled, resolve_webhook_secret_token, start_webhook_server
+from xray_api import XrayApiError
+from xray_logs import XRAY_LOG_LEVELS, is_access_log_tailer_enabled
+
+# the only update types with handlers - telegram doesn't have to send (or hold back) anything else
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+STATS_DEFAULT_TOP_COUNT = 10
+
+# up to this many new users are listed by tag after /au
+ADDED_USERS_MESSAGE_LIMIT = 50
+
+# up to this many uris are also sent as a plain message next to the archive
+EXPORT_MESSAGE_URIS_LIMIT = 20
+
+# telegram rate-limits message edits, so progress is sent at most once per interval
+PROGRESS_UPDATE_INTERVAL = 2.0
+PROGRESS_LINES = 10
+
+def build_handlers(users_whitelist:list, config, tmpdir):
+    """
+    Returns the command handlers ({command: callback}) and the callback query handlers ({pattern: callback}).
+    Kept apart from main(), so the handlers can be driven without a live bot (see benchmarks/).
+    """
+
+    # /gc and /rc hand out and reset users instead of whole inbounds when the listeners are shared
+    multi_user = is_multi_user_enabled(config)
+
+    # only reports on demand - refurbishing failing instances is left to the background prober
+    health_prober = HealthProber(config=dict(config, health=dict(config.get("health") or {}, auto_refurbish=False)), tmpdir=tmpdir)
+
+    def make_progress_reporter(message):
+
+        progress_lines = []
+        last_update = 0.0
+
+        async def report_progress(line):
+            nonlocal last_update
+
+            progress_lines.append(line)
+            del progress_lines[:-PROGRESS_LINES]
+
+            if time.monotonic() - last_update < PROGRESS_UPDATE_INTERVAL:
+                return
+
+            last_update = time.monotonic()
+
+            try:
+                await message.edit_text("\n".join(progress_lines))
+            except BadRequest:
+                pass # "message is not modified" and friends - progress is best effort
+
+        return report_progress
+
     async def help_command_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
         if update.message is not None and update.message.chat_id in users_whitelist:
-            
+
+            if multi_user:
+                instance_help_answer = (
+                    "/lc - list listeners and their users count\n",
+                    "/gc [filter] - get config for a user\n",
+                    "/rc [filter] - reset (refurbish) a user's credential\n",
+                    "/au [N] - add N users\n",
+                    "/ru [filter] - revoke a user\n",
+                )
+            else:
+                instance_help_answer = (
+                    "/restart <shard> - wipe only one xray-core shard (new credentials for all of its instances)\n",
+                    "/lc - list active inbound istances\n",
+                    "/gc [filter] - get config for an instance\n",
+                    "/rc [filter] - reset (refurbish) an instance\n",
+                )
+
             help_answer = (
                 "/help - show this message message\n",
                 "/restart - restart system and wipe all configs\n",
                 "/shutdown - shut down xray-cAD\n",
-                "/lc - list active inbound istances\n",
-                "/gc - get config for an instance\n",
-                "/rc - reset (refurbish) an instance",
+                *instance_help_answer,
+                "/export [filter] - download configs, share uris (ss://, vless://) and QR codes of all (or matching) instances\n",
+                "/stats [N] - show the N busiest instances\n",
+                "/health - probe every instance right now\n",
+                "/loglevel [level] - show or switch the xray-core log level (switching restarts every xray-core container and drops all connections)\n",
+                "/logstats [N] - show the N shards with the highest share of rejected connections (xray doesn't log which instance a reject was for)",
             )
-            
+
             await update.message.reply_text("".join(help_answer))
 
     async def restart_command_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
         if update.message is not None and update.message.chat_id in users_whitelist:
-            
-            await update.message.reply_text("Restarting... Cleaning old configs and restarting services.")
 
-            # some other functions except that EXCACTLY tmpdir (with it's unique name) exists - so it's can't be deleted.
-            remove_content_of_tmpdir(tmpdir=tmpdir)
+            if context.args:
+                if multi_user:
+                    await update.message.reply_text("A shard restart would break the configs of every user on it. Refurbish users with /rc, or /restart everything.")
+                    return
+
+                shards_count = await get_xray_shards_count_async(config=config, tmpdir=tmpdir) or 0
+
+                if not context.args[0].isdigit() or not 1 <= int(context.args[0]) <= shards_count:
+                    await update.message.reply_text(f"There is no such shard. Shards: 1-{shards_count}.")
+                    return
 
-            generate_xray_config(config=config, tmpdir=tmpdir)
-            generate_docker_compose(config=config, tmpdir=tmpdir)
+                shard = int(context.args[0]) - 1 # because it's starts from zero
 
-            stop_docker_compose(tmpdir)
-            run_docker_compose(tmpdir)
+                progress_message = await update.message.reply_text(f"Restarting shard {shard + 1}... Other shards keep serving.")
+                recreated = await restart_xray_shard_async(config=config, tmpdir=tmpdir, shard=shard, progress=make_progress_reporter(progress_message))
+
+                applied_answer = "Its container was recreated." if recreated else "Applied live, the container kept running."
+                await update.message.reply_text(f"Shard {shard + 1} restarted. {applied_answer} Its configs are wiped, request for new if needed.")
+                return
+
+            progress_message = await update.message.reply_text("Restarting... Cleaning old configs and restarting services.")
+
+            # some other functions except that EXCACTLY tmpdir (with it's unique name) exists - so it's can't be deleted.
+            await restart_xray_core_async(config=config, tmpdir=tmpdir, progress=make_progress_reporter(progress_message))
 
             await update.message.reply_text("Restart complete. All configs wiped. Request for new if needed.")
-   
+
     async def shutdown_command_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
         if update.message is not None and update.message.chat_id in users_whitelist:
 
-            stop_docker_compose(tmpdir)
-            remove_tmpdir(tmpdir)
+            async with get_compose_lock(tmpdir):
+                await stop_docker_compose_async(tmpdir)
+
+                # a persistent state dir outlives the shutdown, the next start serves the same configs
+                if get_state_dir(config) is None:
+                    await run_blocking(remove_tmpdir, tmpdir)
 
             await update.message.reply_text("Shutting down... Goodbye!")
 
@@ -65,103 +169,441 @@ def main(bot_token:str, users_whitelist:list, config, tmpdir):
     async def lc_command_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
         if update.message is not None and update.message.chat_id in users_whitelist:
 
-            xray_inbound_intances = list_xray_inbound_instances(config=config, tmpdir=tmpdir)
+            if multi_user:
+                listener_users = await count_xray_listener_users_async(config=config, tmpdir=tmpdir) or {}
+                listeners_str = "".join(f"{tag}: {users_count} users\n" for tag, users_count in listener_users.items())
+
+                await update.message.reply_text(f"Listeners ({sum(listener_users.values())} users):\n\n{listeners_str}")
+                return
+
+            xray_inbound_intances = await list_xray_inbound_instances_async(config=config, tmpdir=tmpdir)
+
+            if xray_inbound_intances is None:
+                await update.message.reply_text("Nothing is generated right now (a restart is running?). Try again in a moment.")
+                return
+
             inbound_instances_str = ""
 
-            for instance_num in xray_inbound_intances:
-                tag = request_instance_tag(config=config, tmpdir=tmpdir, instance_num=instance_num)
+            for tag in xray_inbound_intances.values():
                 inbound_instances_str = inbound_instances_str + f"{tag}\n"
 
             await update.message.reply_text(f"Active inbound instances:\n\n{inbound_instances_str}")
 
-    async def gc_command_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
+    async def stats_command_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
         if update.message is not None and update.message.chat_id in users_whitelist:
 
-            xray_inbound_intances = list_xray_inbound_instances(config=config, tmpdir=tmpdir)
+            if context.args and context.args[0].isdigit():
+                top_count = int(context.args[0])
+            else:
+                top_count = STATS_DEFAULT_TOP_COUNT
+
+            try:
+                top_inbounds = await get_top_inbounds_async(config=config, tmpdir=tmpdir, count=top_count)
+            except XrayApiError:
+                await update.message.reply_text("Cannot get stats from xray-core right now. Sorry.")
+                return
+
+            if not top_inbounds:
+                await update.message.reply_text("No traffic stats yet. Is \"metrics\" enabled in settings.json?")
+                return
 
-            keyboard = [
-                [
-                    InlineKeyboardButton(text=tag, callback_data=f"getconfigforinboundnum:{num}")
-                    for num, tag in xray_inbound_intances.items()
-                ]
-            ]
+            stats_str = ""
 
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            for row in top_inbounds:
+                rate_str = f", {row['rate'] / 1024:.1f} KiB/s" if row["rate"] is not None else ""
+                stats_str = stats_str + f"{row['tag']}: ↑{row['uplink'] / 1048576:.1f} MiB ↓{row['downlink'] / 1048576:.1f} MiB, {row['connections']} conn{rate_str}\n"
 
-            await update.message.reply_text(text="Which instance do you want the config for?", reply_markup=reply_markup)
+            await update.message.reply_text(f"Busiest inbound instances:\n\n{stats_str}")
+
+    async def health_command_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
+        if update.message is not None and update.message.chat_id in users_whitelist:
+
+            await update.message.reply_text("Probing all inbound instances...")
+
+            report = await health_prober.check()
+
+            await update.message.reply_text(render_health_report(report))
+
+    async def loglevel_command_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
+        if update.message is not None and update.message.chat_id in users_whitelist:
+
+            if not context.args:
+                loglevel = await get_xray_log_level_async(config=config, tmpdir=tmpdir)
+                await update.message.reply_text(f"xray-core log level: {loglevel}. Levels: {', '.join(XRAY_LOG_LEVELS)}. Switching it restarts every xray-core container, all connections drop.")
+                return
+
+            loglevel = context.args[0].lower()
+
+            if loglevel not in XRAY_LOG_LEVELS:
+                await update.message.reply_text(f"There is no such log level. Levels: {', '.join(XRAY_LOG_LEVELS)}.")
+                return
+
+            if await get_xray_log_level_async(config=config, tmpdir=tmpdir) == loglevel:
+                await update.message.reply_text(f"The log level is {loglevel} already.")
+                return
+
+            # xray has no api for the log level, the containers have to be restarted to pick it up
+            await update.message.reply_text(f"Switching the log level to {loglevel}. Every xray-core container is restarted - all connections drop, clients have to reconnect.")
+
+            restarted = await set_xray_log_level_async(config=config, tmpdir=tmpdir, loglevel=loglevel)
+
+            if not restarted:
+                await update.message.reply_text(f"The log level is {loglevel} already.")
+                return
+
+            await update.message.reply_text(f"Log level switched to {loglevel}, restarted: {', '.join(restarted)} - their connections were dropped. Configs are kept. settings.json wins again on the next start.")
+
+    async def logstats_command_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
+        if update.message is not None and update.message.chat_id in users_whitelist:
+
+            if not is_access_log_tailer_enabled(config):
+                await update.message.reply_text("The access log isn't tailed. Set \"dir\" and \"access_log\" of \"xray_log\" in settings.json.")
+                return
+
+            if context.args and context.args[0].isdigit():
+                top_count = int(context.args[0])
+            else:
+                top_count = STATS_DEFAULT_TOP_COUNT
+
+            error_rates = metrics.access_log_error_rates(top_count)
+
+            if not error_rates:
+                await update.message.reply_text("No connections in the access log yet.")
+                return
+
+            logstats_str = ""
+
+            for row in error_rates:
+                logstats_str = logstats_str + f"{row['service']}: {row['error_rate'] * 100:.1f}% rejected ({row['rejected']} of {row['accepted'] + row['rejected']})\n"
+
+            await update.message.reply_text(f"Rejected connections by shard:\n\n{logstats_str}")
+
+    async def export_command_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
+        if update.message is not None and update.message.chat_id in users_whitelist:
+
+            tag_filter = " ".join(context.args)
+            archive, uris = await export_xray_inbound_instances_async(config=config, tmpdir=tmpdir, tag_filter=tag_filter)
+
+            if not uris:
+                await update.message.reply_text("No instances match this filter.")
+                return
+
+            if len(uris) <= EXPORT_MESSAGE_URIS_LIMIT:
+                await update.message.reply_text("\n\n".join(f"{tag}:\n{uri}" for tag, uri in uris))
+
+            await update.message.reply_document(document=archive, filename="xray-cAD-configs.zip", caption=f"{len(uris)} instance configs")
+
+    async def gc_command_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
+        if update.message is not None and update.message.chat_id in users_whitelist:
+
+            reply_markup, page, pages_count, matches_count = await get_inbounds_keyboard_page(config=config, tmpdir=tmpdir, action="gcu" if multi_user else "gc", tag_filter=" ".join(context.args))
+
+            if matches_count == 0:
+                await update.message.reply_text("No instances match this filter.")
+                return
+
+            await update.message.reply_text(text=f"Which {'user' if multi_user else 'instance'} do you want the config for?", reply_markup=reply_markup)
 
     async def rc_command_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
         if update.message is not None and update.message.chat_id in users_whitelist:
-            
-            xray_inbound_intances = list_xray_inbound_instances(config=config, tmpdir=tmpdir)
 
-            keyboard = [
-                [
-                    InlineKeyboardButton(text=tag, callback_data=f"refurbishinboundnum:{num}")
-                    for num, tag in xray_inbound_intances.items()
-                ]
-            ]
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup, page, pages_count, matches_count = await get_inbounds_keyboard_page(config=config, tmpdir=tmpdir, action="rcu" if multi_user else "rc", tag_filter=" ".join(context.args))
+
+            if matches_count == 0:
+                await update.message.reply_text("No instances match this filter.")
+                return
+
+            await update.message.reply_text(text=f"Which {'user' if multi_user else 'instance'} you want to refurbish?", reply_markup=reply_markup)
+
+    async def au_command_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
+        if update.message is not None and update.message.chat_id in users_whitelist:
+
+            if not multi_user:
+                await update.message.reply_text("Users exist only in multi-user mode (\"xray_inbound_multi_user\" in settings.json).")
+                return
 
-            await update.message.reply_text(text="Which instance you want to refurbish?", reply_markup=reply_markup)
+            if context.args and not context.args[0].isdigit():
+                await update.message.reply_text("Usage: /au [N]")
+                return
+
+            users_count = int(context.args[0]) if context.args else 1
+
+            added, _, _, services_to_restart = await change_xray_users_async(config=config, tmpdir=tmpdir, add_count=users_count)
+
+            if len(added) <= ADDED_USERS_MESSAGE_LIMIT:
+                added_str = ", ".join(user.tag for _, user in added)
+            else:
+                added_str = f"{added[0][1].tag} ... {added[-1][1].tag}"
+
+            applied_answer = f"Restarted to apply: {', '.join(services_to_restart)}." if services_to_restart else "Applied live, nobody was disconnected."
+
+            await update.message.reply_text(f"Added {len(added)} users: {added_str}. {applied_answer} Get their configs with /gc or /export.")
+
+    async def ru_command_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
+        if update.message is not None and update.message.chat_id in users_whitelist:
+
+            if not multi_user:
+                await update.message.reply_text("Users exist only in multi-user mode (\"xray_inbound_multi_user\" in settings.json).")
+                return
+
+            reply_markup, page, pages_count, matches_count = await get_inbounds_keyboard_page(config=config, tmpdir=tmpdir, action="ru", tag_filter=" ".join(context.args))
+
+            if matches_count == 0:
+                await update.message.reply_text("No users match this filter.")
+                return
+
+            await update.message.reply_text(text="Which user do you want to revoke?", reply_markup=reply_markup)
+
+    async def page_buttons_callback_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
+
+        query = update.callback_query
+        if query is not None and query.data is not None and query.message is not None and query.message.chat.id in users_whitelist:
+
+            await query.answer()
+
+            _, action, page, tag_filter = query.data.split(":", 3)
+
+            reply_markup, page, pages_count, matches_count = await get_inbounds_keyboard_page(config=config, tmpdir=tmpdir, action=action, page=int(page), tag_filter=tag_filter)
+
+            try:
+                await query.edit_message_reply_markup(reply_markup=reply_markup)
+            except BadRequest:
+                pass # the current page was pressed - "message is not modified"
+
+    async def send_instance_artifacts(query, context, instance_artifacts):
+
+        instance_config = instance_artifacts["config"]
+
+        # a flat shadowsocks config reads fine as lines, a nested xray client config (vless) is left to the file
+        if all(not isinstance(v, (dict, list)) for v in instance_config.values()):
+            instance_config_string = "\n".join(f"{k}: {v}" for k, v in instance_config.items()) + "\n\n"
+        else:
+            instance_config_string = ""
+
+        instance_config_json = io.BytesIO((json.dumps(instance_config, indent=4, ensure_ascii=False) + "\n").encode("utf-8"))
+        instance_config_json.seek(0)
+
+        await query.edit_message_text(f"{instance_config_string}{instance_artifacts['uri']}")
+
+        await context.bot.send_document(
+            chat_id=query.message.chat.id,
+            document=instance_config_json,
+            filename="config.json"
+        )
+
+        if instance_artifacts["qr_png"] is not None:
+            await context.bot.send_photo(chat_id=query.message.chat.id, photo=instance_artifacts["qr_png"])
 
     async def gc_buttons_callback_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
-        
+
         query = update.callback_query
-        if query is not None and query.data is not None and query.message is not None:
+        if query is not None and query.data is not None and query.message is not None and query.message.chat.id in users_whitelist:
 
             await query.answer()
 
             instance_num = int(query.data.split(":")[1])
-            
-            instance_config = request_config_for_xray_inbound_instance(config=config, tmpdir=tmpdir, instance_num=instance_num)
-            
-            if instance_config is not None:
 
-                if request_instance_protocol(config=config, tmpdir=tmpdir, instance_num=instance_num) == "shadowsocks":
+            # the keyboard may be older than a /restart that left fewer instances
+            try:
+                instance_artifacts = await request_artifacts_for_xray_inbound_instance_async(config=config, tmpdir=tmpdir, instance_num=instance_num)
+            except IndexError:
+                await query.edit_message_text("There is no such instance anymore, request a new list with /gc.")
+                return
 
-                    instance_config_string = "\n".join(f"{k}: {v}" for k, v in instance_config.items())
-                
-                    instance_config_json = io.BytesIO((json.dumps(instance_config_string, indent=4, ensure_ascii=False) + "\n").encode("utf-8"))
-                    instance_config_json.seek(0)
+            if instance_artifacts is not None:
+                await send_instance_artifacts(query, context, instance_artifacts)
 
-                    await query.edit_message_text(instance_config_string)
+    async def gc_user_buttons_callback_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
 
-                    await context.bot.send_document(
-                        chat_id=query.message.chat.id,
-                        document=instance_config_json,
-                        filename="config.json"
-                    )
-                else:
-                    await query.edit_message_text("Cannot get config for this type of instances. Sorry.")
+        query = update.callback_query
+        if query is not None and query.data is not None and query.message is not None and query.message.chat.id in users_whitelist:
+
+            await query.answer()
+
+            user_tag = query.data.split(":", 1)[1]
+
+            try:
+                instance_artifacts = await request_artifacts_for_xray_user_async(config=config, tmpdir=tmpdir, user_tag=user_tag)
+            except ValueError:
+                await query.edit_message_text(f"There is no {user_tag} anymore.")
+                return
+
+            if instance_artifacts is not None:
+                await send_instance_artifacts(query, context, instance_artifacts)
 
     async def rc_buttons_callback_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
-        
+
         query = update.callback_query
-        if query is not None and query.data is not None:
-            
+        if query is not None and query.data is not None and query.message is not None and query.message.chat.id in users_whitelist:
+
             await query.answer()
 
             instance_num = int(query.data.split(":")[1])
             #print(f"instance_num: {instance_num} -- will be refurbish!")
-            
-            refurbish_xray_inbound_intance(config=config, tmpdir=tmpdir, instance_num=instance_num)
-            await query.edit_message_text("The selected instance has been refurbished. If you need a new configuration file for it, feel free to request it from me.")
+
+            await query.edit_message_text("Refurbishing the selected instance...")
+
+            try:
+                applied_live = await refurbish_xray_inbound_instance_async(config=config, tmpdir=tmpdir, instance_num=instance_num, progress=make_progress_reporter(query.message))
+            except IndexError:
+                await query.edit_message_text("There is no such instance anymore, request a new list with /rc.")
+                return
+            except ValueError as e:
+                await query.edit_message_text(f"The instance can't be refurbished: {e}")
+                return
+
+            if applied_live:
+                applied_answer = "Applied live, other instances were not touched."
+            else:
+                applied_answer = "The container was recreated to apply it."
+
+            await query.edit_message_text(f"The selected instance has been refurbished. {applied_answer} If you need a new configuration file for it, feel free to request it from me.")
+
+    async def rc_user_buttons_callback_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
+
+        query = update.callback_query
+        if query is not None and query.data is not None and query.message is not None and query.message.chat.id in users_whitelist:
+
+            await query.answer()
+
+            user_tag = query.data.split(":", 1)[1]
+
+            await query.edit_message_text(f"Refurbishing {user_tag}...")
+
+            try:
+                applied_live = await refurbish_xray_user_async(config=config, tmpdir=tmpdir, user_tag=user_tag, progress=make_progress_reporter(query.message))
+            except ValueError:
+                await query.edit_message_text(f"There is no {user_tag} anymore.")
+                return
+
+            if applied_live:
+                applied_answer = "Applied live, other users stayed connected."
+            else:
+                applied_answer = "The container was restarted to apply it."
+
+            await query.edit_message_text(f"{user_tag} has a new credential, the old one no longer works. {applied_answer} Request the new config with /gc.")
+
+    async def ru_user_buttons_callback_handler(update:Update, context:ContextTypes.DEFAULT_TYPE) -> None:
+
+        query = update.callback_query
+        if query is not None and query.data is not None and query.message is not None and query.message.chat.id in users_whitelist:
+
+            await query.answer()
+
+            user_tag = query.data.split(":", 1)[1]
+
+            try:
+                _, _, _, services_to_restart = await change_xray_users_async(config=config, tmpdir=tmpdir, revoke_user_tags=[user_tag], progress=make_progress_reporter(query.message))
+            except ValueError:
+                await query.edit_message_text(f"There is no {user_tag} anymore.")
+                return
+
+            applied_answer = "The container was restarted to apply it." if services_to_restart else "Applied live, other users stayed connected."
+
+            await query.edit_message_text(f"{user_tag} is revoked. {applied_answer}")
+
+    command_handlers = {
+        "help": help_command_handler,
+        "restart": restart_command_handler,
+        "shutdown": shutdown_command_handler,
+        "lc": lc_command_handler,
+        "gc": gc_command_handler,
+        "rc": rc_command_handler,
+        "stats": stats_command_handler,
+        "export": export_command_handler,
+        "health": health_command_handler,
+        "loglevel": loglevel_command_handler,
+        "logstats": logstats_command_handler,
+        "au": au_command_handler,
+        "ru": ru_command_handler
+    }
+
+    callback_query_handlers = {
+        "^getconfigforinboundnum:\\d+$": gc_buttons_callback_handler,
+        "^refurbishinboundnum:\\d+$": rc_buttons_callback_handler,
+        "^getconfigforuser:": gc_user_buttons_callback_handler,
+        "^refurbishuser:": rc_user_buttons_callback_handler,
+        "^revokeuser:": ru_user_buttons_callback_handler,
+        "^inboundspage:(gc|rc|gcu|rcu|ru):\\d+:": page_buttons_callback_handler
+    }
+
+    return command_handlers, callback_query_handlers
+
+def main(bot_token:str, users_whitelist:list, config, tmpdir):
 
     #print(users_whitelist, bot_token)
 
-    application = Application.builder().token(bot_token).build()
-    
-    application.add_handler(CommandHandler("help", help_command_handler))
-    application.add_handler(CommandHandler("restart", restart_command_handler))
-    application.add_handler(CommandHandler("shutdown", shutdown_command_handler))
-    application.add_handler(CommandHandler("lc", lc_command_handler))
-    application.add_handler(CommandHandler("gc", gc_command_handler))
-    application.add_handler(CommandHandler("rc", rc_command_handler))
-    
-    application.add_handler(CallbackQueryHandler(gc_buttons_callback_handler, pattern="^getconfigforinboundnum:\\d+$"))
-    application.add_handler(CallbackQueryHandler(rc_buttons_callback_handler, pattern="^refurbishinboundnum:\\d+$"))
-    
-
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    command_handlers, callback_query_handlers = build_handlers(users_whitelist=users_whitelist, config=config, tmpdir=tmpdir)
+
+    async def notify_users(text):
+        for chat_id in users_whitelist:
+            try:
+                await application.bot.send_message(chat_id=chat_id, text=text)
+            except TelegramError as e:
+                print(f"[-] Cannot notify {chat_id}: {e}")
+
+    async def post_init(application:Application) -> None:
+        # rotation, health checks and the control api live in the bot's event loop, next to the handlers
+        application.bot_data["background"] = await start_background_tasks(config=config, tmpdir=tmpdir, notify=notify_users)
+
+    # concurrent updates, so /gc, /lc and /rc are still answered while a /restart is running
+    application = Application.builder().token(bot_token).concurrent_updates(True).post_init(post_init).build()
+
+    for command, command_handler in command_handlers.items():
+        application.add_handler(CommandHandler(command, command_handler))
+
+    for pattern, callback_query_handler in callback_query_handlers.items():
+        application.add_handler(CallbackQueryHandler(callback_query_handler, pattern=pattern))
+
+    if not is_webhook_enabled(config):
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
+        return
+
+    async def serve_webhook():
+
+        stop_event = asyncio.Event()
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(signum, stop_event.set)
+
+        async with application:
+            # post_init is only called by run_polling() / run_webhook()
+            await post_init(application)
+
+            webhook_settings = get_webhook_settings(config)
+            secret_token = resolve_webhook_secret_token(config)
+
+            webhook_server = None
+
+            try:
+                webhook_server = await start_webhook_server(application, config, secret_token)
+
+                await application.bot.set_webhook(
+                    url=webhook_settings["url"],
+                    allowed_updates=ALLOWED_UPDATES,
+                    secret_token=secret_token
+                )
+            except (OSError, KeyError, TelegramError) as e:
+                print(f"[-] Cannot set up the webhook, falling back to polling: {e}")
+
+                if webhook_server is not None:
+                    webhook_server.close()
+                    webhook_server = None
+
+                # polling doesn't work while a webhook is set
+                await application.bot.delete_webhook()
+                await application.updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+
+            await application.start()
+            await stop_event.wait()
+
+            if webhook_server is not None:
+                webhook_server.close()
+                await webhook_server.wait_closed()
+
+            if application.updater.running:
+                await application.updater.stop()
+
+            await application.stop()
+
+    asyncio.run(serve_webhook())
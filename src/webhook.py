@@ -0,0 +1,87 @@
+import asyncio
+import json
+import secrets
+import time
+
+from telegram import Update
+
+from http_server import HttpError, read_http_request, write_http_response
+from metrics import metrics
+
+WEBHOOK_DEFAULT_LISTEN = "127.0.0.1:8443"
+WEBHOOK_DEFAULT_PATH = "/telegram"
+
+# a single telegram update is a few kilobytes at most
+WEBHOOK_MAX_BODY_SIZE = 1024 * 1024
+
+def get_webhook_settings(config):
+    return config.get("telegram_webhook") or {}
+
+def is_webhook_enabled(config):
+    return bool(get_webhook_settings(config).get("enabled", False))
+
+def resolve_webhook_secret_token(config):
+    """
+    The secret telegram sends along with every update. Without one in settings.json a random one is made
+    for this run (set_webhook hands it to telegram) - the endpoint never accepts unauthenticated updates.
+    """
+
+    return get_webhook_settings(config).get("secret_token") or secrets.token_urlsafe(32)
+
+async def start_webhook_server(application, config, secret_token):
+    """
+    Receives telegram updates on POST <path> (behind a tls terminating reverse proxy).
+    Every update is acknowledged with 200 right away and processed in its own task afterwards,
+    so telegram never waits for a handler - processing time ends up in the "telegram_update" metric.
+    """
+
+    webhook_settings = get_webhook_settings(config)
+
+    host, port = webhook_settings.get("listen", WEBHOOK_DEFAULT_LISTEN).rsplit(":", 1)
+    webhook_path = webhook_settings.get("path", WEBHOOK_DEFAULT_PATH)
+
+    if not secret_token:
+        raise ValueError("[-] The webhook needs a secret token!")
+
+    # raw update payloads for replaying them later (benchmarks/webhook_latency.py)
+    record_updates_path = webhook_settings.get("record_updates") or None
+
+    async def process_update(update, received_at):
+        try:
+            await application.process_update(update)
+        finally:
+            metrics.observe("telegram_update", time.perf_counter() - received_at)
+
+    async def handle_connection(reader, writer):
+
+        received_at = time.perf_counter()
+
+        try:
+            method, path, params, headers, body = await read_http_request(reader, WEBHOOK_MAX_BODY_SIZE)
+
+            if path != webhook_path:
+                raise HttpError(404, "Not found")
+
+            if method != "POST":
+                raise HttpError(405, "Use POST")
+
+            if not secrets.compare_digest(headers.get("x-telegram-bot-api-secret-token", "").encode("utf-8"), secret_token.encode("utf-8")):
+                raise HttpError(403, "Wrong secret token")
+
+            update = Update.de_json(json.loads(body), application.bot)
+
+            if record_updates_path is not None:
+                with open(record_updates_path, "ab") as f:
+                    f.write(body.rstrip(b"\n") + b"\n")
+        except HttpError as e:
+            await write_http_response(writer, e.status, b"", content_type="text/plain")
+            return
+        except (ValueError, KeyError, TypeError):
+            await write_http_response(writer, 400, b"", content_type="text/plain")
+            return
+
+        await write_http_response(writer, 200, b"", content_type="text/plain")
+
+        application.create_task(process_update(update, received_at), update=update)
+
+    return await asyncio.start_server(handle_connection, host=host, port=int(port))
@@ -0,0 +1,142 @@
+import json
+import subprocess
+
+from publishing import get_ports_publishing_mode
+from shards import get_shard_service_name
+
+XRAY_API_DEFAULT_LISTEN = "127.0.0.1:10085"
+XRAY_API_TIMEOUT = 10
+
+class XrayApiError(Exception):
+    pass
+
+def get_xray_api_listen(config, shard=0):
+
+    xray_api_listen = config.get("xray_api_listen") or XRAY_API_DEFAULT_LISTEN
+
+    # with host networking all shards share one loopback, so every shard gets the next port
+    if get_ports_publishing_mode(config) == "host" and shard:
+        host, port = xray_api_listen.rsplit(":", 1)
+        xray_api_listen = f"{host}:{int(port) + shard}"
+
+    return xray_api_listen
+
+def is_xray_api_enabled(config):
+    return bool(config.get("xray_api_enabled", True))
+
+def generate_xray_api_object(config, shard=0, services=("HandlerService", "StatsService")):
+
+    # "listen" makes xray serve the gRPC API by itself, without an extra dokodemo inbound
+    # (an extra inbound would shift every instance number used by the bot)
+    return {
+        "tag": "api",
+        "listen": get_xray_api_listen(config, shard=shard),
+        "services": list(services)
+    }
+
+def generate_xray_stats_objects():
+    """
+    "stats" + "policy" sections that make xray count traffic per inbound tag.
+    """
+
+    return {
+        "stats": {},
+        "policy": {
+            "system": {
+                "statsInboundUplink": True,
+                "statsInboundDownlink": True
+            }
+        }
+    }
+
+def xray_api_command(config, tmpdir, command, *args, input=None, shard=0, shards_count=1):
+
+    # by default "xray api" is run inside the running container, where the api listens on loopback.
+    # "xray_api_executable" points to a local xray binary instead (e.g. against a stub gRPC server)
+    if config.get("xray_api_executable"):
+        cmd = [config["xray_api_executable"], "api", command]
+    else:
+        cmd = ["docker", "compose", "exec", "-T", get_shard_service_name(shards_count, shard), "xray", "api", command]
+
+    cmd.append(f"--server={get_xray_api_listen(config, shard=shard)}")
+    cmd.extend(args)
+
+    return subprocess.run(
+        cmd,
+        check=True,
+        cwd=tmpdir,
+        input=input,
+        capture_output=True,
+        text=True,
+        timeout=XRAY_API_TIMEOUT
+    )
+
+def remove_inbound(config, tmpdir, tag, shard=0, shards_count=1):
+    xray_api_command(config, tmpdir, "rmi", tag, shard=shard, shards_count=shards_count)
+
+def add_inbound(config, tmpdir, inbound_object, shard=0, shards_count=1):
+    xray_api_command(config, tmpdir, "adi", "stdin:", input=json.dumps({"inbounds": [inbound_object]}), shard=shard, shards_count=shards_count)
+
+def replace_inbound(config, tmpdir, tag, inbound_object, shard=0, shards_count=1):
+    """
+    Swaps one inbound handler in the running xray-core, every other inbound keeps serving.
+    Raises XrayApiError if the api can't be reached or refuses the change.
+    """
+
+    try:
+        remove_inbound(config, tmpdir, tag, shard=shard, shards_count=shards_count)
+        add_inbound(config, tmpdir, inbound_object, shard=shard, shards_count=shards_count)
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        raise XrayApiError(f"[-] xray-core api: cannot replace inbound {tag}!") from e
+
+def insert_inbound(config, tmpdir, inbound_object, shard=0, shards_count=1):
+    """
+    Adds a new inbound handler to the running xray-core.
+    Raises XrayApiError if the api can't be reached or refuses the change.
+    """
+
+    try:
+        add_inbound(config, tmpdir, inbound_object, shard=shard, shards_count=shards_count)
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        raise XrayApiError(f"[-] xray-core api: cannot add inbound {inbound_object['tag']}!") from e
+
+def add_users(config, tmpdir, inbound_object, shard=0, shards_count=1):
+    """
+    Adds the clients of inbound_object to the running inbound with the same tag, its other users stay connected.
+    Raises XrayApiError if the api can't be reached or refuses the change.
+    """
+
+    try:
+        xray_api_command(config, tmpdir, "adu", "stdin:", input=json.dumps({"inbounds": [inbound_object]}), shard=shard, shards_count=shards_count)
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        raise XrayApiError(f"[-] xray-core api: cannot add users to inbound {inbound_object['tag']}!") from e
+
+def remove_users(config, tmpdir, tag, emails, shard=0, shards_count=1):
+    """
+    Removes users (by email) from the running inbound tag.
+    Raises XrayApiError if the api can't be reached or refuses the change.
+    """
+
+    try:
+        xray_api_command(config, tmpdir, "rmu", f"-tag={tag}", *emails, shard=shard, shards_count=shards_count)
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        raise XrayApiError(f"[-] xray-core api: cannot remove users from inbound {tag}!") from e
+
+def query_inbound_traffic(config, tmpdir, shard=0, shards_count=1):
+    """
+    Returns {tag: {"uplink": bytes, "downlink": bytes}} from the StatsService of one shard.
+    """
+
+    try:
+        result = xray_api_command(config, tmpdir, "statsquery", "-pattern", "inbound>>>", shard=shard, shards_count=shards_count)
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        raise XrayApiError("[-] xray-core api: cannot query stats!") from e
+
+    inbound_traffic = {}
+
+    # counter names look like "inbound>>>shadowsocks-1>>>traffic>>>uplink", zero values come without "value"
+    for stat in json.loads(result.stdout.strip() or "{}").get("stat", []):
+        _, tag, _, direction = stat["name"].split(">>>")
+        inbound_traffic.setdefault(tag, {"uplink": 0, "downlink": 0})[direction] = int(stat.get("value", 0))
+
+    return inbound_traffic
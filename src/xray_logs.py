@@ -0,0 +1,139 @@
+import os
+import re
+
+XRAY_LOG_LEVELS = ("debug", "info", "warning", "error", "none")
+XRAY_LOG_DEFAULT_LEVEL = "warning"
+
+# where a shard's log directory is mounted inside its container
+CONTAINER_LOG_DIR = "/var/log/xray"
+
+LOG_TAILER_DEFAULT_INTERVAL = 10
+
+# a first look at a big existing log only reads its tail, older lines don't say anything about now
+LOG_TAILER_MAX_INITIAL_READ = 1024 * 1024
+
+# "2024/01/01 12:00:00 1.2.3.4:5678 accepted tcp:example.com:443 [shadowsocks-1 >> direct]"
+# "2024/01/01 12:00:00 from 1.2.3.4:5678 rejected proxy/shadowsocks: ..."
+ACCESS_LOG_LINE = re.compile(r"^\S+ \S+ (?:from )?\S+ (?P<status>accepted|rejected)\s(?:\S+ )?(?:\[(?P<inbound_tag>[^\]\s]+) (?:>>|->) [^\]]*\])?")
+
+def get_xray_log_settings(config):
+    return config.get("xray_log") or {}
+
+def get_xray_log_dir(config):
+    return get_xray_log_settings(config).get("dir") or None
+
+def generate_xray_log_object(config, loglevel=None):
+    """
+    The "log" section of the xray config. Without a log dir xray logs to stdout (docker logs) and the access log is off.
+    """
+
+    log_settings = get_xray_log_settings(config)
+    loglevel = loglevel or log_settings.get("loglevel", XRAY_LOG_DEFAULT_LEVEL)
+
+    if loglevel not in XRAY_LOG_LEVELS:
+        raise ValueError(f"[-] Unknown xray log level {loglevel}, use one of: {', '.join(XRAY_LOG_LEVELS)}!")
+
+    log_object = {"loglevel": loglevel, "access": "none"}
+
+    if get_xray_log_dir(config) is not None:
+        log_object["error"] = f"{CONTAINER_LOG_DIR}/error.log"
+
+        if log_settings.get("access_log", False):
+            log_object["access"] = f"{CONTAINER_LOG_DIR}/access.log"
+
+    if log_settings.get("dns_log", False):
+        log_object["dnsLog"] = True
+
+    if log_settings.get("mask_address"):
+        log_object["maskAddress"] = log_settings["mask_address"]
+
+    return log_object
+
+def get_access_log_path(config, service):
+    return f"{get_xray_log_dir(config)}/{service}/access.log"
+
+class AccessLogTailer:
+    """
+    Follows the access log of every shard and keeps running per inbound counts of accepted and rejected connections.
+
+    Only the bytes appended since the last poll are read (rotation and truncation start the file over),
+    and with access_log_sample_ratio below 1 only every n-th line is parsed, the counts are scaled back up.
+    Sampling only saves parsing here - xray still writes every line.
+
+    xray doesn't name the inbound (nor the port) on a rejected handshake, so rejects are counted for the
+    shard's service. Reject rates only make sense per shard, service_counts has the totals for that.
+    """
+
+    def __init__(self, config):
+        log_settings = get_xray_log_settings(config)
+
+        self.config = config
+
+        sample_ratio = log_settings.get("access_log_sample_ratio", 1.0)
+        self.sample_every = max(1, round(1 / sample_ratio)) if sample_ratio > 0 else 0
+
+        # path -> (inode, offset, unfinished last line)
+        self.positions = {}
+        self.lines_seen = 0
+
+        # tag (or service) -> {"accepted": count, "rejected": count}, published through metrics
+        self.counts = {}
+
+        # service -> {"accepted": count, "rejected": count}, every line of the shard
+        self.service_counts = {}
+
+    def read_new_lines(self, path):
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.positions.pop(path, None)
+            return []
+
+        inode, offset, partial_line = self.positions.get(path, (None, None, b""))
+
+        if offset is None:
+            offset = max(0, stat.st_size - LOG_TAILER_MAX_INITIAL_READ)
+        elif inode != stat.st_ino or stat.st_size < offset:
+            offset, partial_line = 0, b""
+
+        with open(path, "rb") as f:
+            f.seek(offset)
+            chunk = f.read()
+
+        lines = (partial_line + chunk).split(b"\n")
+        self.positions[path] = (stat.st_ino, offset + len(chunk), lines.pop())
+
+        return lines
+
+    def count_line(self, line, service):
+
+        match = ACCESS_LOG_LINE.match(line.decode("utf-8", errors="replace"))
+
+        if match is None:
+            return
+
+        key = match.group("inbound_tag") or service
+        counts = self.counts.setdefault(key, {"accepted": 0, "rejected": 0})
+        counts[match.group("status")] += self.sample_every
+
+        service_counts = self.service_counts.setdefault(service, {"accepted": 0, "rejected": 0})
+        service_counts[match.group("status")] += self.sample_every
+
+    def poll(self, services):
+        """
+        Reads what the given services logged since the last poll. Blocking - run it off the event loop.
+        """
+
+        if self.sample_every == 0:
+            return
+
+        for service in services:
+            for line in self.read_new_lines(get_access_log_path(self.config, service)):
+                self.lines_seen += 1
+
+                if self.lines_seen % self.sample_every == 0:
+                    self.count_line(line, service)
+
+def is_access_log_tailer_enabled(config):
+    return get_xray_log_dir(config) is not None and bool(get_xray_log_settings(config).get("access_log", False))
@@ -0,0 +1,63 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from services import generate_tmpdir, remove_tmpdir
+
+STUB_XRAY = str(Path(__file__).resolve().parent / "stub_xray")
+SETTINGS = Path(__file__).resolve().parent.parent / "src" / "configuration" / "settings.json"
+
+@pytest.fixture
+def config():
+    """
+    The shipped settings, with the xray api pointed at the stub.
+    """
+
+    with open(SETTINGS) as f:
+        config = json.load(f)
+
+    config["xray_api_executable"] = STUB_XRAY
+    config["state_dir"] = ""
+
+    return config
+
+@pytest.fixture
+def tmpdir():
+
+    tmpdir = generate_tmpdir()
+    yield tmpdir
+    remove_tmpdir(tmpdir)
+
+@pytest.fixture
+def xray_calls(tmp_path, monkeypatch):
+    """
+    Returns a function listing the stub calls made so far.
+    """
+
+    log_path = tmp_path / "xray_calls.jsonl"
+    monkeypatch.setenv("XRAY_STUB_LOG", str(log_path))
+    monkeypatch.delenv("XRAY_STUB_FAIL", raising=False)
+
+    def read_calls():
+        if not log_path.exists():
+            return []
+        with open(log_path) as f:
+            return [json.loads(line) for line in f]
+
+    return read_calls
+
+@pytest.fixture
+def multi_user_config(config):
+    """
+    Two shadowsocks-2022 listeners sharing five users.
+    """
+
+    config["xray_inbound_protocol"] = "shadowsocks-2022"
+    config["xray_shadowsocks_inbound_method"] = "2022-blake3-aes-128-gcm"
+    config["xray_inbound_multi_user"] = {"enabled": True, "listeners_count": 2, "users_count": 5}
+
+    return config
@@ -0,0 +1,99 @@
+import asyncio
+import os
+
+import pytest
+
+from control import ControlError, dispatch_control_request
+from services import generate_xray_config, generate_docker_compose
+from state import get_state_store
+
+def request(config, tmpdir, path, params=None, method="POST"):
+    return asyncio.run(dispatch_control_request(config, tmpdir, method, path, params or {}))
+
+@pytest.fixture
+def store(config, tmpdir):
+    # new instances fit into the published blocks, nothing needs a recreate
+    config["docker_ports_publishing"] = "ranges"
+    config["docker_ports_range_spare_ratio"] = 2
+    generate_xray_config(config=config, tmpdir=tmpdir)
+    generate_docker_compose(config=config, tmpdir=tmpdir)
+    return get_state_store(tmpdir)
+
+def test_batch_merges_and_dedups_changes(config, tmpdir, store, xray_calls):
+
+    result = request(config, tmpdir, "/batch", {"requests": [
+        {"op": "refurbish", "instances": [0]},
+        {"op": "refurbish", "tags": ["shadowsocks-1", "shadowsocks-2"]},
+        {"op": "add", "count": 1},
+        {"op": "add", "count": 2},
+        {"op": "list"}
+    ]})
+
+    # instance 0 is shadowsocks-1, it's refurbished once
+    assert result["refurbished"] == ["shadowsocks-1", "shadowsocks-2"]
+    assert result["added"] == ["shadowsocks-4", "shadowsocks-5", "shadowsocks-6"]
+
+    # the read operation runs on the result of the change
+    assert result["results"][:4] == [{"ok": True}] * 4
+    assert [instance["tag"] for instance in result["results"][4]] == [f"shadowsocks-{n}" for n in range(1, 7)]
+
+def test_read_only_batch_changes_nothing(config, tmpdir, store, xray_calls):
+
+    version = store.version
+
+    result = request(config, tmpdir, "/batch", {"requests": [{"op": "list"}, {"op": "loglevel"}]})
+
+    assert (result["added"], result["refurbished"], result["recreated"]) == ([], [], [])
+    assert len(result["results"]) == 2
+    assert store.version == version
+    assert xray_calls() == []
+
+    # not even the applied state is rewritten
+    assert not os.path.exists(f"{tmpdir}/applied.json")
+
+@pytest.mark.parametrize("op", ["restart", "set-loglevel", "add-users", "refurbish-users", "revoke-users", "batch", "nonsense"])
+def test_batch_rejects_unbatched_operations(config, tmpdir, store, op):
+
+    with pytest.raises(ControlError) as error:
+        request(config, tmpdir, "/batch", {"requests": [{"op": "add"}, {"op": op}]})
+
+    assert error.value.status == 400
+    assert len(store.inbounds) == 3
+
+def test_dispatch(config, tmpdir, store, xray_calls):
+
+    assert [instance["shard"] for instance in request(config, tmpdir, "/list", method="GET")] == [1, 1, 1]
+
+    with pytest.raises(ControlError) as error:
+        request(config, tmpdir, "/unknown")
+    assert error.value.status == 404
+
+    # anything that changes instances needs POST
+    with pytest.raises(ControlError) as error:
+        request(config, tmpdir, "/add", method="GET")
+    assert error.value.status == 405
+
+    assert request(config, tmpdir, "/add", {"count": 1})["added"] == ["shadowsocks-4"]
+
+def test_restart_numbers_shards_from_one(config, tmpdir, store, xray_calls):
+
+    with pytest.raises(ControlError) as error:
+        request(config, tmpdir, "/restart", {"shard": 0})
+    assert error.value.status == 404
+
+    assert request(config, tmpdir, "/restart", {"shard": 1}) == {"recreated": []}
+    assert [call["args"][1] for call in xray_calls()].count("adi") == 3
+
+@pytest.mark.parametrize("path, params", [
+    ("/add", {"count": 1}),
+    ("/refurbish", {"instances": [0]}),
+    ("/restart", {"shard": 1}),
+    ("/batch", {"requests": [{"op": "add"}]})
+])
+def test_listeners_stay_in_multi_user_mode(multi_user_config, tmpdir, path, params):
+
+    generate_xray_config(config=multi_user_config, tmpdir=tmpdir)
+
+    with pytest.raises(ControlError) as error:
+        request(multi_user_config, tmpdir, path, params)
+    assert error.value.status == 409
@@ -0,0 +1,142 @@
+import json
+
+from ports import get_port_allocator
+from publishing import is_port_published
+from services import (
+    generate_xray_config,
+    generate_docker_compose,
+    add_xray_inbound_instances,
+    refurbish_xray_inbound_instances,
+    apply_xray_inbound_instances_live
+)
+from state import get_state_store
+
+def generate(config, tmpdir):
+    generate_xray_config(config=config, tmpdir=tmpdir)
+    generate_docker_compose(config=config, tmpdir=tmpdir)
+
+def refurbish_and_apply(config, tmpdir, instance_nums):
+    refurbished = refurbish_xray_inbound_instances(config, tmpdir, instance_nums)
+    return refurbished, apply_xray_inbound_instances_live(config, tmpdir, refurbished)
+
+def test_refurbish_without_port_rotation_is_applied_live(config, tmpdir, xray_calls):
+
+    config["xray_refurbish_rotate_port"] = False
+    generate(config, tmpdir)
+
+    refurbished, services_to_recreate = refurbish_and_apply(config, tmpdir, [0])
+    old_inbound, inbound = refurbished[0]
+
+    assert services_to_recreate == []
+    assert inbound.port == old_inbound.port
+    assert inbound.password != old_inbound.password
+
+    calls = xray_calls()
+
+    # the old handler goes first, then the new one takes its tag and port
+    assert [call["args"][:2] for call in calls] == [["api", "rmi"], ["api", "adi"]]
+    assert calls[0]["args"][-1] == old_inbound.tag
+    assert calls[1]["args"][2] == "--server=127.0.0.1:10085"
+
+    added_inbound = json.loads(calls[1]["stdin"])["inbounds"][0]
+    assert added_inbound == get_state_store(tmpdir).render_inbound_object(inbound)
+
+def test_refused_api_call_falls_back_to_recreate(config, tmpdir, xray_calls, monkeypatch):
+
+    config["xray_refurbish_rotate_port"] = False
+    generate(config, tmpdir)
+    monkeypatch.setenv("XRAY_STUB_FAIL", "adi")
+
+    _, services_to_recreate = refurbish_and_apply(config, tmpdir, [0])
+
+    assert services_to_recreate == ["xray-core"]
+    assert [call["args"][1] for call in xray_calls()] == ["rmi", "adi"]
+
+def test_unpublished_port_falls_back_to_recreate(config, tmpdir, xray_calls):
+
+    # a rotated port isn't published by the running container in "ports" mode
+    config["xray_refurbish_rotate_port"] = True
+    config["docker_ports_publishing"] = "ports"
+    generate(config, tmpdir)
+
+    refurbished, services_to_recreate = refurbish_and_apply(config, tmpdir, [0])
+    old_inbound, inbound = refurbished[0]
+
+    assert inbound.port != old_inbound.port
+    assert services_to_recreate == ["xray-core"]
+    assert xray_calls() == []
+
+def test_rotated_port_inside_published_range_is_applied_live(config, tmpdir, xray_calls):
+
+    config["xray_refurbish_rotate_port"] = True
+    config["docker_ports_publishing"] = "ranges"
+    generate(config, tmpdir)
+
+    refurbished, services_to_recreate = refurbish_and_apply(config, tmpdir, [0])
+    old_inbound, inbound = refurbished[0]
+
+    assert inbound.port != old_inbound.port
+    assert services_to_recreate == []
+    assert [call["args"][1] for call in xray_calls()] == ["rmi", "adi"]
+
+def test_disabled_api_recreates(config, tmpdir, xray_calls):
+
+    config["xray_refurbish_rotate_port"] = False
+    config["xray_api_enabled"] = False
+    generate(config, tmpdir)
+
+    _, services_to_recreate = refurbish_and_apply(config, tmpdir, [0])
+
+    assert services_to_recreate == ["xray-core"]
+    assert xray_calls() == []
+
+def use_two_shards_with_ranges(config):
+    config["docker_ports_publishing"] = "ranges"
+    config["xray_shards"] = {"count": 2, "pin_cpus": False, "cpusets": []}
+    config["xray_inbound_separated_instances"] = {"shadowsocks_instances_count": 5}
+
+def test_kept_port_keeps_the_shard(config, tmpdir, xray_calls):
+
+    config["xray_refurbish_rotate_port"] = False
+    use_two_shards_with_ranges(config)
+    generate(config, tmpdir)
+
+    # the extra instance leaves the shards unbalanced, a rebalance would move instance 0
+    added = add_xray_inbound_instances(config, tmpdir, 1)
+    apply_xray_inbound_instances_live(config, tmpdir, added)
+
+    refurbished, services_to_recreate = refurbish_and_apply(config, tmpdir, [0])
+    old_inbound, inbound = refurbished[0]
+
+    assert inbound.shard == old_inbound.shard
+    assert inbound.port == old_inbound.port
+    assert is_port_published(config, get_state_store(tmpdir), inbound.shard, inbound.port)
+    assert services_to_recreate == []
+
+def test_rotated_port_comes_from_the_block_of_the_new_shard(config, tmpdir, xray_calls):
+
+    config["xray_refurbish_rotate_port"] = True
+    use_two_shards_with_ranges(config)
+    generate(config, tmpdir)
+    add_xray_inbound_instances(config, tmpdir, 1)
+
+    store = get_state_store(tmpdir)
+
+    for instance_num in range(len(store.inbounds)):
+        (_, inbound), = refurbish_xray_inbound_instances(config, tmpdir, [instance_num])
+
+        assert is_port_published(config, store, inbound.shard, inbound.port)
+
+def test_rotation_with_an_exhausted_port_pool_takes_the_old_port(config, tmpdir, xray_calls):
+
+    config["xray_refurbish_rotate_port"] = True
+    config["docker_ports_publishing"] = "ports"
+    generate(config, tmpdir)
+
+    allocator = get_port_allocator(tmpdir)
+    allocator.allocate_many(allocator.free_count)
+
+    (old_inbound, inbound), = refurbish_xray_inbound_instances(config, tmpdir, [0])
+
+    assert inbound.port == old_inbound.port
+    assert inbound.password != old_inbound.password
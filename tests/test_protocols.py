@@ -0,0 +1,14 @@
+import pytest
+
+from protocols import get_configured_engine
+
+def test_vless_needs_the_cleartext_opt_in(config):
+
+    config["xray_inbound_protocol"] = "vless"
+
+    with pytest.raises(ValueError, match="xray_vless_allow_cleartext"):
+        get_configured_engine(config)
+
+    config["xray_vless_allow_cleartext"] = True
+
+    assert get_configured_engine(config).name == "vless"
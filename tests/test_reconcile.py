@@ -0,0 +1,86 @@
+import pytest
+
+import reconcile
+
+from reconcile import SERVICE_HASH_LABEL, mark_config_applied, plan_docker_compose_reconcile, record_applied_services
+from services import generate_xray_config, generate_docker_compose, set_xray_log_level
+from state import load_docker_compose
+
+@pytest.fixture
+def containers(config, tmpdir, monkeypatch):
+    """
+    Generates two shards and stands in for docker: returns the {service: container} dict the plan sees,
+    every container starts out running the generated definition.
+    """
+
+    config["xray_shards"] = {"count": 2, "pin_cpus": False, "cpusets": []}
+    config["xray_inbound_separated_instances"] = {"shadowsocks_instances_count": 4}
+
+    generate_xray_config(config=config, tmpdir=tmpdir)
+    generate_docker_compose(config=config, tmpdir=tmpdir)
+
+    docker_compose = load_docker_compose(f"{tmpdir}/docker-compose.yml")
+    containers = {
+        service: {"id": f"id-{service}", "running": True, "service_hash": definition["labels"][SERVICE_HASH_LABEL]}
+        for service, definition in docker_compose["services"].items()
+    }
+
+    monkeypatch.setattr(reconcile, "inspect_compose_containers", lambda tmpdir: containers)
+
+    return containers
+
+def test_nothing_running_brings_everything_up(config, tmpdir, containers):
+
+    containers.clear()
+
+    assert plan_docker_compose_reconcile(tmpdir) == (["xray-core-1", "xray-core-2"], [], False)
+
+def test_up_to_date_containers_are_left_alone(config, tmpdir, containers):
+
+    record_applied_services(tmpdir)
+
+    assert plan_docker_compose_reconcile(tmpdir) == ([], [], False)
+
+def test_containers_never_recorded_are_restarted(config, tmpdir, containers):
+
+    # e.g. started by an older version that didn't write applied.json
+    assert plan_docker_compose_reconcile(tmpdir) == ([], ["xray-core-1", "xray-core-2"], False)
+
+def test_changed_definition_or_stopped_container_is_brought_up(config, tmpdir, containers):
+
+    record_applied_services(tmpdir)
+    containers["xray-core-1"]["service_hash"] = "older"
+    containers["xray-core-2"]["running"] = False
+
+    assert plan_docker_compose_reconcile(tmpdir) == (["xray-core-1", "xray-core-2"], [], False)
+
+def test_changed_config_only_restarts(config, tmpdir, containers):
+
+    record_applied_services(tmpdir)
+    set_xray_log_level(config, tmpdir, "debug")
+
+    assert plan_docker_compose_reconcile(tmpdir) == ([], ["xray-core-1", "xray-core-2"], False)
+
+def test_config_applied_through_the_api_needs_no_restart(config, tmpdir, containers):
+
+    record_applied_services(tmpdir)
+    set_xray_log_level(config, tmpdir, "debug")
+    mark_config_applied(tmpdir, ["xray-core-2"])
+
+    assert plan_docker_compose_reconcile(tmpdir) == ([], ["xray-core-1"], False)
+
+def test_recreated_container_is_restarted(config, tmpdir, containers):
+
+    record_applied_services(tmpdir)
+
+    # a container the applied config wasn't recorded for, e.g. recreated by hand
+    containers["xray-core-2"]["id"] = "id-new"
+
+    assert plan_docker_compose_reconcile(tmpdir) == ([], ["xray-core-2"], False)
+
+def test_orphans_are_reported(config, tmpdir, containers):
+
+    record_applied_services(tmpdir)
+    containers["xray-core-3"] = {"id": "id-xray-core-3", "running": True, "service_hash": "whatever"}
+
+    assert plan_docker_compose_reconcile(tmpdir) == ([], [], True)
@@ -0,0 +1,122 @@
+import asyncio
+import time
+
+import pytest
+
+from rotation import RotationScheduler, cron_schedule_matches, parse_cron_field, parse_cron_schedule
+from services import generate_xray_config, generate_docker_compose
+from state import get_state_store, reset_state_store
+
+def local_timestamp(year, month, day, hour, minute):
+    return time.mktime((year, month, day, hour, minute, 0, 0, 0, -1))
+
+def test_parse_cron_field():
+
+    assert parse_cron_field("*", 0, 6) == {0, 1, 2, 3, 4, 5, 6}
+    assert parse_cron_field("1,3,5", 0, 6) == {1, 3, 5}
+    assert parse_cron_field("2-4", 0, 6) == {2, 3, 4}
+    assert parse_cron_field("*/15", 0, 59) == {0, 15, 30, 45}
+    assert parse_cron_field("10-20/5,59", 0, 59) == {10, 15, 20, 59}
+
+@pytest.mark.parametrize("field", ["60", "5-1", "0"])
+def test_parse_cron_field_out_of_range(field):
+
+    with pytest.raises(ValueError):
+        parse_cron_field(field, 1, 59)
+
+def test_parse_cron_schedule_needs_five_fields():
+
+    with pytest.raises(ValueError):
+        parse_cron_schedule("0 4 * *")
+
+def test_cron_schedule_matches():
+
+    # 2024-01-01 was a monday
+    every_day_at_four = parse_cron_schedule("0 4 * * *")
+
+    assert cron_schedule_matches(every_day_at_four, local_timestamp(2024, 1, 1, 4, 0))
+    assert not cron_schedule_matches(every_day_at_four, local_timestamp(2024, 1, 1, 4, 1))
+    assert not cron_schedule_matches(every_day_at_four, local_timestamp(2024, 1, 1, 5, 0))
+
+    sundays = parse_cron_schedule("30 2 * * 0")
+
+    assert cron_schedule_matches(sundays, local_timestamp(2024, 1, 7, 2, 30))
+    assert not cron_schedule_matches(sundays, local_timestamp(2024, 1, 1, 2, 30))
+
+def test_cron_restricted_days_match_either():
+
+    # like cron: the 15th or any monday
+    schedule = parse_cron_schedule("0 0 15 * 1")
+
+    assert cron_schedule_matches(schedule, local_timestamp(2024, 1, 15, 0, 0))
+    assert cron_schedule_matches(schedule, local_timestamp(2024, 1, 8, 0, 0))
+    assert not cron_schedule_matches(schedule, local_timestamp(2024, 1, 9, 0, 0))
+
+def make_scheduler(config, tmpdir, **rotation_settings):
+    return RotationScheduler(dict(config, rotation=dict({"enabled": True}, **rotation_settings)), tmpdir)
+
+@pytest.fixture
+def store(config, tmpdir):
+    config["xray_inbound_separated_instances"] = {"shadowsocks_instances_count": 4}
+    generate_xray_config(config=config, tmpdir=tmpdir)
+    generate_docker_compose(config=config, tmpdir=tmpdir)
+    return get_state_store(tmpdir)
+
+def test_nothing_is_due_while_young(config, tmpdir, store):
+
+    scheduler = make_scheduler(config, tmpdir, max_age=3600)
+
+    assert scheduler.collect_due(time.time()) == []
+
+def test_oldest_go_first_up_to_max_per_window(config, tmpdir, store):
+
+    for age, tag in zip((100, 400, 300, 200), ["shadowsocks-1", "shadowsocks-2", "shadowsocks-3", "shadowsocks-4"]):
+        store.created_at[tag] = time.time() - age
+
+    scheduler = make_scheduler(config, tmpdir, max_age=150, max_per_window=2)
+
+    assert scheduler.collect_due(time.time()) == [("shadowsocks-2", "age"), ("shadowsocks-3", "age")]
+
+def test_ages_survive_a_restart(config, tmpdir, store):
+
+    store.created_at["shadowsocks-3"] = time.time() - 7200
+    store.commit()
+
+    # a new process reads the state back instead of starting every age over
+    reset_state_store(tmpdir)
+
+    scheduler = make_scheduler(config, tmpdir, max_age=3600)
+
+    assert scheduler.collect_due(time.time()) == [("shadowsocks-3", "age")]
+
+def test_schedule_makes_everything_due_window_by_window(config, tmpdir, store, xray_calls):
+
+    scheduler = make_scheduler(config, tmpdir, schedule="* * * * *", max_per_window=3)
+
+    rotated = asyncio.run(scheduler.rotate_due())
+
+    assert [reason for _, reason in rotated] == ["schedule"] * 3
+
+    # the same minute doesn't fire again, the rest of the tick is drained
+    now = time.time()
+    scheduler.last_checked_minute = int(now // 60) * 60
+
+    assert len(scheduler.collect_due(now)) == 1
+
+def test_rotation_goes_by_tag(config, tmpdir, store, xray_calls):
+
+    store.created_at["shadowsocks-2"] = time.time() - 7200
+    old_inbound = store.get(1)
+
+    scheduler = make_scheduler(config, tmpdir, max_age=3600)
+    rotated = asyncio.run(scheduler.rotate_due())
+
+    inbound = get_state_store(tmpdir).get(1)
+
+    assert rotated == [("shadowsocks-2", "age")]
+    assert (inbound.tag, inbound.port) == (old_inbound.tag, old_inbound.port)
+    assert inbound.password != old_inbound.password
+    assert [call["args"][1] for call in xray_calls()] == ["rmi", "adi"]
+
+    # the refurbished instance is young again
+    assert scheduler.collect_due(time.time()) == []
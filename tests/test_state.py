@@ -0,0 +1,144 @@
+import json
+import os
+
+import pytest
+
+from services import (
+    generate_xray_config,
+    generate_docker_compose,
+    add_xray_inbound_instances,
+    load_state_dir,
+    store_matches_config,
+    sync_xray_api_settings
+)
+from state import StateStore, get_state_store, reset_state_store
+
+def generate(config, tmpdir):
+    generate_xray_config(config=config, tmpdir=tmpdir)
+    generate_docker_compose(config=config, tmpdir=tmpdir)
+    return get_state_store(tmpdir)
+
+def reload(tmpdir):
+    reset_state_store(tmpdir)
+    return get_state_store(tmpdir)
+
+def rows(store):
+    return [inbound.to_row() for inbound in store.inbounds]
+
+def test_state_round_trip(config, tmpdir):
+
+    config["xray_shards"] = {"count": 2, "pin_cpus": False, "cpusets": []}
+    config["docker_ports_publishing"] = "ranges"
+    store = generate(config, tmpdir)
+
+    reloaded = reload(tmpdir)
+
+    assert reloaded is not store
+    assert rows(reloaded) == rows(store)
+    assert reloaded.shards_count == 2
+    assert reloaded.port_blocks == store.port_blocks
+    assert sorted(reloaded.used_ports) == sorted(store.used_ports)
+    assert [reloaded.render_xray_config(shard) for shard in range(2)] == [store.render_xray_config(shard) for shard in range(2)]
+
+def test_missing_xray_config_is_rendered_again(config, tmpdir):
+
+    store = generate(config, tmpdir)
+    os.unlink(f"{tmpdir}/config.json")
+
+    reload(tmpdir)
+
+    with open(f"{tmpdir}/config.json") as f:
+        assert json.load(f) == store.render_xray_config()
+
+def test_configs_without_state_are_parsed_back(config, tmpdir):
+
+    # tmpdirs written before state.json existed only have the xray configs
+    store = generate(config, tmpdir)
+
+    for name in ("state.json", "inbounds.tsv"):
+        os.unlink(f"{tmpdir}/{name}")
+
+    assert rows(reload(tmpdir)) == rows(store)
+
+def corrupt(tmpdir, name, change):
+
+    with open(f"{tmpdir}/{name}") as f:
+        content = f.read()
+
+    with open(f"{tmpdir}/{name}", "w") as f:
+        f.write(change(content))
+
+def test_unknown_state_version_is_refused(config, tmpdir):
+
+    generate(config, tmpdir)
+    corrupt(tmpdir, "state.json", lambda content: json.dumps(dict(json.loads(content), version=0)))
+
+    with pytest.raises(ValueError, match="version"):
+        StateStore.load(tmpdir)
+
+def test_inbound_of_a_missing_shard_is_refused(config, tmpdir):
+
+    generate(config, tmpdir)
+    corrupt(tmpdir, "inbounds.tsv", lambda content: content.replace("\t0\n", "\t1\n", 1))
+
+    with pytest.raises(ValueError, match="shards"):
+        StateStore.load(tmpdir)
+
+def test_duplicate_tags_are_refused(config, tmpdir):
+
+    generate(config, tmpdir)
+    corrupt(tmpdir, "inbounds.tsv", lambda content: content + content.splitlines(keepends=True)[0])
+
+    with pytest.raises(ValueError, match="duplicate"):
+        StateStore.load(tmpdir)
+
+def test_users_of_a_missing_listener_are_refused(multi_user_config, tmpdir):
+
+    generate(multi_user_config, tmpdir)
+    corrupt(tmpdir, "users.tsv", lambda content: content.replace("shadowsocks-2022-1", "shadowsocks-2022-9", 1))
+
+    with pytest.raises(ValueError, match="listeners"):
+        StateStore.load(tmpdir)
+
+def test_store_matches_config(config, tmpdir):
+
+    store = generate(config, tmpdir)
+
+    assert store_matches_config(config, store)
+
+    # instances added on top of the configured count still fit
+    add_xray_inbound_instances(config, tmpdir, 1)
+    assert store_matches_config(config, store)
+
+    assert not store_matches_config(dict(config, xray_inbound_separated_instances={"shadowsocks_instances_count": 10}), store)
+    assert not store_matches_config(dict(config, xray_shadowsocks_inbound_method="chacha20-ietf-poly1305"), store)
+    assert not store_matches_config(dict(config, xray_shadowsocks_inbound_network="tcp"), store)
+    assert not store_matches_config(dict(config, docker_ports_publishing="ranges"), store)
+    assert not store_matches_config(dict(config, xray_shards={"count": 2}), store)
+
+def test_api_and_stats_settings_are_synced_not_refused(config, tmpdir):
+
+    config["xray_api_enabled"] = True
+    config["metrics"] = {"enabled": False}
+    store = generate(config, tmpdir)
+    passwords = [inbound.password for inbound in store.inbounds]
+
+    changed_config = dict(config, xray_api_enabled=False, metrics={"enabled": True})
+
+    # the state still fits, its api and stats sections are rebuilt instead
+    assert load_state_dir(changed_config, tmpdir)
+    assert sync_xray_api_settings(changed_config, tmpdir)
+    assert not sync_xray_api_settings(changed_config, tmpdir)
+
+    xray_config = reload(tmpdir).render_xray_config()
+
+    assert "api" not in xray_config
+    assert "stats" in xray_config and xray_config["policy"]["system"]["statsInboundUplink"]
+    assert [inbound.password for inbound in get_state_store(tmpdir).inbounds] == passwords
+
+def test_state_of_other_settings_is_refused(config, tmpdir):
+
+    generate(config, tmpdir)
+
+    with pytest.raises(ValueError, match="reset-state"):
+        load_state_dir(dict(config, xray_shadowsocks_inbound_network="tcp"), tmpdir)
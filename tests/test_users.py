@@ -0,0 +1,126 @@
+import json
+
+import pytest
+
+from services import (
+    generate_xray_config,
+    generate_docker_compose,
+    add_xray_inbound_instances,
+    add_xray_users,
+    refurbish_xray_users,
+    revoke_xray_users,
+    apply_xray_users_live
+)
+from state import get_state_store, reset_state_store
+
+def generate(config, tmpdir):
+    generate_xray_config(config=config, tmpdir=tmpdir)
+    generate_docker_compose(config=config, tmpdir=tmpdir)
+    return get_state_store(tmpdir)
+
+def users_by_listener(store):
+    return {tag: sorted(user.tag for user in users) for tag, users in store.group_users().items()}
+
+def test_users_are_spread_over_the_listeners(multi_user_config, tmpdir):
+
+    store = generate(multi_user_config, tmpdir)
+
+    assert len(store.inbounds) == 2
+    assert sorted(len(users) for users in users_by_listener(store).values()) == [2, 3]
+
+    add_xray_users(multi_user_config, tmpdir, 1)
+
+    assert sorted(len(users) for users in users_by_listener(store).values()) == [3, 3]
+
+def test_added_users_are_applied_live(multi_user_config, tmpdir, xray_calls):
+
+    store = generate(multi_user_config, tmpdir)
+
+    added = add_xray_users(multi_user_config, tmpdir, 2)
+    services_to_restart = apply_xray_users_live(multi_user_config, tmpdir, added)
+
+    assert [user.tag for _, user in added] == ["user-6", "user-7"]
+    assert services_to_restart == []
+
+    calls = xray_calls()
+
+    # one adu per listener, carrying only the new users
+    assert [call["args"][1] for call in calls] == ["adu", "adu"]
+
+    for call in calls:
+        inbound_object = json.loads(call["stdin"])["inbounds"][0]
+        new_users = [user for _, user in added if user.inbound_tag == inbound_object["tag"]]
+
+        assert [client["email"] for client in inbound_object["settings"]["clients"]] == [user.tag for user in new_users]
+        assert store.get_inbound_by_tag(inbound_object["tag"]).port == inbound_object["port"]
+
+def test_refurbished_users_keep_tag_and_listener(multi_user_config, tmpdir, xray_calls):
+
+    store = generate(multi_user_config, tmpdir)
+    old_listeners = users_by_listener(store)
+
+    refurbished = refurbish_xray_users(multi_user_config, tmpdir, ["user-1", "user-1"])
+    services_to_restart = apply_xray_users_live(multi_user_config, tmpdir, refurbished)
+
+    (old_user, user), = refurbished
+
+    assert (user.tag, user.inbound_tag) == (old_user.tag, old_user.inbound_tag)
+    assert user.password != old_user.password
+    assert users_by_listener(store) == old_listeners
+    assert services_to_restart == []
+
+    # the old credential goes first, then the user comes back with the new one
+    rmu, adu = xray_calls()
+
+    assert rmu["args"][1] == "rmu" and rmu["args"][-2:] == [f"-tag={user.inbound_tag}", "user-1"]
+    assert adu["args"][1] == "adu"
+    assert json.loads(adu["stdin"])["inbounds"][0]["settings"]["clients"][0]["password"] == user.password
+
+def test_revoked_user_tags_are_never_handed_out_again(multi_user_config, tmpdir, xray_calls):
+
+    store = generate(multi_user_config, tmpdir)
+
+    revoked = revoke_xray_users(multi_user_config, tmpdir, ["user-5"])
+    apply_xray_users_live(multi_user_config, tmpdir, revoked)
+
+    assert "user-5" not in store.list_user_tags()
+    assert [call["args"][1] for call in xray_calls()] == ["rmu"]
+
+    # not even after a restart
+    reset_state_store(tmpdir)
+
+    added = add_xray_users(multi_user_config, tmpdir, 1)
+
+    assert added[0][1].tag == "user-6"
+
+def test_users_survive_a_reload(multi_user_config, tmpdir):
+
+    store = generate(multi_user_config, tmpdir)
+    refurbish_xray_users(multi_user_config, tmpdir, ["user-2"])
+    revoke_xray_users(multi_user_config, tmpdir, ["user-3"])
+    add_xray_users(multi_user_config, tmpdir, 1)
+
+    users = [(user.tag, user.inbound_tag, user.password) for user in store.users]
+
+    # users.tsv is read back on the next start
+    reset_state_store(tmpdir)
+    reloaded = get_state_store(tmpdir)
+
+    assert reloaded is not store
+    assert [(user.tag, user.inbound_tag, user.password) for user in reloaded.users] == users
+
+def test_refused_api_call_falls_back_to_restart(multi_user_config, tmpdir, xray_calls, monkeypatch):
+
+    generate(multi_user_config, tmpdir)
+    monkeypatch.setenv("XRAY_STUB_FAIL", "adu")
+
+    added = add_xray_users(multi_user_config, tmpdir, 1)
+
+    assert apply_xray_users_live(multi_user_config, tmpdir, added) == ["xray-core"]
+
+def test_listeners_are_not_added_in_multi_user_mode(multi_user_config, tmpdir):
+
+    generate(multi_user_config, tmpdir)
+
+    with pytest.raises(ValueError):
+        add_xray_inbound_instances(multi_user_config, tmpdir, 1)
@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from xray_api import XrayApiError, query_inbound_traffic
+
+def set_stats(monkeypatch, stats):
+    monkeypatch.setenv("XRAY_STUB_STATS", json.dumps(stats))
+
+def test_query_inbound_traffic_sums_per_tag(config, tmpdir, xray_calls, monkeypatch):
+
+    set_stats(monkeypatch, {"stat": [
+        {"name": "inbound>>>shadowsocks-1>>>traffic>>>uplink", "value": 1024},
+        {"name": "inbound>>>shadowsocks-1>>>traffic>>>downlink", "value": "4096"},
+        {"name": "inbound>>>shadowsocks-2>>>traffic>>>downlink", "value": 7}
+    ]})
+
+    assert query_inbound_traffic(config, tmpdir) == {
+        "shadowsocks-1": {"uplink": 1024, "downlink": 4096},
+        "shadowsocks-2": {"uplink": 0, "downlink": 7}
+    }
+    assert xray_calls()[0]["args"] == ["api", "statsquery", "--server=127.0.0.1:10085", "-pattern", "inbound>>>"]
+
+def test_query_inbound_traffic_zero_counters_come_without_value(config, tmpdir, xray_calls, monkeypatch):
+
+    set_stats(monkeypatch, {"stat": [
+        {"name": "inbound>>>vless-1>>>traffic>>>uplink"},
+        {"name": "inbound>>>vless-1>>>traffic>>>downlink"}
+    ]})
+
+    assert query_inbound_traffic(config, tmpdir) == {"vless-1": {"uplink": 0, "downlink": 0}}
+
+@pytest.mark.parametrize("stdout", ["", "{}"])
+def test_query_inbound_traffic_without_counters(config, tmpdir, xray_calls, monkeypatch, stdout):
+
+    monkeypatch.setenv("XRAY_STUB_STATS", stdout)
+
+    assert query_inbound_traffic(config, tmpdir) == {}
+
+def test_query_inbound_traffic_asks_the_shard_api(config, tmpdir, xray_calls, monkeypatch):
+
+    # with host networking every shard listens on the next port
+    config["docker_ports_publishing"] = "host"
+    set_stats(monkeypatch, {})
+
+    query_inbound_traffic(config, tmpdir, shard=2, shards_count=3)
+
+    assert xray_calls()[0]["args"][2] == "--server=127.0.0.1:10087"
+
+def test_query_inbound_traffic_raises_when_the_api_fails(config, tmpdir, xray_calls, monkeypatch):
+
+    monkeypatch.setenv("XRAY_STUB_FAIL", "statsquery")
+
+    with pytest.raises(XrayApiError):
+        query_inbound_traffic(config, tmpdir)
@@ -0,0 +1,19 @@
+from xray_logs import AccessLogTailer
+
+ACCEPTED_LINE = "2024/01/01 12:00:00 1.2.3.4:5678 accepted tcp:example.com:443 [shadowsocks-1 >> direct]\n"
+REJECTED_LINE = "2024/01/01 12:00:00 from 1.2.3.4:5678 rejected proxy/shadowsocks: failed to read 50 bytes\n"
+
+def test_rejects_are_counted_per_shard(tmp_path):
+
+    (tmp_path / "xray-core").mkdir()
+    (tmp_path / "xray-core" / "access.log").write_text(ACCEPTED_LINE * 3 + REJECTED_LINE)
+
+    tailer = AccessLogTailer({"xray_log": {"dir": str(tmp_path), "access_log": True}})
+    tailer.poll(["xray-core"])
+
+    # the reject names no inbound, it lands on the shard's service
+    assert tailer.counts == {
+        "shadowsocks-1": {"accepted": 3, "rejected": 0},
+        "xray-core": {"accepted": 0, "rejected": 1}
+    }
+    assert tailer.service_counts == {"xray-core": {"accepted": 3, "rejected": 1}}